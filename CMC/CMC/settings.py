@@ -83,6 +83,28 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+# 'harmony' stores results of checking pieces (see harmony_cache.py). Use
+# django.core.cache.backends.filebased.FileBasedCache to share it between
+# processes
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'harmony': {
+        'BACKEND': 'CheckMyChords.cache_backends.LRULocMemCache',
+        'LOCATION': 'harmony',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+            'CULL_FREQUENCY': 10,
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -125,6 +147,9 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Maximum size of MIDI files kept in memory (in each process), in bytes
+MIDI_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
 
 # Other settings
 
@@ -21,10 +21,17 @@ from django.contrib.auth import views as auth_views
 
 from CheckMyChords.views import (
     SignUpView,
+    ApiCheckView,
+    ApiSearchView,
     AddPieceView,
     CheckPieceView,
+    CheckPieceStreamView,
+    EditPieceView,
     PiecesView,
     GenerateMidiView,
+    DownloadMidiView,
+    RuleStatsView,
+    ViolationStatsView,
 )
 
 
@@ -38,9 +45,20 @@ urlpatterns = [
     url(r'^new_piece$', AddPieceView.as_view(), name="add_new_piece"),
     url(r'^check_piece/(?P<piece_id>(\d)+)$', CheckPieceView.as_view(),
         name = 'check_piece' ),
+    url(r'^check_piece/(?P<piece_id>(\d)+)/stream$',
+        CheckPieceStreamView.as_view(), name = 'check_piece_stream'),
+    url(r'^check_piece/(?P<piece_id>(\d)+)/edit$', EditPieceView.as_view(),
+        name = 'edit_piece'),
     url(r'^$', PiecesView.as_view(), name = 'pieces'),
+    url(r'^api/check$', ApiCheckView.as_view(), name = 'api_check'),
+    url(r'^api/search$', ApiSearchView.as_view(), name = 'api_search'),
+    url(r'^api/violation_stats$', ViolationStatsView.as_view(),
+        name = 'violation_stats'),
+    url(r'^debug/rule_stats$', RuleStatsView.as_view(), name = 'rule_stats'),
     url(r'^generate_midi/(?P<piece_id>(\d)+)$', GenerateMidiView.as_view(),
         name = "generate_midi"),
+    url(r'^download_midi/(?P<piece_id>(\d)+)$', DownloadMidiView.as_view(),
+        name = "download_midi"),
 ]
 urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
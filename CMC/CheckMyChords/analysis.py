@@ -0,0 +1,143 @@
+# Keeps PieceAnalysis of each MusicPiece up to date
+import json
+
+from django.db.models import F
+
+from CheckMyChords.harmony_rules import (
+    ANALYSIS_VERSION,
+    MODES,
+    RULES,
+    RULE_VERSIONS,
+    VOICES,
+    check_harmony_rules,
+)
+from CheckMyChords.models import MusicPiece, PieceAnalysis, PieceViolation
+from CheckMyChords.search import (
+    index_piece,
+    piece_sequences,
+    update_index,
+    window_ngrams,
+)
+
+
+PART_FIELDS = ('soprano', 'alto', 'tenor', 'bass')
+
+
+def stale_rules(analysis, parts_hash):
+    # rules that have to be checked again - all of them if the parts (or the
+    # chord analysis) changed, otherwise only those with a new RULE_VERSION
+    if analysis.parts_hash != parts_hash \
+            or analysis.analysis_version != ANALYSIS_VERSION:
+        return list(RULES)
+    versions = analysis.rule_versions_dict
+    return [rule for rule in RULES if versions.get(rule) != RULE_VERSIONS[rule]]
+
+def _analysis_of(music_piece):
+    try:
+        return music_piece.analysis
+    except PieceAnalysis.DoesNotExist:
+        return PieceAnalysis(piece=music_piece)
+
+def _store(music_piece, analysis, piece, rules):
+    # stores results of the rules checked in piece - counts and mistakes (see
+    # PieceViolation), chords and key if all the rules were checked (then the
+    # search index of the piece is updated as well)
+    if len(rules) == len(RULES):
+        # everything was checked, chords and key have to be stored as well
+        analysis.parts_hash = music_piece.parts_hash
+        analysis.analysis_version = ANALYSIS_VERSION
+        analysis.key = piece.key_hr
+        analysis.chords = json.dumps(_chords(piece, 0, len(piece)))
+        counts = {}
+        versions = {}
+    else:
+        counts = analysis.rule_counts_dict
+        versions = analysis.rule_versions_dict
+    for rule in rules:
+        counts[rule] = list(piece.rule_counts[rule])
+        versions[rule] = RULE_VERSIONS[rule]
+    analysis.rule_counts = json.dumps(counts, sort_keys=True)
+    analysis.rule_versions = json.dumps(versions, sort_keys=True)
+    analysis.err_count = sum(count[0] for count in counts.values())
+    analysis.war_count = sum(count[1] for count in counts.values())
+    analysis.save()
+    _store_violations(music_piece, piece, rules)
+    if len(rules) == len(RULES):
+        index_piece(music_piece, piece)
+    return analysis
+
+def _chords(piece, start, stop):
+    # root, mode and function of chords start..stop-1 (as stored)
+    return [
+        [root, MODES[mode], function] for root, mode, function
+        in zip(piece._roots[start:stop], piece._modes[start:stop],
+               piece._functions()[start:stop])
+    ]
+
+def _piece_violations(music_piece, violations):
+    return [
+        PieceViolation(piece=music_piece, author_id=music_piece.author_id,
+                       date_added=music_piece.date_added, **violation._asdict())
+        for violation in violations
+    ]
+
+def _store_violations(music_piece, piece, rules):
+    # replaces the stored mistakes of the rules checked
+    PieceViolation.objects.filter(piece=music_piece, rule__in=rules).delete()
+    PieceViolation.objects.bulk_create(_piece_violations(music_piece, [
+        violation for violation in piece.violations if violation.rule in rules
+    ]))
+
+def update_analysis(music_piece, force=False):
+    # creates or updates the stored analysis of a piece, returns it
+    analysis = _analysis_of(music_piece)
+    parts_hash = music_piece.parts_hash
+    rules = list(RULES) if force else stale_rules(analysis, parts_hash)
+    if not rules:
+        return analysis
+    piece = check_harmony_rules(music_piece, rules)
+    return _store(music_piece, analysis, piece, rules)
+
+def patch_piece(music_piece, piece, start, stop, parts):
+    # edits a music_piece - chords start..stop-1 are replaced with parts (see
+    # Piece.patch), piece - the music_piece checked with all the rules. The
+    # parts are saved without post_save, the analysis stored is changed only
+    # in the chords checked again (if it's the analysis of the piece before
+    # the edit, otherwise it's stored again). Returns the range of chords
+    # checked again
+    analysis = _analysis_of(music_piece)
+    current = analysis.pk is not None \
+        and not stale_rules(analysis, music_piece.parts_hash)
+    if current:
+        before = piece_sequences(piece)
+    length = len(piece)
+    lo, hi = piece.patch(start, stop, *parts)
+    delta = len(piece) - length
+    parts = piece.parts_str
+    for field, voice in zip(PART_FIELDS, VOICES):
+        setattr(music_piece, field, parts[voice])
+    MusicPiece.objects.filter(id=music_piece.id).update(
+        **{field: getattr(music_piece, field) for field in PART_FIELDS})
+    if not current:
+        _store(music_piece, analysis, piece, list(RULES))
+        return lo, hi
+    # chords lo..hi-1 were lo..hi-delta-1 before the edit
+    analysis.parts_hash = music_piece.parts_hash
+    analysis.key = piece.key_hr
+    chords = analysis.chords_list
+    chords[lo:hi - delta] = _chords(piece, lo, hi)
+    analysis.chords = json.dumps(chords)
+    counts = {rule: list(count) for rule, count in piece.rule_counts.items()}
+    analysis.rule_counts = json.dumps(counts, sort_keys=True)
+    analysis.err_count = piece.err_count
+    analysis.war_count = piece.war_count
+    analysis.save()
+    violations = PieceViolation.objects.filter(piece=music_piece)
+    violations.filter(beat__gte=lo, beat__lt=hi - delta).delete()
+    if delta:
+        violations.filter(beat__gte=hi - delta).update(beat=F('beat') + delta)
+    PieceViolation.objects.bulk_create(
+        _piece_violations(music_piece, piece.violations_in(lo, hi)))
+    update_index(music_piece, window_ngrams(*before, lo, hi - delta),
+                 window_ngrams(*piece_sequences(piece), lo, hi))
+    return lo, hi
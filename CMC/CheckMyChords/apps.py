@@ -7,5 +7,6 @@ from pyknon.music import Note
 
 class CheckmychordsConfig(AppConfig):
     name = 'CheckMyChords'
-    
 
+    def ready(self):
+        import CheckMyChords.signals
@@ -0,0 +1,38 @@
+# Cache backends used by CMC (see CACHES in settings)
+from collections import OrderedDict
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends import locmem
+
+
+class LRULocMemCache(locmem.LocMemCache):
+    # Local memory cache evicting the least recently used entries (the
+    # default LocMemCache culls entries regardless of how often they're used)
+    # OPTIONS: MAX_ENTRIES - size of the cache, CULL_FREQUENCY - 1/n of the
+    # entries is evicted when the cache is full
+
+    def __init__(self, name, params):
+        locmem._caches.setdefault(name, OrderedDict())
+        super(LRULocMemCache, self).__init__(name, params)
+
+    def get(self, key, default=None, version=None, acquire_lock=True):
+        value = super(LRULocMemCache, self).get(key, default, version,
+                                                acquire_lock)
+        key = self.make_key(key, version=version)
+        with (self._lock.writer() if acquire_lock else locmem.dummy()):
+            if key in self._cache:
+                self._cache.move_to_end(key)  # most recently used
+        return value
+
+    def _set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        self._cache.pop(key, None)  # (re)inserted keys go to the end
+        super(LRULocMemCache, self)._set(key, value, timeout)
+
+    def _cull(self):
+        if self._cull_frequency == 0:
+            self.clear()
+        else:
+            count = max(len(self._cache) // self._cull_frequency, 1)
+            doomed = [k for (i, k) in zip(range(count), self._cache)]
+            for k in doomed:
+                self._delete(k)
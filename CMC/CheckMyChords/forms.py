@@ -1,56 +1,65 @@
 from django import forms
 from django.core.exceptions import ValidationError
 
-from pyknon.music import NoteSeq
-
+from CheckMyChords.harmony_rules import RULE_REGISTRY
 from CheckMyChords.models import MusicPiece
+from CheckMyChords.notation import parse_notes
 from CheckMyChords.validators import NotesValidator
 
 
-class NewPieceForm(forms.Form):
-    title = forms.CharField(max_length=64, label="Title")
+class PartsForm(forms.Form):
+    # Four parts of a piece (in CMC notation)
     soprano = forms.CharField(validators = [NotesValidator])
     alto = forms.CharField(validators = [NotesValidator])
     tenor = forms.CharField(validators = [NotesValidator])
     bass = forms.CharField(validators = [NotesValidator])
-    is_public = forms.BooleanField(required=False)
-    # The TODOs below are TODO when rewriting Note class ("leaving" pyknon)
-    #     TODO: add a key field (not required), turn set_key into a fallback
-    #       key = forms.CharField(validaators = [KeyValidator], required=False)
-    #     TODO: make it possible to add parts in English notation (C4 for
-    #       middle C) (just need to change numbers to ' or ,-s)
 
     def clean(self):
         # Validates if all parts in the input have the same length
-        cleaned_data = super(NewPieceForm, self).clean()
+        # (parts have been already parsed by NotesValidator)
+        cleaned_data = super(PartsForm, self).clean()
         try:
-            s = len(NoteSeq(cleaned_data['soprano']))
-            a = len(NoteSeq(cleaned_data['alto']))
-            t = len(NoteSeq(cleaned_data['tenor']))
-            b = len(NoteSeq(cleaned_data['bass']))
-            if not (s == a == t == b != 0):
-                msg = ValidationError("All parts must have the same length" + 
-                                    " and have more than 0 notes")
-                self.add_error(None, msg)
-        except Exception:
-            msg = ValidationError("Wrong input, unidentified error")
+            s = len(parse_notes(cleaned_data['soprano']))
+            a = len(parse_notes(cleaned_data['alto']))
+            t = len(parse_notes(cleaned_data['tenor']))
+            b = len(parse_notes(cleaned_data['bass']))
+        except KeyError:
+            # a part is invalid - the error is already shown for the field
+            return cleaned_data
+        if not (s == a == t == b != 0):
+            msg = ValidationError("All parts must have the same length" + 
+                                " and have more than 0 notes")
             self.add_error(None, msg)
-            # TODO: this should never happen after NotesValidator is
-            # strengthened
         return cleaned_data
 
+class NewPieceForm(PartsForm):
+    title = forms.CharField(max_length=64, label="Title")
+    is_public = forms.BooleanField(required=False)
+    field_order = ['title', 'soprano', 'alto', 'tenor', 'bass', 'is_public']
+    # The TODOs below are TODO when rewriting Note class ("leaving" pyknon)
+    #     TODO: add a key field (not required), turn set_key into a fallback
+    #       key = forms.CharField(validaators = [KeyValidator], required=False)
+    #     TODO: make it possible to add parts in English notation (C4 for
+    #       middle C) (just need to change numbers to ' or ,-s)
+
 class SelectRulesForm(forms.Form):
     # Determines which harmony rules will be used in check_harmony method
-    RULES = (
-        ("RANGE", 'Default voice ranges'),
-        ("LEAPS", 'Leaps of a seventh or above octave forbidden'),
-        ("DISTANCES", 'Distances allowed: S/A - max 8, A/T - less than 8, T/B - preferably below 12, max 15'),
-        ("PARALELS", '(Anti)consecutive unisons, perfect fifths and octaves forbidden'),
-        ("CHORDS", "Chords - in implementation"),
-        ("CHORDS_IN_CTX", "Chords (in musical context) -Not yet implemented")
-    )  
+    # (generated from the rules registered in harmony_rules)
+    RULES = tuple((rule.code, rule.label) for rule in RULE_REGISTRY.values())
     rules = forms.MultipleChoiceField(
         choices=RULES,
         widget=forms.CheckboxSelectMultiple(attrs={'checked' : 'checked'})
     )
 
+
+class CheckPartsForm(PartsForm):
+    # A piece sent to the API (api/check) - parts and rules to check,
+    # checking may stop after max_errors errors (see Piece.check_harmony)
+    rules = forms.MultipleChoiceField(
+        choices=(('ALL', 'All rules'),) + SelectRulesForm.RULES,
+        required=False,
+    )
+    max_errors = forms.IntegerField(min_value=0, required=False)
+
+    def clean_rules(self):
+        return self.cleaned_data['rules'] or ['ALL']
@@ -0,0 +1,103 @@
+# Caches results of check_harmony_rules. What is shown of a checked Piece
+# (see piece_results) is stored under a key made of its parts, the rules used
+# and ENGINE_VERSION (bumped whenever results of the rules change) - an edited
+# piece gets a new key.
+# Pieces being edited (see analysis.patch_piece) are kept as Pieces by the
+# process - a Piece can be patched instead of checking the edited piece again
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+
+from django.core.cache import caches
+
+from CheckMyChords.harmony_rules import ENGINE_VERSION, check_harmony_rules
+
+
+CACHE_ALIAS = 'harmony'
+# should be increased whenever the results stored change (see piece_results)
+RESULTS_VERSION = 4
+_stats = {"hits": 0, "misses": 0}
+_stats_lock = Lock()
+LIVE_PIECES = 8  # Pieces kept by a process for the next edit
+_live_pieces = OrderedDict()
+_live_pieces_lock = Lock()
+
+
+def _count(counter):
+    with _stats_lock:
+        _stats[counter] += 1
+
+def cache_stats():
+    # hits and misses of this process (since start or reset_cache_stats)
+    with _stats_lock:
+        return dict(_stats)
+
+def reset_cache_stats():
+    with _stats_lock:
+        for counter in _stats:
+            _stats[counter] = 0
+
+def result_key(music_piece, rules):
+    content = "{}:{}".format(music_piece.parts_hash, ",".join(sorted(rules)))
+    return "harmony:{}.{}:{}".format(
+        ENGINE_VERSION,
+        RESULTS_VERSION,
+        sha1(content.encode("utf-8")).hexdigest(),
+    )
+
+def piece_results(piece):
+    # what is shown of a checked Piece (see check_piece.html) - plain data,
+    # which doesn't depend on how a Piece is stored
+    return {
+        "title": piece.title,
+        "key_hr": piece.key_hr,
+        "modulations_hr": piece.modulations_hr,
+        "score_hr": piece.score_hr,
+        "err_count": piece.err_count,
+        "war_count": piece.war_count,
+        "err_detailed": piece.err_detailed,
+        "war_detailed": piece.war_detailed,
+    }
+
+def cached_check_harmony_rules(music_piece, rules=['ALL']):
+    # results (see piece_results) of check_harmony_rules, cached if the same
+    # parts have been already checked using the same rules (or, for all the
+    # rules, if the piece has just been edited - see keep_checked_piece)
+    cache = caches[CACHE_ALIAS]
+    key = result_key(music_piece, rules)
+    results = cache.get(key)
+    if results is None:
+        _count("misses")
+        if rules == ['ALL']:
+            piece = take_checked_piece(music_piece)
+            results = piece_results(piece)
+            keep_checked_piece(music_piece, piece)
+        else:
+            results = piece_results(check_harmony_rules(music_piece, rules))
+        cache.set(key, results)
+    else:
+        _count("hits")
+    # identical pieces may differ in title
+    results["title"] = music_piece.title
+    return results
+
+def take_checked_piece(music_piece):
+    # the music_piece checked with all the rules - the Piece kept after its
+    # last edit (see keep_checked_piece), or checked again. It's taken out of
+    # the process, so that only a single thread patches it
+    key = result_key(music_piece, ['ALL'])
+    with _live_pieces_lock:
+        piece = _live_pieces.pop(key, None)
+    if piece is None:
+        piece = check_harmony_rules(music_piece)
+    return piece
+
+def keep_checked_piece(music_piece, piece):
+    # keeps a Piece (the music_piece checked with all the rules) for the next
+    # edit, the least recently edited ones are dropped
+    key = result_key(music_piece, ['ALL'])
+    with _live_pieces_lock:
+        _live_pieces[key] = piece
+        _live_pieces.move_to_end(key)
+        while len(_live_pieces) > LIVE_PIECES:
+            _live_pieces.popitem(last=False)
@@ -1,29 +1,725 @@
 # Stores classes & functions needed to check harmony of a piece
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from hashlib import sha1
+from itertools import compress, zip_longest
+from operator import and_, attrgetter, ne, sub
+from threading import Lock
+from time import perf_counter
+
+from django.conf import settings
 from pyknon.music import Note, NoteSeq
 
 from CheckMyChords.models import MusicPiece
+from CheckMyChords.notation import (
+    NOTE_NAMES,
+    iter_notes,
+    midi_to_hrstr,
+    midi_to_str,
+    parse_notes,
+)
 from CheckMyChords.pyknon_extension import *
+from CheckMyChords.rule_stats import record_rule_time, rule_stats
+
+
+# versions of the logic - should be increased whenever results of the chord
+# and key analysis (ANALYSIS_VERSION) or of a rule (version in harmony_rule)
+# change (invalidates stored and cached results)
+ANALYSIS_VERSION = 2
+
+VOICES = ("S", "A", "T", "B")
+# chord modes and chord structure (intervals from the root) are stored in
+# a Piece as small integers - indexes of the touples below (0 == None ==
+# 'not recognised')
+MODES = (None, "M", "m", "M7", "m7")
+INTERVALS = (None, "1", "3>", "3", "5", "7")
+# distance from the root (in semitones) -> index in INTERVALS
+_INTERVAL_CODES = {0: 1, 3: 2, 4: 3, 7: 4, 10: 5}
+# duration and volume pyknon gives to the notes parsed from a string (used
+# when Note objects are recreated from midi numbers)
+_NOTE_DUR = 0.25
+_NOTE_VOLUME = 120
+# width of a chord in the printed score (see Piece.score_hr), human-readable
+# notes and notes in CMC notation (see Piece.parts_str) by midi number
+SCORE_COLUMN = 4
+_HR_NOTES = tuple(midi_to_hrstr(midi) for midi in range(128))
+_NOTE_STRS = tuple(midi_to_str(midi) for midi in range(128))
+
+# Tables used by the rules (in pairs of voices, voices are given as indexes
+# of VOICES)
+VOICE_RANGES = {
+    "S" : (58, 81),
+    "A" : (53, 74),
+    "T" : (46, 69),
+    "B" : (40, 62)
+}
+# restricted leaps (distance in semitones -> interval), leaps over an octave
+# are restricted as well ("over_octave")
+LEAPS = {10: "7", 11: "7<"}
+# (upper voice, lower voice, max distance, max recommended distance)
+VOICE_DISTANCES = (
+    (0, 1, 12, 12),  # S/A
+    (1, 2, 11, 11),  # A/T
+    (2, 3, 24, 19),  # T/B
+)
+# (upper voice, lower voice, distances treated as a perfect fifth)
+# The distances extended above allowed by check_distance (by a reasonable
+# amount to identify both errors if occur simultaneously). Written as
+# exact distances to not falsly trigger it when voices move in consecutive
+# forths, A above S - REVISE IT!
+PARALELS = (
+    (0, 1, frozenset((7, 19, 31))),  # S/A
+    (0, 2, frozenset((7, 19, 31, 43))),  # S/T
+    (0, 3, frozenset((7, 19, 31, 43))),  # S/B
+    (1, 2, frozenset((7, 19, 31))),  # A/T
+    (1, 3, frozenset((7, 19, 31, 43))),  # A/B
+    (2, 3, frozenset((7, 19, 31))),  # T/B
+)
+
+ERROR = "error"
+WARNING = "warning"
+# All the rules that can be checked (by code, in order of checking). A rule
+# is a method of Piece, registered with the harmony_rule decorator.
+# severity - the most severe kind of mistakes the rule reports
+Rule = namedtuple("Rule", "code label severity version check")
+RULE_REGISTRY = OrderedDict()
+
+
+class Violation(namedtuple("Violation", "rule severity beat voices detail")):
+    # A single mistake found by a rule. beat - index of the chord (from 0, for
+    # mistakes between two chords - of the first one), voices - e.g. "S" or
+    # "S/A" (or "" if the mistake concerns the whole chord), detail - kind of
+    # mistake (a key of _MESSAGES). Text is made only when it's needed
+    __slots__ = ()
+
+    @property
+    def message(self):
+        return violation_message(self)
+
+
+# messages of the mistakes - by (rule, detail)
+_MESSAGES = {
+    ("RANGE", "high"): "Chord {beat}: {voices} too high",
+    ("RANGE", "low"): "Chord {beat}: {voices} too low",
+    ("LEAPS", "7"): "Chords {beat}/{next}: Restricted leap in {voices} - 7",
+    ("LEAPS", "7<"): "Chords {beat}/{next}: Restricted leap in {voices} - 7<",
+    ("LEAPS", "over_octave"):
+        "Chords {beat}/{next}: Restricted leap in {voices} - over an octave",
+    ("DISTANCES", "wide"): "Chord {beat}: {voices} interval to wide",
+    ("DISTANCES", "overlap"): "Chord {beat}: {voices} overlap",
+    ("PARALELS", "octaves"):
+        "Chords {beat}/{next}: {voices} consecutive Unison/Octave",
+    ("PARALELS", "fifths"): "Chords {beat}/{next}: {voices} consecutive Fifths",
+    ("CHORDS", "unknown"): "Chord {beat}: Chord mode unknown",
+    ("CHORDS", "foreign"):
+        "Chord {beat}: {voices} note doesn't belong to the chord",
+    ("CHORDS", "thirds"): "Chord {beat}: more than one third in the chord",
+    ("CHORDS", "fifths"): "Chord {beat}: more than one fifth in the chord",
+    ("CHORDS", "sevenths"): "Chord {beat}: more than one seventh in the chord",
+    ("CHORDS_IN_CTX", "progression"):
+        "Chords {beat}/{next}: Forbidden progression {arg}",
+    ("CHORDS_IN_CTX", "seventh"):
+        "Chords {beat}/{next}: Seventh in {voices} not resolved",
+    ("CHORDS_IN_CTX", "seventh_at_end"):
+        "Chord {beat}: Seventh in {voices} not resolved (end of the piece)",
+    ("CHORDS_IN_CTX", "leading_tone"):
+        "Chords {beat}/{next}: Leading tone in {voices} not resolved",
+    ("CHORDS_IN_CTX", "doubled_leading_tone"):
+        "Chord {beat}: Leading tone doubled",
+}
+# titles of the groups of mistakes (in err_detailed and war_detailed) - by
+# (rule, severity)
+_TITLES = {
+    ("RANGE", ERROR): "Voice range errors",
+    ("LEAPS", ERROR): "Restricted leaps",
+    ("DISTANCES", ERROR): "Voice distance errors",
+    ("DISTANCES", WARNING): "Voice distance warnings",
+    ("PARALELS", ERROR): "Consecutive intervals",
+    ("CHORDS", ERROR): "Unnown chords",
+    ("CHORDS", WARNING): "Foreign notes in chords and wrong doubling",
+    ("CHORDS_IN_CTX", ERROR): "Wrong chord progressions",
+    ("CHORDS_IN_CTX", WARNING): "Chord progression warnings",
+}
+
+
+def _note(midi_number):
+    # recreates a pyknon Note from its midi number
+    return Note(midi_number % 12, midi_number // 12, _NOTE_DUR, _NOTE_VOLUME)
+
+def note_seq(midi_numbers):
+    # a pyknon NoteSeq of the notes (as if parsed from a string)
+    return NoteSeq([_note(midi) for midi in midi_numbers])
+
+def _diff(part):
+    # differences between consecutive notes of a part
+    return map(sub, part[1:], part)
+
+def _find_root(s, a, t, b):
+    # deducts the root of a chord (int 0-11) from midi numbers of its notes
+    # TODO: Rewrite it to use values instead of midi_numbers
+    #     (will possibly simplify conditions)
+    # finding root
+    #   ifs' condtions ordered by decreasing "importance"
+    #     I. looking for a fifth (including crossed voices)
+    if (t-b) in (7, 19, 31) \
+            or (a-b) in (7, 19, 31, 43) \
+            or (s-b) in (7, 19, 31, 43):
+        return b % 12
+    elif (b-t) in (7,) \
+            or (a-t) in (7, 19, 31) \
+            or (s-t) in (7, 19, 31, 43):
+        return t % 12
+    elif (b-a) in (7,) \
+            or (t-a) in (7, 19) \
+            or (s-a) in (7, 19, 31):
+        return a % 12
+    elif (b-s) in (7,) or (t-s) in (7,) or (a-s) in (7,):
+        return s % 12
+    #    II. looking for a fourth (tonic only above fifth)
+    elif (b-t) in (5,) or (b-a) in (5,) or (b-s) in (5,):
+        return b % 12
+    elif (t-b) in (5, 17, 29, 41) \
+            or (t-a) in (5, 17) \
+            or (t-s) in (5,):
+        return t % 12
+    elif (a-b) in (5, 17, 29, 41) \
+            or (a-t) in (5, 17, 29, 41) \
+            or (a-s) in (5,):
+        return a % 12
+    elif (s-b) in (5, 17, 29, 41, 53) \
+            or (s-t) in (5, 17, 29, 41) \
+            or (s-a) in (5, 17, 29, 41):
+        return s % 12
+    #    III. the fifth is missing, looking for a doubled interval
+    #        (1113 chord or similar)
+    elif (b%12 == t%12) or (b%12 == a%12) or (b%12 == s%12):
+        return b % 12
+    elif (t%12 == a%12) or (t%12 == s%12):
+        return t % 12
+    elif (a%12 == s%12):
+        return a % 12
+    #    IV. no note is dubled (and 5th missing), assuming bass
+    #        note is the root (to modify, should D9(>) be included)
+    else:
+        return b % 12
+
+def _find_structure(root, notes):
+    # deducts chord structure (as INTERVALS indexes, one per voice) from
+    # the root and midi numbers of the notes. 0 is left for unrecognised
+    # notes, minor/major thirds are distinguished
+    return tuple(_INTERVAL_CODES.get((note - root) % 12, 0) for note in notes)
+
+def _find_mode(structure):
+    # determines chord mode (as MODES index) from the chord structure
+    if 2 in structure and 3 in structure:
+        # both minor and major thirds in a chord at the same time
+        return 0
+    elif 2 in structure:
+        return 4 if 5 in structure else 2  # "m7" or "m"
+    elif 3 in structure:
+        return 3 if 5 in structure else 1  # "M7" or "M"
+    else:  # no third in a chord (or find_structure failed)
+        return 0
+
+def _analyse_chord(s, a, t, b):
+    # root, mode and structure of a chord, worked out using the functions
+    # above (used to build the chord table)
+    notes = (s, a, t, b)
+    root = _find_root(*notes)
+    structure = _find_structure(root, notes)
+    return root, _find_mode(structure), structure
+
+# The chord table - the result of _analyse_chord depends only on intervals
+# between the notes (it's invariant under transposition), so it's computed
+# once for every voicing with the bass at 0 and indexed by the distances of
+# T, A and S above the bass. The table covers all chords that can be written
+# in VOICE_RANGES (the bass pitch class is added back to the root)
+def _bounds_above_bass(voice):
+    low, high = VOICE_RANGES[voice]
+    return low - VOICE_RANGES["B"][1], high - VOICE_RANGES["B"][0]
+
+_TABLE_T = _bounds_above_bass("T")
+_TABLE_A = _bounds_above_bass("A")
+_TABLE_S = _bounds_above_bass("S")
+_TABLE_A_SIZE = _TABLE_A[1] - _TABLE_A[0] + 1
+_TABLE_S_SIZE = _TABLE_S[1] - _TABLE_S[0] + 1
+_chord_table = []  # built on first use
+
+def _build_chord_table():
+    # equal entries are shared (there are just a few hundred of them)
+    entries = {}
+    table = []
+    for t in range(_TABLE_T[0], _TABLE_T[1] + 1):
+        for a in range(_TABLE_A[0], _TABLE_A[1] + 1):
+            for s in range(_TABLE_S[0], _TABLE_S[1] + 1):
+                entry = _analyse_chord(s, a, t, 0)
+                table.append(entries.setdefault(entry, entry))
+    _chord_table[:] = table
+    return _chord_table
+
+def _read_chord(s, a, t, b):
+    # root (int 0-11), mode (MODES index) and structure (INTERVALS indexes)
+    # of a chord in a single lookup in the chord table (chords outside of
+    # the table are analysed directly)
+    t -= b
+    a -= b
+    s -= b
+    if _TABLE_T[0] <= t <= _TABLE_T[1] \
+            and _TABLE_A[0] <= a <= _TABLE_A[1] \
+            and _TABLE_S[0] <= s <= _TABLE_S[1]:
+        table = _chord_table or _build_chord_table()
+        root, mode, structure = table[
+            ((t - _TABLE_T[0]) * _TABLE_A_SIZE + a - _TABLE_A[0])
+            * _TABLE_S_SIZE + s - _TABLE_S[0]
+        ]
+    else:
+        root, mode, structure = _analyse_chord(s, a, t, 0)
+    return (root + b) % 12, mode, structure
+
+def _read_chord_columns(rows):
+    # rows - midi numbers of the parts (S, A, T, B), returns arrays of roots
+    # and modes and 4 rows of structures of the chords
+    roots = array('b')
+    modes = array('b')
+    structures = [array('b') for row in rows]
+    for chord in zip(*rows):
+        root, mode, structure = _read_chord(*chord)
+        roots.append(root)
+        modes.append(mode)
+        for row, interval in zip(structures, structure):
+            row.append(interval)
+    return roots, modes, structures
+
+def _harmonic_function(root, mode, key):
+    # see Chord.harmonic_function
+    if root == key[0]:
+        if key[1] == 1 and mode == "M":  # major
+            return "T"
+        elif key[1] == 0 and mode =='m': # minor
+            return "T"
+        else:
+            return ""  # unrecognised chord or seventh present
+    elif (root - key[0]) % 12 == 5:
+        if mode in ("M", "m"):
+            return "S"
+        else:
+            return ""
+    elif (root - key[0]) % 12 == 7:
+        if key[1] == 1 and mode == "M":
+            return "D"
+        elif key[1] == 1 and mode == "M7":
+            return "D7"
+        elif key[1] == 0 and mode in ("M", "m"):
+            return "D"
+        elif key[1] == 0 and mode in ("M7", "m7"):
+            return "D7"
+        else:
+            return ""
+    elif (root - key[0]) % 12 == 8:  #6th in minor scale
+        if mode == "M":
+            return "TVI"
+        else:
+            return ""
+    elif (root - key[0]) % 12 == 9:  #6th in major key
+        if mode == "m":
+            return "TVI"
+        else:
+            return ""
+    else:
+        return ""
+
+# harmonic functions of chords in a Piece are stored as indexes of FUNCTIONS,
+# looked up in _FUNCTION_TABLE[key mode][root - tonic][mode of the chord]
+FUNCTIONS = ("", "T", "S", "D", "D7", "TVI")
+_FUNCTION_TABLE = tuple(
+    tuple(
+        bytes(FUNCTIONS.index(_harmonic_function(distance, chord_mode,
+                                                 (0, key_mode)))
+              for chord_mode in MODES)
+        for distance in range(12)
+    )
+    for key_mode in (0, 1)
+)
+
+# Keys are found for every chord (modulations are recognised). KEYS - all
+# the keys as (tonic, 1 == major or 0 == minor), key track of a piece holds
+# indexes of KEYS. A chord scores _FUNCTION_SCORES[its function] points in
+# a key (unrecognised chords score 0 in every key), changing the key costs
+# MODULATION_PENALTY points - the track with the highest total is chosen
+# (see find_key_track)
+KEYS = tuple((tonic, mode) for tonic in range(12) for mode in (1, 0))
+_FUNCTION_SCORES = {"": -1, "T": 2, "S": 1, "D": 1, "D7": 2, "TVI": 1}
+MODULATION_PENALTY = 3
+# scores of a chord in each key - by root * len(MODES) + mode
+_KEY_SCORES = tuple(
+    tuple(_FUNCTION_SCORES[FUNCTIONS[
+              _FUNCTION_TABLE[key_mode][(root - tonic) % 12][chord_mode]]]
+          if chord_mode else 0
+          for tonic, key_mode in KEYS)
+    for root in range(12) for chord_mode in range(len(MODES))
+)
+# keys in order of decreasing scores of a chord - by root * len(MODES) + mode
+_KEYS_BY_SCORE = tuple(
+    tuple(sorted(range(len(KEYS)), key=lambda key: -scores[key]))
+    for scores in _KEY_SCORES
+)
+# the tables of find_key_track are replaced with new ones when they grow
+# beyond these sizes (pieces keep the tables their states belong to)
+_MAX_KEY_STATES = 20000
+_MAX_KEY_TRANSITIONS = 100000
+
+
+class _KeyTables(object):
+    # states and transitions of find_key_track, shared by the pieces. A state
+    # (alive keys with their scores) is known by its id - index in states
+    def __init__(self):
+        self.states = []
+        self.state_ids = {}
+        self.transitions = {}  # state id * len(_KEY_SCORES) + chord ->
+                               # (next state id, best key, alive keys)
+        self._lock = Lock()
+
+    def state(self, alive):
+        # id of a set of alive keys with their scores
+        state = tuple(sorted(alive.items()))
+        state_id = self.state_ids.get(state)
+        if state_id is None:
+            with self._lock:
+                state_id = self.state_ids.get(state)
+                if state_id is None:
+                    state_id = len(self.states)
+                    self.states.append(state)
+                    self.state_ids[state] = state_id
+        return state_id
+
+    def transition(self, state_id, chord):
+        # (next state id, best key, alive keys as bits) after a chord (index
+        # of _KEY_SCORES) - the scores of a state are relative to the best one
+        chord_scores = _KEY_SCORES[chord]
+        switch = -MODULATION_PENALTY  # modulation from the best key
+        scores = {key: chord_scores[key] + score
+                  for key, score in self.states[state_id]}
+        # other keys are checked in order of decreasing scores, only until
+        # they fall below threshold
+        order = _KEYS_BY_SCORE[chord]
+        modulation = next(key for key in order if key not in scores)
+        best = max(max(scores.values()), chord_scores[modulation] + switch)
+        threshold = best - MODULATION_PENALTY
+        alive = {key: score for key, score in scores.items()
+                 if score > threshold}
+        for key in order:
+            if key in scores:
+                continue
+            score = chord_scores[key] + switch
+            if score <= threshold:
+                break
+            alive[key] = score
+        best_key = min(key for key, score in alive.items() if score == best)
+        alive_keys = sum(1 << key for key in alive)
+        alive = {key: score - best for key, score in alive.items()}
+        transition = (self.state(alive), best_key, alive_keys)
+        self.transitions[state_id * len(_KEY_SCORES) + chord] = transition
+        return transition
+
+    def step(self, state, root, mode):
+        # (next state, best key, alive keys) after a chord
+        chord = root * len(MODES) + mode if root >= 0 else 0
+        transition = self.transitions.get(state * len(_KEY_SCORES) + chord)
+        if transition is None:
+            transition = self.transition(state, chord)
+        return transition
+
+_key_tables = _KeyTables()
+
+def _current_key_tables():
+    # the shared tables - new ones if the current ones are too big
+    global _key_tables
+    tables = _key_tables
+    if len(tables.states) > _MAX_KEY_STATES \
+            or len(tables.transitions) > _MAX_KEY_TRANSITIONS:
+        tables = _key_tables = _KeyTables()
+    return tables
+
+def _key_viterbi(roots, modes, first_key, tables):
+    # forward pass of find_key_track - (states, best keys, alive keys) after
+    # each chord, states are ids in tables
+    n_modes = len(MODES)
+    n_chords = len(_KEY_SCORES)
+    transitions = tables.transitions
+    state = tables.state({KEYS.index(tuple(first_key)): 0})
+    states = array('l')
+    alive_keys = array('l')  # alive keys after each chord (as bits)
+    best_keys = array('b')  # key with the best score after each chord
+    for root, mode in zip(roots, modes):
+        chord = root * n_modes + mode if root >= 0 else 0
+        transition = transitions.get(state * n_chords + chord)
+        if transition is None:
+            transition = tables.transition(state, chord)
+        state, best_key, alive = transition
+        states.append(state)
+        best_keys.append(best_key)
+        alive_keys.append(alive)
+    return states, best_keys, alive_keys
+
+def _read_key_track(best_keys, alive_keys):
+    # backward pass of find_key_track
+    n = len(best_keys)
+    if not n:
+        return array('b')
+    track = array('b', bytes(n))
+    key = best_keys[-1]
+    for i in range(n - 1, 0, -1):
+        track[i] = key
+        if not alive_keys[i-1] >> key & 1:
+            key = best_keys[i-1]  # modulation to the key at chord i
+    track[0] = key
+    return track
+
+def find_key_track(roots, modes, first_key):
+    # key (index of KEYS) of every chord - Viterbi algorithm: for every chord
+    # and key the best score of the chords so far ending in the key is found,
+    # the best track is then read backwards. first_key (the key of the first
+    # chord, see _key_of_chord) is preferred at the beginning, if tracks score
+    # the same, modulations are placed as late as possible.
+    # Only keys scoring more than (best score - MODULATION_PENALTY) are kept
+    # ("alive") - a track in any other key can't beat modulating from the
+    # best key. States (alive keys with scores relative to the best one)
+    # repeat a lot, so transitions between them are computed once and
+    # remembered (see _KeyTables)
+    states, best_keys, alive_keys = _key_viterbi(roots, modes, first_key,
+                                                 _current_key_tables())
+    return _read_key_track(best_keys, alive_keys)
+
+# Chords in context are checked by an automaton - for every chord
+# CONTEXT_TABLE[its function][function of the next chord] gives the checks
+# to run (functions, with their severity). Functions of chords are indexes of
+# FUNCTIONS, the next function of the last chord is END. The table is
+# compiled from a list of rules: (function, next function, name of the check
+# - see CONTEXT_CHECKS, severity), "*" matches any function (also END). The
+# rules can be set in settings.CONTEXT_RULES
+END = len(FUNCTIONS)
+DEFAULT_CONTEXT_RULES = (
+    ("D", "S", "forbidden", ERROR),
+    ("D7", "S", "forbidden", ERROR),
+    ("D7", "*", "resolve_seventh", ERROR),
+    ("D", "T", "resolve_leading_tone", WARNING),
+    ("D7", "T", "resolve_leading_tone", WARNING),
+    ("D", "*", "doubled_leading_tone", ERROR),
+    ("D7", "*", "doubled_leading_tone", ERROR),
+)
+
+# Checks of chords in context (see CONTEXT_TABLE), return lists of
+# Violations
+def _context_forbidden(piece, beat, severity, code, next_code):
+    return [Violation("CHORDS_IN_CTX", severity, beat, "",
+                      "progression:{}-{}".format(FUNCTIONS[code],
+                                                 FUNCTIONS[next_code]))]
+
+def _context_resolve_seventh(piece, beat, severity, code, next_code):
+    # the seventh should go down by a step
+    violations = []
+    n = piece._length
+    for row, voice in enumerate(VOICES):
+        if piece._structures[row * n + beat] != 5:
+            continue
+        if next_code == END:
+            violations.append(Violation("CHORDS_IN_CTX", severity, beat,
+                                        voice, "seventh_at_end"))
+            continue
+        move = piece._notes[row * n + beat + 1] - piece._notes[row * n + beat]
+        if move not in (-1, -2):
+            violations.append(Violation("CHORDS_IN_CTX", severity, beat,
+                                        voice, "seventh"))
+    return violations
+
+def _context_resolve_leading_tone(piece, beat, severity, code, next_code):
+    # the leading tone (major third of the dominant) in an outer voice
+    # should go up by a semitone (inner voices may leave it)
+    violations = []
+    n = piece._length
+    for row in (0, 3):
+        if piece._structures[row * n + beat] != 3 or next_code == END:
+            continue
+        move = piece._notes[row * n + beat + 1] - piece._notes[row * n + beat]
+        if move != 1:
+            violations.append(Violation("CHORDS_IN_CTX", severity, beat,
+                                        VOICES[row], "leading_tone"))
+    return violations
+
+def _context_doubled_leading_tone(piece, beat, severity, code, next_code):
+    n = piece._length
+    thirds = sum(1 for row in range(4)
+                 if piece._structures[row * n + beat] == 3)
+    if thirds > 1:
+        return [Violation("CHORDS_IN_CTX", severity, beat, "",
+                          "doubled_leading_tone")]
+    return []
+
+CONTEXT_CHECKS = {
+    "forbidden": _context_forbidden,
+    "resolve_seventh": _context_resolve_seventh,
+    "resolve_leading_tone": _context_resolve_leading_tone,
+    "doubled_leading_tone": _context_doubled_leading_tone,
+}
+
+def compile_context_rules(rules):
+    # turns a list of rules into a table (see CONTEXT_TABLE)
+    labels = FUNCTIONS + ("END",)
+    table = [[[] for next_label in labels] for label in FUNCTIONS]
+    for function, next_function, check, severity in rules:
+        if function not in FUNCTIONS + ("*",) \
+                or next_function not in labels + ("*",) \
+                or check not in CONTEXT_CHECKS \
+                or severity not in (ERROR, WARNING):
+            raise ValueError("Invalid context rule: {}".format(
+                (function, next_function, check, severity)))
+        rows = range(len(FUNCTIONS)) if function == "*" \
+            else (FUNCTIONS.index(function),)
+        columns = range(len(labels)) if next_function == "*" \
+            else (labels.index(next_function),)
+        for row in rows:
+            for column in columns:
+                entry = (CONTEXT_CHECKS[check], severity)
+                if entry not in table[row][column]:
+                    table[row][column].append(entry)
+    return tuple(tuple(tuple(checks) for checks in row) for row in table)
+
+def context_table_hash(table):
+    # identifies the checks of a table - part of the version of CHORDS_IN_CTX,
+    # so that results of another table (settings.CONTEXT_RULES) aren't reused
+    content = repr([[[(check.__name__, severity) for check, severity in checks]
+                     for checks in row] for row in table])
+    return sha1(content.encode("utf-8")).hexdigest()[:8]
+
+CONTEXT_TABLE = compile_context_rules(
+    getattr(settings, 'CONTEXT_RULES', DEFAULT_CONTEXT_RULES))
+
+def harmony_rule(code, label, severity, version=1):
+    # registers a Piece method checking a rule
+    def register(check):
+        if code in RULE_REGISTRY:
+            raise ValueError("Rule {} already registered".format(code))
+        RULE_REGISTRY[code] = Rule(code, label, severity, version, check)
+        return check
+    return register
+
+def _key_of_chord(root, mode):
+    # key set basing on a chord - (tonic (int 0-11), 1 == major or 0 ==
+    # minor), C major if failed to read the chord
+    tonic = root if root is not None and root >= 0 else 0
+    if MODES[mode] in ("m", "m7"):
+        return (tonic, 0)
+    else:
+        return (tonic, 1)  # major (also as a fallback value)
+
+def key_to_str(key):
+    # human-readable version of key
+    if None in key:
+        return "Unknown key"
+    return "{} {}".format(NOTE_NAMES[key[0]], ("minor", "major")[key[1]])
+
+def violation_message(violation):
+    # details may have an argument (e.g. "progression:D-S")
+    detail, _, arg = violation.detail.partition(":")
+    return _MESSAGES[violation.rule, detail].format(
+        beat=violation.beat + 1,
+        next=violation.beat + 2,
+        voices=violation.voices,
+        arg=arg,
+    )
+
+def _pair_name(upper, lower):
+    return "{}/{}".format(VOICES[upper], VOICES[lower])
+
+# Functions below find a single mistake (used both by Piece and iter_harmony)
+
+def _range_mistake(voice, midi_number):
+    low, high = VOICE_RANGES[voice]
+    if midi_number > high:
+        return "high"
+    elif midi_number < low:
+        return "low"
+
+def _leap_mistake(distance):
+    # distance - absolute, in semitones
+    if distance in LEAPS:
+        return LEAPS[distance]
+    elif distance > 12:
+        return "over_octave"
+
+def _distance_mistake(pair, distance):
+    # pair - index in VOICE_DISTANCES, returns (severity, detail) or None
+    upper, lower, max_dist, max_rec = VOICE_DISTANCES[pair]
+    if distance > max_dist:
+        return ERROR, "wide"
+    elif distance > max_rec:
+        return WARNING, "wide"
+    elif distance < 0:
+        return ERROR, "overlap"
+
+def _paralel_mistake(pair, interval, next_interval):
+    # pair - index in PARALELS (both voices of the pair should move)
+    fifths = PARALELS[pair][2]
+    if interval % 12 == 0 and next_interval % 12 == 0:
+        return "octaves"
+    elif interval in fifths and next_interval in fifths:
+        return "fifths"
+
+def _chord_violations(beat, mode, structure, function):
+    # checking a chord (unrecognisable, or wrong dubling) - mode and
+    # structure as MODES and INTERVALS indexes
+    # if chord is unrecognisable, other conditions aren't checked
+    # e.g - chord c,d,e,g, will get warning (d doesn't belong to C chord)
+    # but c,d,g,c will not get warning, but will get an error -
+    # chord mode unknown)
+    if mode == 0:
+        return [Violation("CHORDS", ERROR, beat, "", "unknown")]
+    violations = []
+    roots = 0
+    thirds = 0
+    fifths = 0
+    sevenths = 0
+    for voice, interval in zip(VOICES, structure):
+        if interval == 1:
+            roots += 1
+        elif interval == 2 or interval == 3:
+            thirds += 1
+        elif interval == 4:
+            fifths += 1
+        elif interval == 5:
+            sevenths += 1
+        else:
+            violations.append(
+                Violation("CHORDS", WARNING, beat, voice, "foreign"))
+    if thirds > 1 and (not function == "TVI"):
+        violations.append(Violation("CHORDS", WARNING, beat, "", "thirds"))
+    elif fifths >1:
+        violations.append(Violation("CHORDS", WARNING, beat, "", "fifths"))
+    elif sevenths > 1:
+        violations.append(Violation("CHORDS", ERROR, beat, "", "sevenths"))
+    return violations
 
 
 class Chord(object):
     # a class storing a chord (as Note objects) and additional info about it
     # (as well as methods for getting that info)
-    
+
     def __init__(self, soprano, alto, tenor, bass):  # TODO: pass more arguments (key)
         if (not isinstance(soprano, Note)) or \
            (not isinstance(alto, Note)) or \
            (not isinstance(tenor, Note)) or \
            (not isinstance(bass, Note)):
             raise TypeError(
-                'A Chord object should be built using Note objects' 
+                'A Chord object should be built using Note objects'
                 + ' as arguments.')
         # TODO: add an iterator (over parts) and delete self.parts
         self.soprano = soprano
         self.alto = alto
         self.tenor = tenor
         self.bass = bass
-        self.parts = {"S": self.soprano, 
-                      "A": self.alto, 
+        self.parts = {"S": self.soprano,
+                      "A": self.alto,
                       "T": self.tenor,
                       "B": self.bass}
         self.root = None  # int 0-11 or None
@@ -31,106 +727,31 @@ class Chord(object):
         self.structure = {"S": None,  # as intervals from the root
                           "A": None,  # in "standard" notation (e.g. 5==fifth)
                           "T": None,  # None == 'not recognised'
-                          "B": None} 
+                          "B": None}
         self._read_chord()
-    
+
     def __str__(self):
         return "S:{s}, A:{a}, T:{t}, B:{b}".format(
             s = self.soprano.to_str,
             a = self.alto.to_str,
             t = self.tenor.to_str,
             b = self.bass.to_str)
-    
+
+    @property
+    def midi_numbers(self):
+        return (self.soprano.midi_number,
+                self.alto.midi_number,
+                self.tenor.midi_number,
+                self.bass.midi_number)
+
     def _read_chord(self):
-        # determines chord detailed info
-        self._find_root()
-        self._find_structure()
-        self._find_mode()
-    
-    def _find_root(self):
-        # method deducting chord details from the notes given
-        # TODO: Rewrite it to use values instead of midi_numbers 
-        #     (will possibly simplify conditions)
-        b = self.bass.midi_number
-        t = self.tenor.midi_number
-        a = self.alto.midi_number
-        s = self.soprano.midi_number
-        # finding root
-        #   ifs' condtions ordered by decreasing "importance"
-        #     I. looking for a fifth (including crossed voices)
-        if (t-b) in (7, 19, 31) \
-                or (a-b) in (7, 19, 31, 43) \
-                or (s-b) in (7, 19, 31, 43):
-            self.root = self.bass.value
-        elif (b-t) in (7,) \
-                or (a-t) in (7, 19, 31) \
-                or (s-t) in (7, 19, 31, 43):
-            self.root = self.tenor.value
-        elif (b-a) in (7,) \
-                or (t-a) in (7, 19) \
-                or (s-a) in (7, 19, 31):
-            self.root = self.alto.value
-        elif (b-s) in (7,) or (t-s) in (7,) or (a-s) in (7,):
-            self.root = self.soprano.value
-        #    II. looking for a fourth (tonic only above fifth)
-        elif (b-t) in (5,) or (b-a) in (5,) or (b-s) in (5,):
-            self.root = self.bass.value
-        elif (t-b) in (5, 17, 29, 41) \
-                or (t-a) in (5, 17) \
-                or (t-s) in (5,):
-            self.root = self.tenor.value
-        elif (a-b) in (5, 17, 29, 41) \
-                or (a-t) in (5, 17, 29, 41) \
-                or (a-s) in (5,):
-            self.root = self.alto.value
-        elif (s-b) in (5, 17, 29, 41, 53) \
-                or (s-t) in (5, 17, 29, 41) \
-                or (s-a) in (5, 17, 29, 41):
-            self.root = self.soprano.value
-        #    III. the fifth is missing, looking for a doubled interval
-        #        (1113 chord or similar)
-        elif (b%12 == t%12) or (b%12 == a%12) or (b%12 == s%12):
-            self.root = self.bass.value
-        elif (t%12 == a%12) or (t%12 == s%12):
-            self.root = self.tenor.value
-        elif (a%12 == s%12):
-            self.root = self.alto.value     
-        #    IV. no note is dubled (and 5th missing), assuming bass 
-        #        note is the root (to modify, should D9(>) be included)
-        else:
-            self.root = self.bass.value
-    
-    def _find_structure(self):
-        # method deducting chord structure from notes given (needs root)
-        # should leave initial (None) for unrecognised notes
-        # minor/major thirds are distinguished
-        if self.root == None:
-            return
-        intervals = {
-            "0": "1",  # root
-            "3": "3>",  # minor third
-            "4": "3",  # major third
-            "7": "5",  # fith
-            "10": "7",  # minor seventh
-        }
-        for voice, note in self.parts.items():
-            dist_from_root = str((note.midi_number - self.root) % 12)
-            if dist_from_root in intervals:
-                self.structure[voice] = intervals[dist_from_root]
-    
-    def _find_mode(self):
-        # method determining chord mode (M, m, M7 or m7) from the chord
-        # structure
-        if "3>" in self.structure.values() and "3" in self.structure.values():
-            # both minor and major thirds in a chord at the same time
-            self.mode = None
-        elif "3>" in self.structure.values():
-            self.mode = "m7" if "7" in self.structure.values() else "m"
-        elif "3" in self.structure.values():
-            self.mode = "M7" if "7" in self.structure.values() else "M"
-        else:  # no third in a chord (or find_structure failed)
-            self.mode = None
-    
+        # determines chord detailed info (see _read_chord function)
+        root, mode, structure = _read_chord(*self.midi_numbers)
+        self.root = root
+        self.mode = MODES[mode]
+        for voice, interval in zip(VOICES, structure):
+            self.structure[voice] = INTERVALS[interval]
+
     def harmonic_function(self, key):
         # Tonic must be of correct mode
         # Tonic6 must be of oposite mode (a minor in C major key)
@@ -142,440 +763,837 @@ class Chord(object):
         # NOTE - this method will recognise function if foreign notes are
         # present (C E F# G) will be recognised as a Tonic in C major,
         # but (C E G Bb) won't
-        if self.root == key[0]:
-            if key[1] == 1 and self.mode == "M":  # major
-                return "T" 
-            elif key[1] == 0 and self.mode =='m': # minor
-                return "T"
-            else:
-                return ""  # unrecognised chord or seventh present
-        elif (self.root - key[0]) % 12 == 5:
-            if self.mode in ("M", "m"):
-                return "S"
-            else:
-                return ""
-        elif (self.root - key[0]) % 12 == 7:
-            if key[1] == 1 and self.mode == "M":
-                return "D"
-            elif key[1] == 1 and self.mode == "M7":
-                return "D7"
-            elif key[1] == 0 and self.mode in ("M", "m"): 
-                return "D"
-            elif key[1] == 0 and self.mode in ("M7", "m7"):
-                return "D7"
-            else:
-                return ""
-        elif (self.root - key[0]) % 12 == 8:  #6th in minor scale
-            if self.mode == "M":
-                return "TVI"
-            else:
-                return ""
-        elif (self.root - key[0]) % 12 == 9:  #6th in major key
-            if self.mode == "m":
-                return "TVI"
-            else:
-                return ""
-        else:
-            return ""
+        return _harmonic_function(self.root, self.mode, key)
+
+
+class PieceChord(Chord):
+    # A thin view of a single chord of a Piece - everything is read from the
+    # Piece's arrays, Note objects are created only when asked for
+
+    def __init__(self, piece, idx):
+        self._piece = piece
+        self._idx = idx
+
+    def _note(self, row):
+        return _note(self._piece._notes[row * len(self._piece) + self._idx])
+
+    @property
+    def soprano(self):
+        return self._note(0)
+
+    @property
+    def alto(self):
+        return self._note(1)
+
+    @property
+    def tenor(self):
+        return self._note(2)
+
+    @property
+    def bass(self):
+        return self._note(3)
+
+    @property
+    def parts(self):
+        return {voice: self._note(row) for row, voice in enumerate(VOICES)}
+
+    @property
+    def midi_numbers(self):
+        notes = self._piece._notes
+        n = len(self._piece)
+        return tuple(notes[row * n + self._idx] for row in range(4))
+
+    @property
+    def root(self):
+        root = self._piece._roots[self._idx]
+        return None if root < 0 else root
+
+    @property
+    def mode(self):
+        return MODES[self._piece._modes[self._idx]]
+
+    @property
+    def structure(self):
+        structure = self._piece._structures
+        n = len(self._piece)
+        return {voice: INTERVALS[structure[row * n + self._idx]]
+                for row, voice in enumerate(VOICES)}
+
+    def _read_chord(self):
+        # chord info is precomputed by the Piece
+        pass
 
 
 class Piece(object):
-    # A class analogous to MusicPiece, but stores parts as NoteSeqs objects
+    # A class analogous to MusicPiece, but stores parts as one compact array
+    # of midi numbers (4 rows - S, A, T, B - of len(self) notes each),
+    # together with precomputed root, mode and structure of every chord
     # also stores harmony rules functions and results of their "work"
-    # TODO: add an iterator (over parts) and delete self.parts
-    
+    # table of checks of chords in context (may be set for a single piece,
+    # see compile_context_rules)
+    context_table = CONTEXT_TABLE
+
     def __init__(self, piece):
         if not isinstance(piece, MusicPiece):
             raise TypeError(
-                'A Piece object should be built using MusicPiece object' 
+                'A Piece object should be built using MusicPiece object'
                 + ' as an argument.')
-        self.soprano = NoteSeq(piece.soprano)
-        self.alto = NoteSeq(piece.alto)
-        self.tenor = NoteSeq(piece.tenor)
-        self.bass = NoteSeq(piece.bass)
         self.title = piece.title
-        self.parts = {"S": self.soprano, 
-                      "A": self.alto, 
-                      "T": self.tenor,
-                      "B": self.bass}
-        self._key = [None, None]
-        self._chords = []
-        self._err_count = 0
-        self._war_count = 0
-        self._err_detailed = []
-        self._war_detailed = []
+        parts = [parse_notes(part) for part in (piece.soprano, piece.alto,
+                                                piece.tenor, piece.bass)]
+        if len(set(len(part) for part in parts)) != 1:
+            raise ValueError('All parts must have the same length.')
+        self._length = len(parts[0])
+        self._notes = array('h')
+        for part in parts:
+            self._notes.extend(part)
+        self._roots = array('b')  # -1 == None
+        self._modes = array('b')  # indexes of MODES
+        self._structures = array('b')  # indexes of INTERVALS (4 rows)
+        self._key = (None, None)
+        self._key_fixed = False  # key set by hand (see key.setter)
+        self._key_track = array('b')  # indexes of KEYS (for every chord)
+        # states of find_key_track after each chord and the tables they
+        # belong to (kept for patch)
+        self._key_states = (array('l'), array('b'), array('l'))
+        self._key_tables = None
+        self._function_codes = None  # indexes of FUNCTIONS (see _functions)
+        # {rule: [Violation, ...] (ordered by beat)} for each rule checked
+        self._rule_violations = OrderedDict()
+        self._rule_counts = None  # see rule_counts
+        self._summary = None  # see _summarize
+        self._complete = True  # False if checking stopped early
         self._read_chords()
         self._set_key()
-    
+
+    def __len__(self):
+        return self._length
+
+    def __getstate__(self):
+        # states of find_key_track are ids in tables of this process - they
+        # are found again when a pickled piece is patched
+        state = self.__dict__.copy()
+        state['_key_states'] = None
+        state['_key_tables'] = None
+        return state
+
+    def _row(self, voice_idx):
+        # midi numbers of a single part (0 == S, ..., 3 == B)
+        return self._notes[voice_idx * self._length:
+                           (voice_idx + 1) * self._length]
+
+    def _part(self, voice_idx):
+        return note_seq(self._row(voice_idx))
+
+    @property
+    def soprano(self):
+        return self._part(0)
+
+    @property
+    def alto(self):
+        return self._part(1)
+
+    @property
+    def tenor(self):
+        return self._part(2)
+
+    @property
+    def bass(self):
+        return self._part(3)
+
+    @property
+    def parts(self):
+        # parts as pyknon NoteSeqs (built on demand - e.g. for MIDI files)
+        return {voice: self._part(row) for row, voice in enumerate(VOICES)}
+
+    def _summarize(self):
+        # messages of the mistakes (see err_detailed) and the list of all of
+        # them, made from _rule_violations once after each check (or patch)
+        if self._summary is None:
+            summary = {ERROR: [], WARNING: [], "violations": []}
+            for rule in RULE_REGISTRY:
+                if rule not in self._rule_violations:
+                    continue
+                violations = self._rule_violations[rule]
+                summary["violations"].extend(violations)
+                for severity in (ERROR, WARNING):
+                    # in order of chords (and voices)
+                    messages = [violation_message(violation)
+                                for violation in violations
+                                if violation.severity == severity]
+                    if not messages:
+                        continue
+                    summary[severity].append(
+                        (_TITLES[rule, severity], len(messages), messages))
+            self._summary = summary
+        return self._summary
+
     @property
     def err_count(self):
-        return self._err_count
-    
+        return sum(counts[0] for counts in self.rule_counts.values())
+
     @property
     def war_count(self):
-        return self._war_count
-    
+        return sum(counts[1] for counts in self.rule_counts.values())
+
     @property
     def err_detailed(self):
-        return self._err_detailed
-    
+        return self._summarize()[ERROR]
+
     @property
     def war_detailed(self):
-        return self._war_detailed
-    
+        return self._summarize()[WARNING]
+
+    @property
+    def violations(self):
+        # all mistakes found (as Violation touples), rule by rule (in order of
+        # RULE_REGISTRY) and chord by chord
+        return self._summarize()["violations"]
+
+    def violations_in(self, start, stop):
+        # mistakes found in chords start..stop-1 (see violations)
+        result = []
+        for rule in RULE_REGISTRY:
+            violations = self._rule_violations.get(rule, ())
+            beats = [violation.beat for violation in violations]
+            result.extend(violations[bisect_left(beats, start):
+                                     bisect_left(beats, stop)])
+        return result
+
+    @property
+    def rule_counts(self):
+        # {rule: (err_count, war_count)} for each rule checked (counted
+        # without making the messages)
+        if self._rule_counts is None:
+            counts = {}
+            for rule in RULE_REGISTRY:
+                if rule in self._rule_violations:
+                    severities = list(map(attrgetter("severity"),
+                                          self._rule_violations[rule]))
+                    errors = severities.count(ERROR)
+                    counts[rule] = (errors, len(severities) - errors)
+            self._rule_counts = counts
+        return self._rule_counts
+
     @property
     def key(self):
         return self._key
-    
+
+    @key.setter
+    def key(self, key):
+        # overrides the key found by _set_key (for all the chords - without
+        # modulations), should be set before checking the rules (harmonic
+        # functions are found again)
+        tonic, mode = key
+        if tonic not in range(12) or mode not in (0, 1):
+            raise ValueError("Invalid key: {}".format(key))
+        key_idx = KEYS.index((tonic, mode))
+        self._key_fixed = True
+        if (tonic, mode) != self._key or set(self._key_track) != {key_idx}:
+            self._key = (tonic, mode)
+            self._key_track = array('b', [key_idx] * self._length)
+            self._function_codes = None
+
+    @property
+    def key_track(self):
+        # key of every chord (as (tonic, mode))
+        return [KEYS[key] for key in self._key_track]
+
+    @property
+    def modulations(self):
+        # [(index of the chord, key)] - the first key and every change of it
+        result = []
+        previous = None
+        for idx, key in enumerate(self._key_track):
+            if key != previous:
+                result.append((idx, KEYS[key]))
+                previous = key
+        return result
+
     @property
     def chords(self):
-        return self._chords
-    
+        return [PieceChord(self, idx) for idx in range(self._length)]
+
     @property
     def parts_hr(self):
         # human-readable representation of the part
         result = {}
-        for voice, part in self.parts.items():
-            result[voice] = "|" + part.to_hrstr + "||"
+        for row, voice in enumerate(VOICES):
+            result[voice] = "|" + " ".join(
+                _HR_NOTES[midi] for midi in self._row(row)) + "||"
         return result
-    
+
+    @property
+    def parts_str(self):
+        # parts in CMC notation (as in MusicPiece) - e.g. to store a patched
+        # piece
+        return {voice: " ".join(map(_NOTE_STRS.__getitem__, self._row(row)))
+                for row, voice in enumerate(VOICES)}
+
     @property
     def key_hr(self):
         # human-readable version of key
-        if None in self.key:
-            return "Unknown key"
-        else:
-            result =" ".join((
-                ("C","C#","D","D#","E","F","F#","G","G#","A",
-                                                        "A#","B")[self.key[0]],
-                ("minor", "major")[self.key[1]]
-            ))
-            return result
-    
+        return key_to_str(self.key)
+
+    @property
+    def modulations_hr(self):
+        # human-readable list of modulations (empty if there are none)
+        return ", ".join(
+            "chord {}: {}".format(idx + 1, key_to_str(key))
+            for idx, key in self.modulations[1:]
+        )
+
     @property
     def functions_hr(self):
         # gives harmonic functions set to print under score (compatible with
         # parts_hr)
-        result = "|"
-        for chord in self.chords:
-            ch = chord.harmonic_function(self.key)
-            while len(ch) < 4:
-                ch += " "  # ensures correct spacing
-            result += ch
-        result = result[:-1] + "||"
-        return result
-    
+        return "|" + "".join(function.ljust(SCORE_COLUMN)
+                             for function in self._functions())[:-1] + "||"
+
     @property
     def chord_n_hr(self):
         # chord numbers to print above score (compatible with parts_hr)
-        result = " "
-        for idx in enumerate(self.chords, 1):
-            num = str(idx[0])
-            while len(num) < 4:
-                num += " "
-            result += num
-        return result
-    
+        return " " + "".join(str(idx).ljust(SCORE_COLUMN)
+                             for idx in range(1, self._length + 1))
+
+    @property
+    def score_hr(self):
+        # the whole score as lines of text (chord numbers, parts and
+        # functions), a chord in each column - built at once, to be shown as
+        # it is (in <pre>). Columns are widened for long pieces, so that
+        # chord numbers don't run together
+        width = max(SCORE_COLUMN, len(str(self._length)) + 1)
+        rows = [("n", " ", [str(idx) for idx in range(1, self._length + 1)])]
+        for row, voice in enumerate(VOICES):
+            rows.append((voice, "|", [_HR_NOTES[midi]
+                                      for midi in self._row(row)]))
+        rows.append(("f", "|", self._functions()))
+        return "\n".join(
+            "{}: {}{}{}".format(label, start,
+                                "".join(cell.ljust(width) for cell in cells),
+                                start.strip())
+            for label, start, cells in rows
+        )
+
+    @property
+    def function_codes(self):
+        # harmonic function of every chord (in its key - see key_track) as
+        # indexes of FUNCTIONS, found once for each key track
+        if self._function_codes is None:
+            self._function_codes = self._find_function_codes(0, self._length)
+        return self._function_codes
+
+    def _find_function_codes(self, start, stop):
+        codes = array('b')
+        for root, mode, key in zip(self._roots[start:stop],
+                                   self._modes[start:stop],
+                                   self._key_track[start:stop]):
+            if root < 0:
+                codes.append(0)
+            else:
+                tonic, key_mode = KEYS[key]
+                codes.append(
+                    _FUNCTION_TABLE[key_mode][(root - tonic) % 12][mode])
+        return codes
+
+    def _functions(self):
+        # harmonic function of every chord (in the current key)
+        return [FUNCTIONS[code] for code in self.function_codes]
+
     def _read_chords(self):
-        # converts noteSeqs to chords
-        for i in range(len(self.soprano)):
-            chord = Chord(self.soprano[i], 
-                          self.alto[i], 
-                          self.tenor[i], 
-                          self.bass[i])
-            self._chords.append(chord)
-    
+        # fills root, mode and structure columns of the chords
+        self._roots, self._modes, structures = _read_chord_columns(
+            [self._row(row) for row in range(4)])
+        for row in structures:
+            self._structures.extend(row)
+
     def _set_key(self):
         # method dentifies key (basing on the first chord)
         # key is stored as a touple - first element determinines the tonic,
         # (integer 0-11) second detemines the mode (1 == major or 0 == minor)
         # method should return C major if failed to read the chord
-        if self.chords[0].root != None:
-            self._key[0] = self.chords[0].root
-        else:
-            self._key[0] = 0  # C as a fallback value
-        if self.chords[0].mode in ("M","M7"):
-            self._key[1] = 1
-        elif self.chords[0].mode in ("m", "m7"):
-            self._key[1] = 0
+        # key of every chord is found afterwards (see find_key_track)
+        self._key = _key_of_chord(self._roots[0], self._modes[0])
+        self._key_fixed = False
+        self._key_tables = _current_key_tables()
+        self._key_states = _key_viterbi(self._roots, self._modes, self._key,
+                                        self._key_tables)
+        self._key_track = _read_key_track(*self._key_states[1:])
+        self._function_codes = None
+
+    @property
+    def complete(self):
+        # False if check_harmony stopped early (see max_errors) - the counts
+        # and mistakes are only those found so far
+        return self._complete
+
+    def check_harmony(self, rules=['ALL'], max_errors=None):
+        # main method for checking harmony of a piece, calls methods
+        # checking each rule (see RULE_REGISTRY), each call is timed.
+        # With max_errors checking stops as soon as more errors are found
+        # (0 - at the first one): the piece is checked in blocks of
+        # CHECK_BLOCK chords, the cheapest rules (see _rules_by_cost) first
+        selected = [rule for rule in RULE_REGISTRY.values()
+                    if 'ALL' in rules or rule.code in rules]
+        self._complete = True
+        if max_errors is None:
+            for rule in selected:
+                self._check_rule(rule, 0, self._length)
+            return
+        selected = self._rules_by_cost(selected)
+        for rule in selected:
+            self._rule_violations[rule.code] = []
+        errors = 0
+        for start in range(0, self._length, CHECK_BLOCK):
+            stop = min(start + CHECK_BLOCK, self._length)
+            for rule in selected:
+                errors += self._check_rule(rule, start, stop)
+                if errors > max_errors:
+                    self._complete = False
+                    return
+
+    def _check_rule(self, rule, start, stop):
+        # checks a rule in chords start..stop-1 (after the chords checked
+        # before), returns the number of errors found
+        found = len(self._rule_violations.get(rule.code, ()))
+        begin = perf_counter()
+        rule.check(self, start, stop)
+        record_rule_time(rule.code, perf_counter() - begin, stop - start)
+        return sum(1 for violation in self._rule_violations[rule.code][found:]
+                   if violation.severity == ERROR)
+
+    def _rules_by_cost(self, rules):
+        # rules in order of their measured time per chord (see rule_stats),
+        # rules not timed yet first (in order of RULE_REGISTRY)
+        stats = rule_stats()
+        return sorted(rules, key=lambda rule: stats[rule.code]["ms_per_chord"]
+                      if rule.code in stats else 0)
+
+    def patch(self, start, stop, soprano, alto, tenor, bass):
+        # replaces chords start..stop-1 with new ones (start == stop inserts
+        # them, empty parts delete the chords). Parts are strings (in CMC
+        # notation) or sequences of midi numbers.
+        # Only the edited chords are read, the key track is found again only
+        # until it meets the old one, and the rules checked before are
+        # checked again only in the chords whose notes or key changed (and in
+        # the chord before them - for rules about two chords). Returns the
+        # (start, stop) range of chords checked again
+        n = self._length
+        if not self._complete:
+            raise ValueError("A piece checked only partly can't be patched.")
+        if not 0 <= start <= stop <= n:
+            raise ValueError('Invalid range of chords: {}-{}'.format(start,
+                                                                     stop))
+        parts = [parse_notes(part) if isinstance(part, str) else tuple(part)
+                 for part in (soprano, alto, tenor, bass)]
+        if len(set(len(part) for part in parts)) != 1:
+            raise ValueError('All parts must have the same length.')
+        count = len(parts[0])
+        delta = count - (stop - start)
+        if n + delta == 0:
+            raise ValueError("A piece can't be empty.")
+        if self._key_states is None and not self._key_fixed:
+            self._key_tables = _current_key_tables()
+            self._key_states = _key_viterbi(self._roots, self._modes,
+                                            self._key, self._key_tables)
+        roots, modes, structures = _read_chord_columns(parts)
+        for row in range(3, -1, -1):  # later rows first - offsets still valid
+            self._notes[row * n + start:row * n + stop] = \
+                array('h', parts[row])
+            self._structures[row * n + start:row * n + stop] = structures[row]
+        self._roots[start:stop] = roots
+        self._modes[start:stop] = modes
+        self._length = n + delta
+        lo, hi = self._patch_key_track(start, stop, count)
+        if self._function_codes is not None:
+            self._function_codes[lo:hi - delta] = \
+                self._find_function_codes(lo, hi)
+        # mistakes in the chords lo-1..hi-1 are found again, the later ones
+        # are moved by delta
+        lo = max(lo - 1, 0)
+        for rule, violations in self._rule_violations.items():
+            beats = [violation.beat for violation in violations]
+            tail = violations[bisect_left(beats, hi - delta):]
+            if delta:
+                tail = [violation._replace(beat=violation.beat + delta)
+                        for violation in tail]
+            self._rule_violations[rule] = \
+                violations[:bisect_left(beats, lo)] + tail
+            RULE_REGISTRY[rule].check(self, lo, hi)
+        self._rule_counts = None
+        self._summary = None
+        return lo, hi
+
+    def _patch_key_track(self, start, stop, count):
+        # key track after replacing chords start..stop-1 with count chords
+        # (already read) - the Viterbi states are found from start only until
+        # they are the same as before, the track is read backwards only until
+        # it's the same as before. Returns the range of chords whose key
+        # could have changed
+        n = self._length
+        delta = count - (stop - start)
+        end = start + count
+        if self._key_fixed:
+            key_idx = KEYS.index(self._key)
+            self._key_track[start:stop] = array('b', [key_idx] * count)
+            return start, end
+        old_track = self._key_track
+        if start == 0:
+            # the first chord (and so the first key) may have changed
+            self._set_key()
+            track = self._key_track
+            hi = n
+            while hi > end and track[hi - 1] == old_track[hi - 1 - delta]:
+                hi -= 1
+            return 0, hi
+        states, best_keys, alive_keys = self._key_states
+        state = states[start - 1]
+        new_states = array('l')
+        new_best_keys = array('b')
+        new_alive_keys = array('l')
+        meet = None  # first chord after the edit with the same state
+        for i in range(start, n):
+            state, best_key, alive = self._key_tables.step(
+                state, self._roots[i], self._modes[i])
+            if i >= end and state == states[i - delta]:
+                meet = i
+                break
+            new_states.append(state)
+            new_best_keys.append(best_key)
+            new_alive_keys.append(alive)
+        old_stop = n - delta if meet is None else meet - delta
+        states[start:old_stop] = new_states
+        best_keys[start:old_stop] = new_best_keys
+        alive_keys[start:old_stop] = new_alive_keys
+        # reading the track backwards, from the last chord or from the chord
+        # where the states met (its key can't change)
+        if meet is None:
+            hi = n
+            key = None
         else:
-            self._key[1] = 1  # major as a fallback value
-    
-    def check_harmony(self, rules=['ALL']):
-        # main method for checking harmony of a piece, should call methods
-        # for checking each rule
-        if 'ALL' in rules or 'RANGE' in rules:
-            self._check_range()
-        if 'ALL' in rules or 'LEAPS' in rules:
-            self._check_leaps()
-        if 'ALL' in rules or 'DISTANCES' in rules:
-            self._check_distances()
-        if 'ALL' in rules or 'PARALELS' in rules:
-            self._check_paralels()
-        if 'ALL' in rules or 'CHORDS' in rules:
-            self._check_chords()
-        if 'ALL' in rules or "CHORDS_IN_CTX" in rules:
-            self._check_chords_in_context()
-    
-    # Methods checking individual rules. Each method should:
-    # Increase self.err_count by number of mistakes found
-    # Append a 3-element touple to self.err_detailed, matching the pattern:
+            hi = meet
+            key = old_track[meet - delta]
+        keys = []
+        i = hi - 1
+        while i >= 0:
+            if key is None or not alive_keys[i] >> key & 1:
+                key = best_keys[i]
+            if i < start and key == old_track[i]:
+                break
+            keys.append(key)
+            i -= 1
+        lo = i + 1
+        keys.reverse()
+        old_track[lo:hi - delta] = array('b', keys)
+        return lo, hi
+
+    # Methods checking individual rules. Each method should find mistakes
+    # (as Violation touples) in chords start..stop-1 (the whole piece by
+    # default; rules about two chords - those starting in these chords) and
+    # pass them to self._report, which stores them in self._rule_violations
+    # (replacing the ones found there before). Counts and messages
+    # (err_count, err_detailed - 3-element touples matching the pattern:
     # ( <Mistake type (str)> , <err_count (int)>, <list of str-s with details
-    # about each mistake> )
-    
-    def _check_range(self):
+    # about each mistake> ), ...) are made from them when needed
+
+    def _window(self, start, stop):
+        return start, self._length if stop is None else stop
+
+    def _report(self, rule, violations, start=0, stop=None):
+        # violations - ordered by beat
+        current = self._rule_violations.get(rule)
+        if current is None or (start == 0 and (stop is None
+                                               or stop >= self._length)):
+            self._rule_violations[rule] = violations
+        elif not current or current[-1].beat < start:
+            current.extend(violations)  # the next block of chords
+        else:
+            beats = [violation.beat for violation in current]
+            current[bisect_left(beats, start):bisect_left(beats, stop)] = \
+                violations
+        self._rule_counts = None
+        self._summary = None
+
+    @harmony_rule("RANGE", "Default voice ranges", ERROR)
+    def _check_range(self, start=0, stop=None):
         # checking vocal range for each voice in the piece
-        err_count = 0
-        errs = []
-        ranges = {
-            "S" : (58, 81),
-            "A" : (53, 74),
-            "T" : (46, 69),
-            "B" : (40, 62)
-        }
-        for voice, part in self.parts.items():
-            v_range = ranges[voice]
-            for idx, note in enumerate(part, 1):
-                if note.midi_number > v_range[1]:
-                    err_count += 1
-                    errs.append("Chord {0}: {1} too high".format(idx, voice))
-                elif note.midi_number < v_range[0]:
-                    err_count += 1
-                    errs.append("Chord {0}: {1} too low".format(idx, voice))
-        if err_count:
-            errs.sort()
-            self._err_count += err_count
-            self._err_detailed.append(("Voice range errors", err_count, errs))
-    
-    def _check_leaps(self):
+        start, stop = self._window(start, stop)
+        n = self._length
+        violations = []
+        for row, voice in enumerate(VOICES):
+            low, high = VOICE_RANGES[voice]
+            part = self._notes[row * n + start:row * n + stop]
+            if not part or (min(part) >= low and max(part) <= high):
+                continue  # the whole part is in range
+            for beat, midi in enumerate(part, start):
+                detail = _range_mistake(voice, midi)
+                if detail:
+                    violations.append(
+                        Violation("RANGE", ERROR, beat, voice, detail))
+        violations.sort(key=attrgetter("beat"))
+        self._report("RANGE", violations, start, stop)
+
+    @harmony_rule("LEAPS", "Leaps of a seventh or above octave forbidden",
+                  ERROR)
+    def _check_leaps(self, start=0, stop=None):
         # checking for restricted intervals: leaps of a 7th, or >=9th
-        err_count = 0
-        errs = []
-        for voice, part in self.parts.items():
-            for i in range(len(part)-1):
-                distance = abs(part[i+1].midi_number - part[i].midi_number)
-                if  distance == 10:
-                    err_count +=1
-                    errs.append("Chords {0}/{1}: Restricted leap in {2} - 7".
-                                format(i+1, i+2, voice))
-                elif distance == 11:
-                    err_count +=1
-                    errs.append("Chords {0}/{1}: Restricted leap in {2} - 7<".
-                                format(i+1, i+2, voice))
-                elif distance > 12:
-                    err_count +=1
-                    errs.append(
-                        "Chords {0}/{1}: Restricted leap in {2} - over an octave".
-                            format(i+1, i+2, voice))
-        if err_count:
-            errs.sort()
-            self._err_count += err_count
-            self._err_detailed.append(("Restricted leaps", err_count, errs))
-    
-    def _check_distances(self):
-        # checking each chord for too high distances between voices and 
+        start, stop = self._window(start, stop)
+        n = self._length
+        violations = []
+        for row, voice in enumerate(VOICES):
+            leaps = list(map(abs, _diff(
+                self._notes[row * n + start:row * n + min(stop + 1, n)])))
+            if not leaps or max(leaps) < 10:
+                continue  # no leap of a seventh or above in the part
+            for beat, distance in enumerate(leaps, start):
+                detail = _leap_mistake(distance)
+                if detail:
+                    violations.append(
+                        Violation("LEAPS", ERROR, beat, voice, detail))
+        violations.sort(key=attrgetter("beat"))
+        self._report("LEAPS", violations, start, stop)
+
+    @harmony_rule("DISTANCES", "Distances allowed: S/A - max 8, A/T - less "
+                  "than 8, T/B - preferably below 12, max 15", ERROR)
+    def _check_distances(self, start=0, stop=None):
+        # checking each chord for too high distances between voices and
         # too low distances (overlaps == crossing voices)
-        err_count = 0
-        errs = []
-        war_count = 0
-        wars = []
-        for i in range(len(self.soprano)):
-            if self.soprano[i].midi_number - self.alto[i].midi_number > 12:
-                err_count += 1
-                errs.append("Chord {0}: S/A interval to wide".format(i+1))
-            elif self.soprano[i].midi_number - self.alto[i].midi_number < 0:
-                err_count += 1
-                errs.append("Chord {0}: S/A overlap".format(i+1))
-                
-            if self.alto[i].midi_number - self.tenor[i].midi_number >= 12:
-                err_count += 1
-                errs.append("Chord {0}: A/T interval to wide".format(i+1))
-            elif self.alto[i].midi_number - self.tenor[i].midi_number < 0:
-                err_count += 1
-                errs.append("Chord {0}: A/T overlap".format(i+1))
-                
-            if self.tenor[i].midi_number - self.bass[i].midi_number > 24:
-                err_count += 1
-                errs.append("Chord {0}: T/B interval to wide".format(i+1))
-            elif self.tenor[i].midi_number - self.bass[i].midi_number > 19:
-                war_count += 1
-                wars.append("Chord {0}: T/B interval to wide".format(i+1))
-            elif self.tenor[i].midi_number - self.bass[i].midi_number < 0:
-                err_count += 1
-                errs.append("Chord {0}: T/B overlap".format(i+1))
-        if err_count:
-            self._err_count += err_count
-            self._err_detailed.append(
-                ("Voice distance errors", err_count, errs)
-            )
-        if war_count:
-            self._war_count += war_count
-            self._war_detailed.append(
-                ("Voice distance warnings", war_count, wars)
-            )
-    
-    def _check_paralels(self):
+        # mistakes are collected pair by pair and then ordered by chord
+        start, stop = self._window(start, stop)
+        n = self._length
+        notes = self._notes
+        violations = []
+        for pair, (upper, lower, max_dist, max_rec) in \
+                enumerate(VOICE_DISTANCES):
+            distances = list(map(sub,
+                                 notes[upper * n + start:upper * n + stop],
+                                 notes[lower * n + start:lower * n + stop]))
+            if not distances \
+                    or (min(distances) >= 0 and max(distances) <= max_rec):
+                continue  # all the distances are correct
+            for beat, distance in enumerate(distances, start):
+                mistake = _distance_mistake(pair, distance)
+                if mistake:
+                    violations.append(Violation(
+                        "DISTANCES", mistake[0], beat,
+                        _pair_name(upper, lower), mistake[1]))
+        violations.sort(key=attrgetter("beat"))
+        self._report("DISTANCES", violations, start, stop)
+
+    @harmony_rule("PARALELS", "(Anti)consecutive unisons, perfect fifths and "
+                  "octaves forbidden", ERROR)
+    def _check_paralels(self, start=0, stop=None):
         # checking for restricted (anti)consecutive intervals (1, 5, 8)
-        err_count = 0
-        errs = []
-        for i in range(len(self.soprano)-1):
-            s1 = self.soprano[i].midi_number
-            s2 = self.soprano[i+1].midi_number
-            a1 = self.alto[i].midi_number
-            a2 = self.alto[i+1].midi_number
-            t1 = self.tenor[i].midi_number
-            t2 = self.tenor[i+1].midi_number
-            b1 = self.bass[i].midi_number
-            b2 = self.bass[i+1].midi_number
-            # conditions writen usin "in" to not falsly trigger it when
-            # voices move in consecutive forths, A above S
-            # REVISE IT!
-            # The distances extended above allowed by check_distance 
-            # (by a reasonable amount to identify both errors if occur 
-            # simultaneously
-            # paralels should be checked only when note changes, hence:
-            if s1 != s2 and a1 != a2:
-                if (s1 - a1) % 12 == 0 and (s2 - a2) % 12 == 0:
-                    err_count += 1
-                    errs.append("Chords {0}/{1}: S/A consecutive Unison/Octave".
-                                format(i+1, i+2))
-                elif s1 - a1 in (7, 19, 31) and s2 - a2 in (7, 19, 31):
-                    err_count += 1
-                    errs.append("Chords {0}/{1}: S/A consecutive Fifths".
-                                format(i+1, i+2))
-            
-            if s1 != s2 and t1 != t2:
-                if (s1 - t1) % 12 == 0 and (s2 - t2) % 12 == 0:
-                    err_count += 1
-                    errs.append("Chords {0}/{1}: S/T consecutive Unison/Octave".
-                                format(i+1, i+2))
-                elif s1 - t1 in (7, 19, 31, 43) and s2 - t2 in (7, 19, 31, 43):
-                    err_count += 1
-                    errs.append("Chords {0}/{1}: S/T consecutive Fifths".
-                                format(i+1, i+2))
-            
-            if s1 != s2 and b1 != b2:
-                if (s1 - b1) % 12 == 0 and (s2 - b2) % 12 == 0:
-                    err_count += 1
-                    errs.append("Chords {0}/{1}: S/B consecutive Unison/Octave".
-                                format(i+1, i+2))
-                elif s1 - b1 in (7, 19, 31, 43) and s2 - b2 in (7, 19, 31, 43):
-                    err_count += 1
-                    errs.append("Chords {0}/{1}: S/B consecutive Fifths".
-                                format(i+1, i+2))
-            
-            if a1 != a2 and t1 != t2:
-                if (a1 - t1) % 12 == 0 and (a2 - t2) % 12 == 0:
-                    err_count += 1
-                    errs.append("Chords {0}/{1}: A/T consecutive Unison/Octave".
-                                format(i+1, i+2))
-                elif a1 - t1 in (7, 19, 31) and a2 - t2 in (7, 19, 31):
-                    err_count += 1
-                    errs.append("Chords {0}/{1}: A/T consecutive Fifths".
-                                format(i+1, i+2))
-            
-            if a1 != a2 and b1 != b2:
-                if (a1 - b1) % 12 == 0 and (a2 - b2) % 12 == 0:
-                    err_count += 1
-                    errs.append("Chords {0}/{1}: A/B consecutive Unison/Octave".
-                                format(i+1, i+2))
-                elif a1 - b1 in (7, 19, 31, 43) and a2 - b2 in (7, 19, 31, 43):
-                    err_count += 1
-                    errs.append("Chords {0}/{1}: A/B consecutive Fifths".
-                                format(i+1, i+2))
-            
-            if t1 != t2 and b1 != b2:
-                if (t1 - b1) % 12 == 0 and (t2 - b2) % 12 == 0:
-                    err_count += 1
-                    errs.append("Chords {0}/{1}: T/B consecutive Unison/Octave".
-                                format(i+1, i+2))
-                elif t1 - b1 in (7, 19, 31) and t2 - b2 in (7, 19, 31):
-                    err_count += 1
-                    errs.append("Chords {0}/{1}: T/B consecutive Fifths".
-                                format(i+1, i+2))
-            
-        if err_count:
-            self._err_count += err_count
-            self._err_detailed.append(
-                ("Consecutive intervals", err_count, errs)
-            )
-    
-    def _check_chords(self):
+        # paralels should be checked only when note changes (in both voices)
+        # mistakes are collected pair by pair and then ordered by chords
+        start, stop = self._window(start, stop)
+        n = self._length
+        end = min(stop + 1, n)
+        rows = [self._notes[row * n + start:row * n + end]
+                for row in range(4)]
+        moves = [list(map(ne, row[1:], row)) for row in rows]
+        violations = []
+        for pair, (upper, lower, fifths) in enumerate(PARALELS):
+            intervals = list(map(sub, rows[upper], rows[lower]))
+            both_move = map(and_, moves[upper], moves[lower])
+            for beat in compress(range(end - start - 1), both_move):
+                detail = _paralel_mistake(pair, intervals[beat],
+                                          intervals[beat+1])
+                if detail:
+                    violations.append(Violation(
+                        "PARALELS", ERROR, start + beat,
+                        _pair_name(upper, lower), detail))
+        violations.sort(key=attrgetter("beat"))
+        self._report("PARALELS", violations, start, stop)
+
+    @harmony_rule("CHORDS", "Chords - in implementation", ERROR)
+    def _check_chords(self, start=0, stop=None):
         # checking for wrong chords (unrecognisable, or wrong dubling)
-        # if chord is unrecognisable, other conditions aren't checked
-        # e.g - chord c,d,e,g, will get warning (d doesn't belong to C chord)
-        # but c,d,g,c will not get warning, but will get an error - 
-        # chord mode unknown) 
-        err_count = 0
-        errs = []
-        war_count = 0
-        wars = []
-        for idx, chord in enumerate(self.chords, 1):
-            if chord.mode == None:
-                err_count += 1
-                errs.append("Chord {0}: Chord mode unknown".format(idx))
-            else:  
-                roots = 0
-                thirds = 0
-                fifths = 0
-                sevenths = 0
-                for voice, interval in chord.structure.items():
-                    if interval == "1":
-                        roots += 1
-                    elif interval == "3>" or interval == "3":
-                        thirds += 1
-                    elif interval == "5":
-                        fifths += 1
-                    elif interval == "7":
-                        sevenths += 1
-                    else:
-                        war_count += 1
-                        wars.append(
-                            "Chord {0}: {1} note doesn't belong to the chord".
-                                format(idx, voice)
-                        )
-                if thirds > 1 and (not chord.harmonic_function(self.key) == "TVI"):
-                    war_count += 1
-                    wars.append("Chord {0}: more than one third in the chord".
-                                    format(idx))
-                elif fifths >1:
-                    war_count += 1
-                    wars.append("Chord {0}: more than one fifth in the chord".
-                                    format(idx))
-                elif sevenths > 1:
-                    err_count += 1
-                    errs.append("Chord {0}: more than one seventh in the chord".
-                                    format(idx))
-        if err_count:
-            self._err_count += err_count
-            self._err_detailed.append(("Unnown chords", err_count, errs))
-        
-        if war_count:
-            self._war_count += war_count
-            self._war_detailed.append(
-                ("Foreign notes in chords and wrong doubling", war_count, wars)
-            )
-    
-    def _check_chords_in_context(self):
-        err_count = 0
-        errs = []
-        war_count = 0
-        wars = []
-        war_count += 1
-        wars.append("Checking chords in context not yet implemented!")
-        self._war_count += war_count
-        self._war_detailed.append(
-            ("Checking chords in context", war_count, wars)
-        )
+        # (see _chord_violations)
+        start, stop = self._window(start, stop)
+        violations = []
+        n = self._length
+        structures = self._structures
+        codes = self.function_codes
+        for beat in range(start, stop):
+            structure = [structures[row * n + beat] for row in range(4)]
+            violations.extend(_chord_violations(
+                beat, self._modes[beat], structure, FUNCTIONS[codes[beat]]))
+        self._report("CHORDS", violations, start, stop)
+
+    @harmony_rule("CHORDS_IN_CTX", "Chords in context - progressions of "
+                  "functions, resolving dominants", ERROR,
+                  version="2." + context_table_hash(CONTEXT_TABLE))
+    def _check_chords_in_context(self, start=0, stop=None):
+        # checking progressions of chords - a single pass of the automaton
+        # (see CONTEXT_TABLE). Function of the next chord is found in the key
+        # of the current chord (the same, unless the key changes)
+        start, stop = self._window(start, stop)
+        violations = []
+        table = self.context_table
+        codes = self.function_codes
+        roots = self._roots
+        modes = self._modes
+        track = self._key_track
+        n = self._length
+        for beat in range(start, stop):
+            checks = table[codes[beat]]
+            if not any(checks):
+                continue  # nothing to check after this function
+            if beat == n - 1:
+                next_code = END
+            elif track[beat + 1] == track[beat] or roots[beat + 1] < 0:
+                next_code = codes[beat + 1]
+            else:
+                tonic, key_mode = KEYS[track[beat]]
+                next_code = _FUNCTION_TABLE[key_mode][
+                    (roots[beat + 1] - tonic) % 12][modes[beat + 1]]
+            for check, severity in checks[next_code]:
+                violations.extend(check(self, beat, severity, codes[beat],
+                                        next_code))
+        self._report("CHORDS_IN_CTX", violations, start, stop)
+
+RULES = tuple(RULE_REGISTRY)
+CHECK_BLOCK = 256  # chords checked at once by each rule (see max_errors)
+RULE_VERSIONS = {code: rule.version for code, rule in RULE_REGISTRY.items()}
+ENGINE_VERSION = "{}.{}".format(
+    ANALYSIS_VERSION,
+    ".".join(str(RULE_VERSIONS[rule]) for rule in RULES),
+)
+
+
+def _selected(rule, rules):
+    return 'ALL' in rules or rule in rules
+
+def _beat_violations(beat, notes, mode, structure, function, rules):
+    # mistakes in a single chord (see Piece._check_range, _check_distances
+    # and _check_chords)
+    violations = []
+    if _selected("RANGE", rules):
+        for voice, midi in zip(VOICES, notes):
+            detail = _range_mistake(voice, midi)
+            if detail:
+                violations.append(
+                    Violation("RANGE", ERROR, beat, voice, detail))
+    if _selected("DISTANCES", rules):
+        for pair, (upper, lower, max_dist, max_rec) in \
+                enumerate(VOICE_DISTANCES):
+            mistake = _distance_mistake(pair, notes[upper] - notes[lower])
+            if mistake:
+                violations.append(Violation(
+                    "DISTANCES", mistake[0], beat,
+                    _pair_name(upper, lower), mistake[1]))
+    if _selected("CHORDS", rules):
+        violations.extend(_chord_violations(beat, mode, structure, function))
+    return violations
+
+def _transition_violations(beat, notes, next_notes, rules):
+    # mistakes between two consecutive chords (see Piece._check_leaps and
+    # _check_paralels)
+    violations = []
+    if _selected("LEAPS", rules):
+        for voice, note, next_note in zip(VOICES, notes, next_notes):
+            detail = _leap_mistake(abs(next_note - note))
+            if detail:
+                violations.append(
+                    Violation("LEAPS", ERROR, beat, voice, detail))
+    if _selected("PARALELS", rules):
+        for pair, (upper, lower, fifths) in enumerate(PARALELS):
+            if notes[upper] != next_notes[upper] \
+                    and notes[lower] != next_notes[lower]:
+                detail = _paralel_mistake(
+                    pair,
+                    notes[upper] - notes[lower],
+                    next_notes[upper] - next_notes[lower],
+                )
+                if detail:
+                    violations.append(Violation(
+                        "PARALELS", ERROR, beat,
+                        _pair_name(upper, lower), detail))
+    return violations
+
+def iter_harmony(soprano, alto, tenor, bass, rules=['ALL']):
+    # Checks a piece chord by chord while the parts are being read - only two
+    # chords are kept at a time, so it works for pieces of any length.
+    # Parts are strings (in CMC notation) or iterables of midi numbers.
+    # Yields a dict for each chord: its number (from 1), notes, root, mode
+    # and harmonic function, and messages of the mistakes found in that chord
+    # and between it and the next chord. The key is set using the first chord
+    # (as in Piece), but modulations are not recognised (the whole piece
+    # would have to be read first) - chords in context are checked in that
+    # key.
+    parts = [iter_notes(part) if isinstance(part, str) else iter(part)
+             for part in (soprano, alto, tenor, bass)]
+    in_context = _selected("CHORDS_IN_CTX", rules)
+    key = None
+    previous = None  # (notes, structure, function code, result, violations)
+    for beat, notes in enumerate(zip_longest(*parts)):
+        if None in notes:
+            raise ValueError('All parts must have the same length.')
+        root, mode, structure = _read_chord(*notes)
+        if key is None:
+            key = _key_of_chord(root, mode)
+        function = _harmonic_function(root, MODES[mode], key)
+        code = 0 if root < 0 else FUNCTIONS.index(function)
+        violations = _beat_violations(beat, notes, mode, structure,
+                                      function, rules)
+        if previous is not None:
+            previous[4].extend(_transition_violations(beat - 1, previous[0],
+                                                      notes, rules))
+            if in_context:
+                previous[4].extend(_context_violations(
+                    beat - 1, (previous[0], notes),
+                    (previous[1], structure), previous[2], code))
+            yield _beat_result(*previous[3:])
+        result = {
+            "chord": beat + 1,
+            "notes": [midi_to_str(note) for note in notes],
+            "key": key_to_str(key),
+            "root": NOTE_NAMES[root],
+            "mode": MODES[mode],
+            "function": function,
+        }
+        previous = (notes, structure, code, result, violations)
+    if previous is not None:
+        if in_context:
+            previous[4].extend(_context_violations(
+                beat, (previous[0],), (previous[1],), previous[2], END))
+        yield _beat_result(*previous[3:])
+
+class _ChordWindow:
+    # consecutive chords read by iter_harmony, stored as in a Piece - as much
+    # of it as the context checks use (see CONTEXT_CHECKS)
+    def __init__(self, notes, structures):
+        self._length = len(notes)
+        self._notes = [chord[row] for row in range(4) for chord in notes]
+        self._structures = [structure[row] for row in range(4)
+                            for structure in structures]
+
+def _context_violations(beat, notes, structures, code, next_code):
+    # CHORDS_IN_CTX mistakes of a chord read by iter_harmony, notes and
+    # structures - of the chord and of the next one (if any)
+    window = _ChordWindow(notes, structures)
+    violations = []
+    for check, severity in CONTEXT_TABLE[code][next_code]:
+        violations.extend(violation._replace(beat=beat) for violation
+                          in check(window, 0, severity, code, next_code))
+    return violations
 
+def _beat_result(result, violations):
+    result["errors"] = [violation_message(violation)
+                        for violation in violations
+                        if violation.severity == ERROR]
+    result["warnings"] = [violation_message(violation)
+                          for violation in violations
+                          if violation.severity == WARNING]
+    return result
 
-def check_harmony_rules(music_piece, rules=['ALL']):
+def check_harmony_rules(music_piece, rules=['ALL'], max_errors=None):
     piece = Piece(music_piece)
-    piece.check_harmony(rules)
+    piece.check_harmony(rules, max_errors)
     return piece
 
 def make_piece(music_piece):
     # turns a Music_Piece object into a Piece object (without checking rules)
     piece = Piece(music_piece)
     return piece
-    
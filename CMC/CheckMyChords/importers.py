@@ -0,0 +1,283 @@
+# Reads four-voice pieces from Standard MIDI Files (format 1, also 0) and
+# MusicXML files (partwise, also compressed .mxl). Files are read as streams
+# - MIDI track by track, MusicXML with iterparse (elements are dropped as
+# soon as they are read), without building a document tree.
+# A chord is read every time a note starts. Four tracks (channels, parts or
+# voices) playing one note at a time become the voices (ordered by their
+# average pitch), otherwise the four notes sounding together are split by
+# pitch (e.g. a piano score).
+import os
+import struct
+import zipfile
+from fractions import Fraction
+from xml.etree.ElementTree import ParseError, iterparse
+
+from CheckMyChords.notation import midi_to_str
+
+
+class PieceImportError(ValueError):
+    pass
+
+
+def _split_voices(groups):
+    # groups - lists of notes (start, end, midi number), returns 4 lists of
+    # midi numbers (S, A, T, B)
+    groups = [sorted(group) for group in groups if group]
+    onsets = sorted({note[0] for group in groups for note in group})
+    if not onsets:
+        raise PieceImportError("No notes found")
+    if len(groups) == 4 and all(len({note[0] for note in group}) == len(group)
+                                for group in groups):
+        groups.sort(key=lambda group: -sum(note[2] for note in group)
+                    / len(group))
+        return [_sample(group, onsets) for group in groups]
+    notes = sorted(note for group in groups for note in group)
+    parts = [[], [], [], []]
+    sounding = []
+    i = 0
+    for onset in onsets:
+        sounding = [note for note in sounding if note[1] > onset]
+        while i < len(notes) and notes[i][0] == onset:
+            sounding.append(notes[i])
+            i += 1
+        if len(sounding) != 4:
+            raise PieceImportError(
+                "{} notes sounding in chord {}, 4 expected".format(
+                    len(sounding), len(parts[0]) + 1))
+        pitches = sorted((note[2] for note in sounding), reverse=True)
+        for part, pitch in zip(parts, pitches):
+            part.append(pitch)
+    return parts
+
+def _sample(notes, onsets):
+    # the note of a voice sounding at each onset (the last one started)
+    result = []
+    i = -1
+    for onset in onsets:
+        while i + 1 < len(notes) and notes[i + 1][0] <= onset:
+            i += 1
+        if i < 0 or notes[i][1] <= onset:
+            raise PieceImportError(
+                "Rests not allowed (chord {})".format(len(result) + 1))
+        result.append(notes[i][2])
+    return result
+
+def _piece(title, groups):
+    parts = _split_voices(groups)
+    piece = {"title": title[:64]}
+    for field, part in zip(("soprano", "alto", "tenor", "bass"), parts):
+        piece[field] = " ".join(map(midi_to_str, part))
+    return piece
+
+
+# MIDI
+
+def _read(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise PieceImportError("Unexpected end of the MIDI file")
+    return data
+
+def _byte(data, i):
+    if i >= len(data):
+        raise PieceImportError("Unexpected end of a MIDI track")
+    return data[i]
+
+def _varlen(data, i):
+    # (value, index after it) of a variable-length quantity
+    value = 0
+    while True:
+        byte = _byte(data, i)
+        i += 1
+        value = value << 7 | byte & 0x7F
+        if not byte & 0x80:
+            return value, i
+
+def _midi_track(data, notes, track):
+    # adds notes of a track to notes ({(track, channel): [notes]}), returns
+    # its name (if set)
+    name = None
+    time = 0
+    status = None
+    started = {}  # (channel, midi number) -> [start times]
+    i = 0
+    while i < len(data):
+        delta, i = _varlen(data, i)
+        time += delta
+        if _byte(data, i) & 0x80:
+            status = data[i]
+            i += 1
+        elif status is None:
+            raise PieceImportError("Invalid MIDI event")
+        if status == 0xFF:  # meta event
+            kind = _byte(data, i)
+            length, i = _varlen(data, i + 1)
+            if kind == 0x03 and name is None:
+                name = data[i:i + length].decode('latin-1').strip()
+            i += length
+            status = None
+            continue
+        if status in (0xF0, 0xF7):  # sysex
+            length, i = _varlen(data, i)
+            i += length
+            status = None
+            continue
+        kind = status & 0xF0
+        channel = status & 0x0F
+        size = 1 if kind in (0xC0, 0xD0) else 2
+        if i + size > len(data):
+            raise PieceImportError("Unexpected end of a MIDI track")
+        if kind == 0x90 and data[i + 1]:
+            started.setdefault((channel, data[i]), []).append(time)
+        elif kind in (0x80, 0x90):
+            starts = started.get((channel, data[i]))
+            if starts:
+                start = starts.pop(0)
+                if time > start:
+                    notes.setdefault((track, channel), []).append(
+                        (start, time, data[i]))
+        i += size
+    return name
+
+def read_midi(stream, title=""):
+    # stream - a binary file, returns a dict of MusicPiece fields (title -
+    # name of the first track, if set)
+    header = _read(stream, 8)
+    if header[:4] != b"MThd":
+        raise PieceImportError("Not a MIDI file")
+    length = struct.unpack(">I", header[4:])[0]
+    if length < 6:
+        raise PieceImportError("Invalid MIDI header")
+    file_format, n_tracks, division = struct.unpack(
+        ">HHH", _read(stream, length)[:6])
+    if file_format == 2:
+        raise PieceImportError("MIDI files of format 2 are not supported")
+    notes = {}
+    for track in range(n_tracks):
+        kind, length = struct.unpack(">4sI", _read(stream, 8))
+        data = _read(stream, length)
+        if kind != b"MTrk":
+            continue  # unknown chunks should be skipped
+        name = _midi_track(data, notes, track)
+        if track == 0 and name:
+            title = name
+    return _piece(title, notes.values())
+
+
+# MusicXML
+
+_STEPS = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+
+def _text(element, path, default=None):
+    child = element.find(path)
+    if child is None or child.text is None:
+        return default
+    return child.text.strip()
+
+def _tied_note(group, start, midi):
+    # index of the note a tie continues (ending at start), None if not found
+    for i in range(len(group) - 1, max(len(group) - 5, -1), -1):
+        if group[i][1] == start and group[i][2] == midi:
+            return i
+    return None
+
+def read_musicxml(stream, title=""):
+    # stream - a binary file (uncompressed MusicXML), returns a dict of
+    # MusicPiece fields (title - work or movement title, if set)
+    notes = {}  # (part, voice) -> [notes]
+    part = None
+    divisions = 1
+    time = Fraction(0)
+    last_start = time
+    titles = {}
+    try:
+        for event, element in iterparse(stream, events=("start", "end")):
+            tag = element.tag
+            if event == "start":
+                if tag == "score-timewise":
+                    raise PieceImportError(
+                        "Timewise MusicXML files are not supported")
+                if tag == "part" and element.get("id"):
+                    part = element.get("id")
+                    divisions = 1
+                    time = Fraction(0)
+                continue
+            if tag in ("work-title", "movement-title") and element.text:
+                titles[tag] = element.text.strip()
+            elif tag == "divisions":
+                divisions = int(element.text)
+                if divisions <= 0:
+                    raise PieceImportError(
+                        "Invalid divisions: {}".format(divisions))
+            elif tag in ("backup", "forward"):
+                duration = Fraction(int(_text(element, "duration", 0)),
+                                    divisions)
+                time += duration if tag == "forward" else -duration
+            elif tag == "note":
+                if element.find("grace") is not None:
+                    continue
+                duration = Fraction(int(_text(element, "duration", 0)),
+                                    divisions)
+                if element.find("chord") is not None:
+                    start = last_start
+                else:
+                    start = last_start = time
+                    time += duration
+                pitch = element.find("pitch")
+                if pitch is None:
+                    continue  # a rest (or an unpitched note)
+                midi = (int(_text(pitch, "octave")) + 1) * 12 \
+                    + _STEPS[_text(pitch, "step")] \
+                    + int(float(_text(pitch, "alter", 0)))
+                group = notes.setdefault((part, _text(element, "voice", "1")),
+                                         [])
+                tied = _tied_note(group, start, midi) \
+                    if any(tie.get("type") == "stop"
+                           for tie in element.findall("tie")) else None
+                if tied is not None:
+                    group[tied] = (group[tied][0], start + duration, midi)
+                elif duration:
+                    group.append((start, start + duration, midi))
+            elif tag == "measure":
+                element.clear()  # notes of the measure are already read
+    except PieceImportError:
+        raise
+    except (ParseError, KeyError, TypeError, ValueError) as e:
+        raise PieceImportError("Invalid MusicXML file ({})".format(e))
+    title = titles.get("work-title") or titles.get("movement-title") or title
+    return _piece(title, notes.values())
+
+def _mxl_root(archive):
+    # path of the score in a compressed MusicXML file
+    with archive.open("META-INF/container.xml") as container:
+        for event, element in iterparse(container):
+            if element.tag.endswith("rootfile"):
+                return element.get("full-path")
+    raise PieceImportError("No score in the compressed MusicXML file")
+
+
+IMPORTERS = {
+    ".mid": read_midi,
+    ".midi": read_midi,
+    ".xml": read_musicxml,
+    ".musicxml": read_musicxml,
+    ".mxl": read_musicxml,
+}
+
+def read_piece_file(path):
+    # reads a file of any supported kind (by its extension), the file name is
+    # the default title
+    name, extension = os.path.splitext(os.path.basename(path))
+    extension = extension.lower()
+    if extension not in IMPORTERS:
+        raise PieceImportError("Unsupported file type: {}".format(extension))
+    if extension == ".mxl":
+        try:
+            with zipfile.ZipFile(path) as archive:
+                with archive.open(_mxl_root(archive)) as stream:
+                    return read_musicxml(stream, name)
+        except (zipfile.BadZipFile, KeyError) as e:
+            raise PieceImportError(
+                "Invalid compressed MusicXML file ({})".format(e))
+    with open(path, "rb") as stream:
+        return IMPORTERS[extension](stream, name)
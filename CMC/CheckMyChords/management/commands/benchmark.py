@@ -0,0 +1,173 @@
+import json
+import platform
+import random
+from statistics import median
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template.loader import render_to_string
+
+from CheckMyChords.harmony_rules import (
+    ENGINE_VERSION,
+    RULE_REGISTRY,
+    VOICE_RANGES,
+    VOICES,
+    Piece,
+)
+from CheckMyChords.forms import SelectRulesForm
+from CheckMyChords.midi_rendering import render_midi
+from CheckMyChords.models import MusicPiece
+from CheckMyChords.notation import midi_to_str, parse_notes
+
+
+# chords of the "realistic" pieces - (degree of the scale, intervals above
+# the root) in C major, and chords which may follow each chord
+_CHORDS = {
+    "I": (0, (0, 4, 7)),
+    "II": (2, (0, 3, 7)),
+    "IV": (5, (0, 4, 7)),
+    "V": (7, (0, 4, 7)),
+    "V7": (7, (0, 4, 7, 10)),
+    "VI": (9, (0, 3, 7)),
+}
+_PROGRESSIONS = {
+    "I": ("I", "II", "IV", "V", "V7", "VI"),
+    "II": ("V", "V7"),
+    "IV": ("I", "II", "V", "V7"),
+    "V": ("I", "VI"),
+    "V7": ("I", "VI"),
+    "VI": ("II", "IV"),
+}
+
+
+def random_parts(length, rng):
+    # random notes within the voice ranges (most chords are not recognised)
+    return [[rng.randint(*VOICE_RANGES[voice]) for i in range(length)]
+            for voice in VOICES]
+
+def _nearest(pitch_classes, previous, low, high):
+    # note of one of pitch_classes within low..high, nearest to previous
+    candidates = [note for note in range(low, high + 1)
+                  if note % 12 in pitch_classes]
+    return min(candidates, key=lambda note: abs(note - previous))
+
+def realistic_parts(length, rng):
+    # chord progressions in a random key, each voice moves to the nearest
+    # note of the next chord (mostly correct, with some mistakes)
+    tonic = rng.randrange(12)
+    chord = "I"
+    notes = [72, 64, 55, 48]
+    parts = [[] for voice in VOICES]
+    for i in range(length):
+        degree, intervals = _CHORDS[chord]
+        root = (tonic + degree) % 12
+        pitch_classes = {(root + interval) % 12 for interval in intervals}
+        low, high = VOICE_RANGES["B"]
+        bass = _nearest({root}, notes[3], low, high)
+        new_notes = [bass]
+        for row in (2, 1, 0):
+            low, high = VOICE_RANGES[VOICES[row]]
+            new_notes.insert(0, _nearest(pitch_classes, notes[row],
+                                         max(low, new_notes[0]), high))
+        notes = new_notes
+        for part, note in zip(parts, notes):
+            part.append(note)
+        chord = rng.choice(_PROGRESSIONS[chord])
+    return parts
+
+GENERATORS = {"random": random_parts, "realistic": realistic_parts}
+
+
+def _time(function, repeat):
+    # times of the calls, caches of parsed notes are cleared before each call
+    times = []
+    for i in range(repeat):
+        parse_notes.cache_clear()
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+    return times
+
+
+class Command(BaseCommand):
+    help = ('Times the stages of checking harmony on generated pieces and '
+            'writes the results (beats per second) as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lengths', nargs='+', type=int,
+            default=[10, 100, 1000, 10000, 100000],
+            help='Lengths of the generated pieces (in beats)',
+        )
+        parser.add_argument(
+            '--kinds', nargs='+', choices=sorted(GENERATORS),
+            default=sorted(GENERATORS),
+            help='random - random notes, realistic - chord progressions',
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=5,
+            help='Number of times each stage is run (the best time is used)',
+        )
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--output', default='-',
+            help='Output file (stdout by default)',
+        )
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1 or min(options['lengths']) < 1:
+            raise CommandError('--repeat and --lengths must be positive')
+        results = []
+        for kind in options['kinds']:
+            for length in options['lengths']:
+                rng = random.Random(options['seed'])
+                parts = GENERATORS[kind](length, rng)
+                strings = [" ".join(map(midi_to_str, part)) for part in parts]
+                for stage, times in self.stages(strings, options['repeat']):
+                    best = min(times)
+                    results.append({
+                        "kind": kind,
+                        "beats": length,
+                        "stage": stage,
+                        "best_s": best,
+                        "median_s": median(times),
+                        "beats_per_s": length / best if best else None,
+                    })
+                self.stderr.write('{} {}: done'.format(kind, length))
+        report = {
+            "engine_version": ENGINE_VERSION,
+            "python": platform.python_version(),
+            "seed": options['seed'],
+            "repeat": options['repeat'],
+            "results": results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output'] == '-':
+            self.stdout.write(output)
+        else:
+            with open(options['output'], 'w') as f:
+                f.write(output + "\n")
+
+    def stages(self, strings, repeat):
+        # yields (stage, times) - Piece construction (parsing notes, reading
+        # chords and the key), each rule, rendering (of the score and of the
+        # whole check_piece page) and MIDI generation
+        music_piece = MusicPiece(title="Benchmark", soprano=strings[0],
+                                 alto=strings[1], tenor=strings[2],
+                                 bass=strings[3])
+        yield "piece", _time(lambda: Piece(music_piece), repeat)
+        for rule in RULE_REGISTRY.values():
+            pieces = [Piece(music_piece) for i in range(repeat)]
+            yield "rule:" + rule.code, _time(
+                lambda: rule.check(pieces.pop()), repeat)
+        piece = Piece(music_piece)
+        yield "functions_hr", _time(lambda: piece.functions_hr, repeat)
+        yield "parts_hr", _time(lambda: piece.parts_hr, repeat)
+        yield "score_hr", _time(lambda: piece.score_hr, repeat)
+        piece.check_harmony()
+        form = SelectRulesForm()
+        yield "page", _time(
+            lambda: render_to_string('check_piece.html',
+                                     {'piece': piece, 'form': form}),
+            repeat)
+        yield "midi", _time(lambda: render_midi(strings), repeat)
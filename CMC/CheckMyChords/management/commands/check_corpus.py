@@ -0,0 +1,135 @@
+import csv
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from CheckMyChords.harmony_rules import RULES
+from CheckMyChords.management.parallel import chunks, map_chunks, setup_worker
+from CheckMyChords.models import MusicPiece
+
+
+FIELDS = ('id', 'title', 'soprano', 'alto', 'tenor', 'bass')
+
+
+def check_rows(rows, rules, counts_only=False):
+    # checks a chunk of pieces (run in worker processes - gets plain values
+    # instead of model instances and doesn't touch the database). With
+    # counts_only messages of the mistakes are not made at all
+    setup_worker()
+    from CheckMyChords.harmony_rules import check_harmony_rules
+
+    results = []
+    for row in rows:
+        values = dict(zip(FIELDS, row))
+        result = {"id": values["id"], "title": values["title"]}
+        try:
+            piece = check_harmony_rules(MusicPiece(**values), rules)
+        except ValueError as e:  # wrong notation or parts' lengths
+            result["error"] = str(e)
+        else:
+            result.update({
+                "key": piece.key_hr,
+                "err_count": piece.err_count,
+                "war_count": piece.war_count,
+                "rule_counts": piece.rule_counts,
+            })
+            if not counts_only:
+                result["errors"] = piece.err_detailed
+                result["warnings"] = piece.war_detailed
+        results.append(result)
+    return results
+
+
+class JsonLinesWriter(object):
+    def __init__(self, stream, rules):
+        self.stream = stream
+
+    def write(self, result):
+        self.stream.write(json.dumps(result) + "\n")
+
+
+class CsvWriter(object):
+    # one row per piece - total counts and counts of each rule
+    def __init__(self, stream, rules):
+        self.rules = [rule for rule in RULES if 'ALL' in rules or rule in rules]
+        columns = ['id', 'title', 'key', 'err_count', 'war_count', 'error']
+        for rule in self.rules:
+            columns += [rule + '_errors', rule + '_warnings']
+        self.writer = csv.DictWriter(stream, columns)
+        self.writer.writeheader()
+
+    def write(self, result):
+        row = {column: result.get(column, '')
+               for column in self.writer.fieldnames}
+        for rule, counts in result.get("rule_counts", {}).items():
+            row[rule + '_errors'], row[rule + '_warnings'] = counts
+        self.writer.writerow(row)
+
+
+class Command(BaseCommand):
+    help = ('Checks harmony of all the pieces in the database (in parallel) '
+            'and writes the results as JSON Lines or CSV')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rules', nargs='+', default=['ALL'],
+            choices=['ALL'] + list(RULES),
+            help='Rules to check (all by default)',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of worker processes (all cores by default)',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=100,
+            help='Number of pieces sent to a worker at once',
+        )
+        parser.add_argument(
+            '--format', choices=['jsonl', 'csv'], default='jsonl',
+        )
+        parser.add_argument(
+            '--output', default='-',
+            help='Output file (stdout by default)',
+        )
+        parser.add_argument(
+            '--public-only', action='store_true',
+            help='Check only public pieces',
+        )
+        parser.add_argument(
+            '--counts-only', action='store_true',
+            help='Write only counts of mistakes, without their messages '
+                 '(always with --format csv)',
+        )
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['chunk_size'] < 1:
+            raise CommandError('--workers and --chunk-size must be positive')
+        rules = options['rules']
+        counts_only = options['counts_only'] or options['format'] == 'csv'
+        pieces = MusicPiece.objects.order_by('id')
+        if options['public_only']:
+            pieces = pieces.filter(is_public=True)
+        # rows are streamed from the database (voice columns only, without
+        # model instances) and sent to the workers in chunks
+        rows = pieces.values_list(*FIELDS).iterator()
+        row_chunks = chunks(rows, options['chunk_size'])
+
+        if options['output'] == '-':
+            stream = self.stdout
+        else:
+            stream = open(options['output'], 'w', newline='')
+        writer_class = CsvWriter if options['format'] == 'csv' \
+            else JsonLinesWriter
+        writer = writer_class(stream, rules)
+        count = 0
+        try:
+            for results in map_chunks(check_rows, row_chunks,
+                                      options['workers'], rules, counts_only):
+                for result in results:
+                    writer.write(result)
+                count += len(results)
+        finally:
+            if stream is not self.stdout:
+                stream.close()
+        self.stderr.write('Checked {} pieces'.format(count))
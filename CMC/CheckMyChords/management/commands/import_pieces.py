@@ -0,0 +1,126 @@
+import os
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from CheckMyChords.analysis import update_analysis
+from CheckMyChords.importers import IMPORTERS
+from CheckMyChords.management.parallel import chunks, map_chunks, setup_worker
+from CheckMyChords.models import MusicPiece
+
+
+def read_files(paths):
+    # reads and validates a chunk of files (run in worker processes), returns
+    # [(path, MusicPiece fields or None, error or None)]
+    setup_worker()
+    from CheckMyChords.forms import PartsForm
+    from CheckMyChords.importers import read_piece_file
+
+    results = []
+    for path in paths:
+        try:
+            piece = read_piece_file(path)
+        except (OSError, ValueError) as e:
+            results.append((path, None, str(e)))
+            continue
+        form = PartsForm(piece)
+        if not form.is_valid():
+            errors = [error for field_errors in form.errors.values()
+                      for error in field_errors]
+            results.append((path, None, "; ".join(errors)))
+            continue
+        results.append((path, piece, None))
+    return results
+
+def find_files(paths):
+    # supported files (see IMPORTERS) given or found in the directories
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in IMPORTERS:
+                    yield os.path.join(directory, name)
+
+
+class Command(BaseCommand):
+    help = ('Imports pieces from MIDI (format 1) and MusicXML files - files '
+            'are read and validated in parallel, pieces are stored in '
+            'batches')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='+',
+            help='Files or directories (searched for .mid, .midi, .xml, '
+                 '.musicxml and .mxl files)',
+        )
+        parser.add_argument(
+            '--author', required=True,
+            help='Username of the author of the imported pieces',
+        )
+        parser.add_argument(
+            '--public', action='store_true',
+            help='Make the imported pieces public',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of worker processes (all cores by default)',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=50,
+            help='Number of files sent to a worker at once',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of pieces stored at once',
+        )
+        parser.add_argument(
+            '--skip-analysis', action='store_true',
+            help="Don't analyse the imported pieces (update_analyses can do "
+                 "it later)",
+        )
+
+    def handle(self, *args, **options):
+        if min(options['workers'], options['chunk_size'],
+               options['batch_size']) < 1:
+            raise CommandError(
+                '--workers, --chunk-size and --batch-size must be positive')
+        try:
+            author = User.objects.get(username=options['author'])
+        except User.DoesNotExist:
+            raise CommandError(
+                'User "{}" does not exist'.format(options['author']))
+        file_chunks = chunks(find_files(options['paths']),
+                             options['chunk_size'])
+        batch = []
+        imported = 0
+        failed = 0
+        for results in map_chunks(read_files, file_chunks,
+                                  options['workers']):
+            for path, piece, error in results:
+                if error is not None:
+                    self.stderr.write('{}: {}'.format(path, error))
+                    failed += 1
+                    continue
+                batch.append(MusicPiece(author=author,
+                                        is_public=options['public'], **piece))
+                if len(batch) >= options['batch_size']:
+                    imported += self.store(batch)
+        imported += self.store(batch)
+        if not options['skip_analysis']:
+            # bulk_create doesn't send post_save - the pieces are analysed
+            # here
+            pieces = MusicPiece.objects.filter(author=author,
+                                               analysis__isnull=True)
+            for piece in pieces.iterator():
+                update_analysis(piece)
+        self.stdout.write('Imported {} pieces ({} files failed)'.format(
+            imported, failed))
+
+    def store(self, batch):
+        count = len(batch)
+        MusicPiece.objects.bulk_create(batch)
+        del batch[:]
+        return count
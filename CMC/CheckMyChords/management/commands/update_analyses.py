@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from CheckMyChords.analysis import update_analysis
+from CheckMyChords.models import MusicPiece
+
+
+class Command(BaseCommand):
+    # Should be run after RULE_VERSIONS or ANALYSIS_VERSION are increased -
+    # checks again only the rules which changed
+    help = 'Updates stored analyses of all the pieces'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Check all the rules again, even if they did not change',
+        )
+
+    def handle(self, *args, **options):
+        pieces = MusicPiece.objects.select_related('analysis')
+        count = 0
+        for piece in pieces.iterator():
+            update_analysis(piece, force=options['force'])
+            count += 1
+        self.stdout.write('Updated analyses of {} pieces'.format(count))
@@ -0,0 +1,40 @@
+# Runs a function on chunks of items in worker processes - shared by the
+# commands processing many pieces (check_corpus, import_pieces)
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+def setup_worker():
+    # should be called first by functions run in the workers - workers
+    # started with 'spawn' have to set Django up (fork inherits setup)
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+def chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def map_chunks(function, chunks, workers, *args):
+    # yields function(chunk, *args) for the chunks in order. At most 2 chunks
+    # per worker are queued, so memory use doesn't depend on the number of
+    # items. With a single worker chunks are processed in this process
+    if workers == 1:
+        for chunk in chunks:
+            yield function(chunk, *args)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(function, chunk, *args))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
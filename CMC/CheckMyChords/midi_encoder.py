@@ -0,0 +1,46 @@
+# Encodes pieces as Standard MIDI Files (format 1) straight from midi numbers
+# of the notes - without pyknon objects and without writing files. The result
+# is the same kind of file pyknon's Midi(4, tempo=90) writes: a track for each
+# part (on its own channel, piano), every note lasts a beat.
+import struct
+from io import BytesIO
+
+
+TICKS_PER_BEAT = 960
+VELOCITY = 120  # volume pyknon gives to the parsed notes
+
+
+def _varlen(value):
+    # variable-length quantity (7 bits per byte, the most significant first)
+    result = bytearray((value & 0x7F,))
+    value >>= 7
+    while value:
+        result.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(result)
+
+def _track(events):
+    # events - bytes of the events (with delta times), end of track added
+    data = b"".join(events) + b"\x00\xff\x2f\x00"
+    return b"MTrk" + struct.pack(">I", len(data)) + data
+
+def _part_events(channel, midi_numbers, tempo):
+    if channel == 0:
+        # tempo (microseconds per beat) is set in the first track
+        yield b"\x00\xff\x51\x03" + struct.pack(">I", 60000000 // tempo)[1:]
+    yield bytes((0x00, 0xC0 | channel, 0))  # program change - piano
+    note_on = 0x90 | channel
+    note_off = 0x80 | channel
+    duration = _varlen(TICKS_PER_BEAT)
+    for midi_number in midi_numbers:
+        yield bytes((0x00, note_on, midi_number, VELOCITY))
+        yield duration + bytes((note_off, midi_number, 0))
+
+def encode_midi(parts, tempo=90):
+    # parts - sequences of midi numbers (a track for each), returns bytes
+    buffer = BytesIO()
+    buffer.write(b"MThd" + struct.pack(">IHHH", 6, 1, len(parts),
+                                       TICKS_PER_BEAT))
+    for channel, midi_numbers in enumerate(parts):
+        buffer.write(_track(_part_events(channel, midi_numbers, tempo)))
+    return buffer.getvalue()
@@ -0,0 +1,115 @@
+# Renders MIDI files of the pieces in memory (see midi_encoder) - nothing is
+# written to MEDIA_ROOT. Encoded files are kept in a LRU cache limited by
+# size (MIDI_CACHE_MAX_BYTES, 0 turns it off). Each file is rendered only once
+# at a time - concurrent requests for the same piece wait for the first one
+# (single-flight). Harmony is not analysed - notes are parsed straight from
+# the parts.
+import re
+import unicodedata
+from collections import OrderedDict
+from threading import Event, Lock
+from urllib.parse import quote
+
+from django.conf import settings
+
+from CheckMyChords.midi_encoder import encode_midi
+from CheckMyChords.notation import parse_notes
+
+
+# should be increased whenever the encoded files change (part of the ETag)
+MIDI_VERSION = 1
+_in_flight = {}  # key -> _Rendering
+_lock = Lock()
+
+
+class _Rendering(object):
+    # a rendering in progress, data is set when it's finished
+    def __init__(self):
+        self.done = Event()
+        self.data = None
+
+
+class _BytesLRU(object):
+    # least recently used entries are removed when the total size of the
+    # values exceeds max_bytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        if key in self._data:
+            self.size -= len(self._data.pop(key))
+        self._data[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            self.size -= len(self._data.popitem(last=False)[1])
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+_cache = _BytesLRU(getattr(settings, 'MIDI_CACHE_MAX_BYTES', 0))
+
+
+def midi_filename(music_piece):
+    return '{}_{}.mid'.format(music_piece.id, music_piece.title)
+
+def midi_content_disposition(music_piece):
+    # Content-Disposition of the file - the title may contain any characters:
+    # an ASCII name (other characters replaced) for older browsers and the
+    # whole name encoded as in RFC 6266
+    filename = midi_filename(music_piece)
+    fallback = "".join(char for char in unicodedata.normalize('NFKD', filename)
+                       if not unicodedata.combining(char))  # accents
+    fallback = re.sub(r'[^A-Za-z0-9 ._-]', '_', fallback)
+    return "attachment; filename=\"{}\"; filename*=UTF-8''{}".format(
+        fallback, quote(filename, safe=''))
+
+def midi_etag(music_piece):
+    # the file depends only on the parts
+    return '"{}-{}"'.format(MIDI_VERSION, music_piece.parts_hash)
+
+def render_midi(parts):
+    # parts - strings (soprano, alto, tenor, bass), a track for each part
+    return encode_midi([parse_notes(part) for part in parts], tempo=90)
+
+def midi_bytes(music_piece):
+    # the encoded file of a piece (cached)
+    key = midi_etag(music_piece)
+    while True:
+        with _lock:
+            data = _cache.get(key)
+            if data is not None:
+                return data
+            rendering = _in_flight.get(key)
+            if rendering is None:
+                rendering = _in_flight[key] = _Rendering()
+                break
+        # rendered by another thread - wait for its result
+        rendering.done.wait()
+        if rendering.data is not None:
+            return rendering.data
+        # the rendering failed - try again
+    try:
+        rendering.data = render_midi((music_piece.soprano, music_piece.alto,
+                                      music_piece.tenor, music_piece.bass))
+        with _lock:
+            _cache.set(key, rendering.data)
+        return rendering.data
+    finally:
+        with _lock:
+            del _in_flight[key]
+        rendering.done.set()
+
+def clear_midi_cache():
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.6 on 2026-10-18 11:34
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CheckMyChords', '0004_musicpiece_is_public'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PieceAnalysis',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+                ('parts_hash', models.CharField(max_length=40)),
+                ('analysis_version', models.PositiveIntegerField(default=0)),
+                ('key', models.CharField(max_length=16)),
+                ('chords', models.TextField(default='[]')),
+                ('rule_counts', models.TextField(default='{}')),
+                ('rule_versions', models.TextField(default='{}')),
+                ('err_count', models.PositiveIntegerField(default=0)),
+                ('war_count', models.PositiveIntegerField(default=0)),
+                ('piece', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='analysis', to='CheckMyChords.MusicPiece')),
+            ],
+        ),
+    ]
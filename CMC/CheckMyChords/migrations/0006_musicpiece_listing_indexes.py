@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.6 on 2026-10-18 11:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CheckMyChords', '0005_pieceanalysis'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='musicpiece',
+            index=models.Index(fields=['is_public', 'date_added'], name='CheckMyChor_is_publ_6f3d09_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='musicpiece',
+            index=models.Index(fields=['author', 'date_added'], name='CheckMyChor_author__aa9e93_idx'),
+        ),
+    ]
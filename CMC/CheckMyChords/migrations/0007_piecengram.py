@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.6 on 2026-10-18 12:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CheckMyChords', '0006_musicpiece_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PieceNGram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gram', models.CharField(max_length=64)),
+                ('count', models.PositiveIntegerField(default=1)),
+                ('piece', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ngrams', to='CheckMyChords.MusicPiece')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='piecengram',
+            index=models.Index(fields=['gram', 'piece'], name='CheckMyChor_gram_0a9b78_idx'),
+        ),
+    ]
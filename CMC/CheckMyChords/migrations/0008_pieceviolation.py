@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.6 on 2026-10-18 12:05
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('CheckMyChords', '0007_piecengram'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PieceViolation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_added', models.DateTimeField()),
+                ('rule', models.CharField(max_length=16)),
+                ('severity', models.CharField(max_length=8)),
+                ('beat', models.PositiveIntegerField()),
+                ('voices', models.CharField(max_length=8)),
+                ('detail', models.CharField(max_length=32)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('piece', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='violations', to='CheckMyChords.MusicPiece')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='pieceviolation',
+            index=models.Index(fields=['rule', 'voices', 'detail'], name='CheckMyChor_rule_afed83_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pieceviolation',
+            index=models.Index(fields=['author', 'rule'], name='CheckMyChor_author__f440af_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pieceviolation',
+            index=models.Index(fields=['date_added', 'rule'], name='CheckMyChor_date_ad_caf625_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.6 on 2026-10-18 12:33
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CheckMyChords', '0008_pieceviolation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='pieceviolation',
+            index=models.Index(fields=['piece', 'beat'], name='CheckMyChor_piece_i_6aedf0_idx'),
+        ),
+    ]
@@ -1,3 +1,6 @@
+import json
+from hashlib import sha1
+
 from django.db import models
 from django.contrib.auth.models import User
 
@@ -19,3 +22,100 @@ class MusicPiece(models.Model):
     #     add a CharField storing a key
     #     ? add a filefield? (and store a midi?)
 
+    class Meta:
+        # for listing public pieces and pieces of a user (newest first)
+        indexes = [
+            models.Index(fields=['is_public', 'date_added']),
+            models.Index(fields=['author', 'date_added']),
+        ]
+
+    @property
+    def parts_hash(self):
+        # identifies the notes of a piece (pieces with the same parts have
+        # the same hash)
+        content = "\n".join((self.soprano, self.alto, self.tenor, self.bass))
+        return sha1(content.encode("utf-8")).hexdigest()
+
+
+class PieceAnalysis(models.Model):
+    # Results of checking a MusicPiece using all the rules, stored when the
+    # piece is saved (see analysis.update_analysis), so that the pieces don't
+    # have to be checked again e.g. to be listed
+    piece = models.OneToOneField(
+        MusicPiece,
+        on_delete = models.CASCADE,
+        related_name = 'analysis'
+    )
+    date_updated = models.DateTimeField(auto_now=True)
+    parts_hash = models.CharField(max_length=40)
+    analysis_version = models.PositiveIntegerField(default=0)
+    key = models.CharField(max_length=16)  # human-readable, e.g. "C major"
+    # JSON: [[root, mode, function], ...] - one list per chord
+    chords = models.TextField(default="[]")
+    # JSON: {rule: [err_count, war_count]} and {rule: version of the rule}
+    rule_counts = models.TextField(default="{}")
+    rule_versions = models.TextField(default="{}")
+    err_count = models.PositiveIntegerField(default=0)
+    war_count = models.PositiveIntegerField(default=0)
+
+    @property
+    def chords_list(self):
+        return json.loads(self.chords)
+
+    @property
+    def rule_counts_dict(self):
+        return json.loads(self.rule_counts)
+
+    @property
+    def rule_versions_dict(self):
+        return json.loads(self.rule_versions)
+
+
+
+class PieceNGram(models.Model):
+    # Inverted index of the pieces (see search.py) - an n-gram of harmonic
+    # functions or of voice motions, and how many times it occurs in a piece
+    piece = models.ForeignKey(
+        MusicPiece,
+        on_delete = models.CASCADE,
+        related_name = 'ngrams'
+    )
+    gram = models.CharField(max_length=64)
+    count = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        # pieces containing an n-gram (the inverted list)
+        indexes = [
+            models.Index(fields=['gram', 'piece']),
+        ]
+
+
+class PieceViolation(models.Model):
+    # A mistake found in a piece (see harmony_rules.Violation), stored with
+    # its analysis - so that mistakes can be counted in the database. Author
+    # and date of the piece are copied for statistics by author and by time
+    piece = models.ForeignKey(
+        MusicPiece,
+        on_delete = models.CASCADE,
+        related_name = 'violations'
+    )
+    author = models.ForeignKey(
+        User,
+        on_delete = models.CASCADE,
+        related_name = '+'
+    )
+    date_added = models.DateTimeField()
+    rule = models.CharField(max_length=16)
+    severity = models.CharField(max_length=8)
+    beat = models.PositiveIntegerField()  # index of the chord (from 0)
+    voices = models.CharField(max_length=8)
+    detail = models.CharField(max_length=32)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['rule', 'voices', 'detail']),
+            models.Index(fields=['author', 'rule']),
+            models.Index(fields=['date_added', 'rule']),
+            # mistakes in the chords of a piece checked again after an edit
+            models.Index(fields=['piece', 'beat']),
+        ]
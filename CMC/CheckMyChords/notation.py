@@ -0,0 +1,91 @@
+# Parses (and writes) notes in the notation used by CMC - the same notation
+# pyknon uses, but without durations and rests. A note is written as:
+#   a note name (C-B, upper or lower case),
+#   optional accidentals (# - sharp, b - flat, e.g. "F#", "Bbb"),
+#   optional octave marks (' - octaves from middle C upwards, , - octaves
+#   below middle C, e.g. "C'" == middle C, "C," == an octave lower). A note
+#   without octave marks is in the octave of the previous note.
+# Notes are separated with whitespace.
+# Notes are turned straight into midi numbers (middle C == 60), without
+# building pyknon objects. The results are compatible with pyknon's NoteSeq
+# (e.g. "Cb'" == 71, as accidentals don't change the octave in pyknon).
+import re
+from functools import lru_cache
+
+
+NOTE_NAMES = ("C","C#","D","D#","E","F","F#","G","G#","A","A#","B")
+_NOTE_VALUES = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11,
+                "c": 0, "d": 2, "e": 4, "f": 5, "g": 7, "a": 9, "b": 11}
+_FIRST_OCTAVE = 5  # octave of a note without marks at the beginning
+# a note followed by whitespace (or the end of the string), anything else is
+# an invalid token
+_TOKENS = re.compile(r"""
+    ([A-Ga-g])(\#+|b+)?('+|,+)?(?=\s|$)
+    |(\S+)
+""", re.VERBOSE)
+
+
+class NotationError(ValueError):
+    # raised for the first invalid token, column counts from 1
+    def __init__(self, message, token, column):
+        self.message = message
+        self.token = token
+        self.column = column
+        super(NotationError, self).__init__(
+            "{}: '{}' (column {})".format(message, token, column))
+
+
+def _invalid_token(token, column):
+    if 'h' in token or 'H' in token:
+        return NotationError("Use english notation!", token, column)
+    elif token[0] in 'rR':
+        return NotationError("Rests not allowed!", token, column)
+    else:
+        return NotationError("Wrong notation", token, column)
+
+def iter_notes(string):
+    # yields midi numbers of the notes in the string, raises NotationError
+    # when an invalid token is reached
+    octave = _FIRST_OCTAVE
+    for match in _TOKENS.finditer(string):
+        name, accidentals, marks, invalid = match.groups()
+        if invalid is not None:
+            raise _invalid_token(invalid, match.start(4) + 1)
+        value = _NOTE_VALUES[name]
+        if accidentals:
+            if accidentals[0] == "#":
+                value += len(accidentals)
+            else:
+                value -= len(accidentals)
+        if marks:
+            if marks[0] == "'":
+                octave = _FIRST_OCTAVE - 1 + len(marks)
+            else:
+                octave = _FIRST_OCTAVE - len(marks)
+        midi_number = value % 12 + octave * 12
+        if not 0 <= midi_number <= 127:
+            raise NotationError("Note out of range", match.group(0),
+                                match.start() + 1)
+        yield midi_number
+
+@lru_cache(maxsize=256)
+def parse_notes(string):
+    # midi numbers of all the notes (as a touple). Results are cached, so
+    # the validator, the form and Piece parse a submitted part only once
+    return tuple(iter_notes(string))
+
+def midi_to_str(midi_number):
+    # a note in CMC notation (parsable back by parse_notes)
+    octave = midi_number // 12
+    if octave < _FIRST_OCTAVE:
+        marks = "," * (_FIRST_OCTAVE - octave)
+    else:
+        marks = "'" * (octave - _FIRST_OCTAVE + 1)
+    return NOTE_NAMES[midi_number % 12] + marks
+
+def midi_to_hrstr(midi_number):
+    # human readable str of a note: in english notation (C4 == 'middle' C),
+    # padded to 3 characters
+    val = NOTE_NAMES[midi_number % 12]
+    space = "" if len(val) == 2 else " "
+    return "{}{}{}".format(val, midi_number // 12 - 1, space)
@@ -0,0 +1,62 @@
+# Timing of the harmony rules - every rule checked by Piece.check_harmony is
+# timed and counted here (per process). Stats can be read with rule_stats
+# (or at debug/rule_stats), hooks added with add_timing_hook get every
+# measurement (e.g. to send it to a monitoring service)
+from bisect import bisect_left
+from threading import Lock
+
+
+# upper bounds of the histogram buckets (in milliseconds), the last bucket
+# is for everything slower
+BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+_stats = {}
+_stats_lock = Lock()
+_hooks = []
+
+
+def _new_stats():
+    return {
+        "calls": 0,
+        "chords": 0,
+        "total_ms": 0.0,
+        "max_ms": 0.0,
+        "histogram": [0] * (len(BUCKETS_MS) + 1),
+    }
+
+def record_rule_time(rule, seconds, chords):
+    # called after each rule is checked, chords - length of the piece
+    ms = seconds * 1000
+    with _stats_lock:
+        stats = _stats.get(rule)
+        if stats is None:
+            stats = _stats[rule] = _new_stats()
+        stats["calls"] += 1
+        stats["chords"] += chords
+        stats["total_ms"] += ms
+        stats["max_ms"] = max(stats["max_ms"], ms)
+        stats["histogram"][bisect_left(BUCKETS_MS, ms)] += 1
+    for hook in _hooks:
+        hook(rule, seconds, chords)
+
+def rule_stats():
+    # stats of each rule (since start or reset_rule_stats) with the average
+    # time of a call and of a chord
+    result = {}
+    with _stats_lock:
+        for rule, stats in _stats.items():
+            stats = dict(stats, histogram=list(stats["histogram"]))
+            stats["avg_ms"] = stats["total_ms"] / stats["calls"]
+            stats["ms_per_chord"] = stats["total_ms"] / max(stats["chords"], 1)
+            result[rule] = stats
+    return result
+
+def reset_rule_stats():
+    with _stats_lock:
+        _stats.clear()
+
+def add_timing_hook(hook):
+    # hook(rule, seconds, chords) is called after each rule is checked
+    _hooks.append(hook)
+
+def remove_timing_hook(hook):
+    _hooks.remove(hook)
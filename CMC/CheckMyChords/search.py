@@ -0,0 +1,221 @@
+# Search in the stored pieces - an inverted index (PieceNGram) of n-grams
+# which don't depend on transposition: harmonic functions of consecutive
+# chords (each in its key) and motions of the voices (in semitones) between
+# them. Pieces containing a pattern are found by intersecting the inverted
+# lists of its n-grams (and checked afterwards), similar pieces - by the
+# n-grams they share with a piece. The index of a piece is updated together
+# with its analysis (see analysis.update_analysis and analysis.patch_piece)
+import math
+from collections import Counter
+
+from django.db.models import Count, Sum
+
+from CheckMyChords.models import MusicPiece, PieceNGram
+from CheckMyChords.notation import parse_notes
+
+
+FUNCTION_NGRAMS = (2, 3)  # lengths of n-grams of functions (in chords)
+MOTION_NGRAMS = (1, 2)  # lengths of n-grams of voice motions (in moves)
+# n-grams of more than this part of the pieces (but at least
+# MIN_DOCUMENT_FREQUENCY pieces) are too common to tell similar pieces
+MAX_DOCUMENT_FREQUENCY = 0.2
+MIN_DOCUMENT_FREQUENCY = 10
+_QUERY_CHUNK = 500  # n-grams in a single query (SQLite limits parameters)
+
+
+def function_labels(functions):
+    # functions - list of str (see Piece._functions), "?" - unknown chords
+    return [function or "?" for function in functions]
+
+def voice_motions(parts):
+    # moves of the voices between consecutive chords - (S, A, T, B) in
+    # semitones, parts - midi numbers of the voices
+    return list(zip(*[[b - a for a, b in zip(part, part[1:])]
+                      for part in parts]))
+
+def motion_label(motion):
+    return " ".join("{:+d}".format(move) for move in motion)
+
+def _ngrams(prefix, labels, lengths, separator):
+    grams = Counter()
+    for n in lengths:
+        for i in range(len(labels) - n + 1):
+            grams[prefix + separator.join(labels[i:i + n])] += 1
+    return grams
+
+def piece_ngrams(functions, parts):
+    # Counter of the n-grams of a piece: "f:T S D", "m:+2 +1 +0 -5/..."
+    return _ngrams("f:", function_labels(functions), FUNCTION_NGRAMS, " ") \
+        + _ngrams("m:", [motion_label(motion)
+                         for motion in voice_motions(parts)],
+                  MOTION_NGRAMS, "/")
+
+def piece_sequences(piece):
+    # what the n-grams of a Piece (with chords and keys already found) are
+    # made of - functions and parts (see piece_ngrams)
+    return piece._functions(), [piece._row(row) for row in range(4)]
+
+def window_ngrams(functions, parts, start, stop):
+    # Counter of the n-grams (see piece_ngrams) containing any of the chords
+    # start..stop-1 - those of the chords around them less those which end
+    # before start or begin at stop
+    reach = max(max(FUNCTION_NGRAMS), max(MOTION_NGRAMS) + 1) - 1
+    first = max(start - reach, 0)
+    last = min(stop + reach, len(functions))
+
+    def grams(start, stop):
+        return piece_ngrams(functions[start:stop],
+                            [part[start:stop] for part in parts])
+
+    return grams(first, last) - grams(first, start) - grams(stop, last)
+
+def index_piece(music_piece, piece):
+    # replaces the n-grams of a music_piece, piece - the same piece as a
+    # Piece (with chords and keys already found)
+    grams = piece_ngrams(*piece_sequences(piece))
+    PieceNGram.objects.filter(piece=music_piece).delete()
+    PieceNGram.objects.bulk_create(
+        PieceNGram(piece=music_piece, gram=gram, count=count)
+        for gram, count in grams.items()
+    )
+
+def update_index(music_piece, old, new):
+    # changes the n-grams of a music_piece after an edit, old and new -
+    # Counters of the n-grams of the edited chords (see window_ngrams)
+    change = Counter(new)
+    change.subtract(old)
+    change = {gram: count for gram, count in change.items() if count}
+    rows = {}
+    for chunk in _chunks(change):
+        rows.update((row.gram, row) for row in PieceNGram.objects.filter(
+            piece=music_piece, gram__in=chunk))
+    added = []
+    removed = []
+    for gram, count in change.items():
+        row = rows.get(gram)
+        if row is None:
+            added.append(PieceNGram(piece=music_piece, gram=gram,
+                                    count=count))
+        elif row.count + count > 0:
+            row.count += count
+            row.save(update_fields=['count'])
+        else:
+            removed.append(row.id)
+    for chunk in _chunks(removed):
+        PieceNGram.objects.filter(id__in=chunk).delete()
+    PieceNGram.objects.bulk_create(added)
+
+def _chunks(items):
+    items = list(items)
+    for i in range(0, len(items), _QUERY_CHUNK):
+        yield items[i:i + _QUERY_CHUNK]
+
+def _containing(grams, pieces):
+    # pieces having all the n-grams (intersection of their inverted lists)
+    grams = set(grams)
+    found = PieceNGram.objects.filter(gram__in=grams).values('piece') \
+        .annotate(found=Count('gram')).filter(found=len(grams)) \
+        .values('piece')
+    return pieces.filter(id__in=found)
+
+def _positions(sequence, pattern):
+    # indexes (from 1) where the pattern starts in the sequence
+    n = len(pattern)
+    return [i + 1 for i in range(len(sequence) - n + 1)
+            if sequence[i:i + n] == pattern]
+
+def find_progression(functions, pieces=None, limit=50):
+    # [(piece, [numbers of the chords where it starts])] - pieces (from the
+    # pieces queryset) with a progression of functions (at least 2, "" or "?"
+    # - an unknown chord)
+    labels = function_labels(functions)
+    if len(labels) < 2:
+        raise ValueError("A progression needs at least 2 chords")
+    n = min(len(labels), max(FUNCTION_NGRAMS))
+    grams = ["f:" + " ".join(labels[i:i + n])
+             for i in range(len(labels) - n + 1)]
+    if pieces is None:
+        pieces = MusicPiece.objects.all()
+    results = []
+    candidates = _containing(grams, pieces).select_related('analysis') \
+        .order_by('id')
+    for music_piece in candidates.iterator():
+        positions = _positions(function_labels(
+            [chord[2] for chord in music_piece.analysis.chords_list]), labels)
+        if positions:
+            results.append((music_piece, positions))
+            if len(results) == limit:
+                break
+    return results
+
+def find_voice_leading(motions, pieces=None, limit=50):
+    # [(piece, [numbers of the chords where it starts])] - pieces (from the
+    # pieces queryset) where the voices move by the motions ((S, A, T, B)
+    # moves in semitones, at least one)
+    motions = [tuple(motion) for motion in motions]
+    if not motions or any(len(motion) != 4 for motion in motions):
+        raise ValueError("Motions of 4 voices expected")
+    labels = [motion_label(motion) for motion in motions]
+    n = min(len(labels), max(MOTION_NGRAMS))
+    grams = ["m:" + "/".join(labels[i:i + n])
+             for i in range(len(labels) - n + 1)]
+    if pieces is None:
+        pieces = MusicPiece.objects.all()
+    results = []
+    for music_piece in _containing(grams, pieces).order_by('id').iterator():
+        parts = [parse_notes(part) for part in
+                 (music_piece.soprano, music_piece.alto, music_piece.tenor,
+                  music_piece.bass)]
+        positions = _positions(voice_motions(parts), motions)
+        if positions:
+            results.append((music_piece, positions))
+            if len(results) == limit:
+                break
+    return results
+
+def similar_pieces(music_piece, pieces=None, limit=10):
+    # [(piece, score)] - pieces (from the pieces queryset) sharing the most
+    # n-grams with music_piece - weighted by how rare they are (idf), divided
+    # by the sizes of both pieces. Only the inverted lists of the n-grams
+    # which are not too common are read
+    own = dict(PieceNGram.objects.filter(piece=music_piece)
+               .values_list('gram', 'count'))
+    if not own:
+        return []
+    total = MusicPiece.objects.count()
+    max_df = max(MIN_DOCUMENT_FREQUENCY, MAX_DOCUMENT_FREQUENCY * total)
+    frequencies = {}
+    for grams in _chunks(own):
+        frequencies.update(
+            PieceNGram.objects.filter(gram__in=grams).values('gram')
+            .annotate(pieces=Count('piece')).values_list('gram', 'pieces'))
+    weights = {gram: math.log(1 + total / frequency)
+               for gram, frequency in frequencies.items()
+               if frequency <= max_df}
+    scores = Counter()
+    for grams in _chunks(weights):
+        postings = PieceNGram.objects.filter(gram__in=grams) \
+            .exclude(piece=music_piece).values_list('piece', 'gram', 'count')
+        for piece_id, gram, count in postings:
+            scores[piece_id] += min(count, own[gram]) * weights[gram]
+    if pieces is None:
+        pieces = MusicPiece.objects.all()
+    candidates = [piece_id for piece_id, score in scores.most_common()]
+    visible = set()
+    for ids in _chunks(candidates):
+        visible.update(pieces.filter(id__in=ids).values_list('id', flat=True))
+    candidates = [piece_id for piece_id in candidates if piece_id in visible]
+    # long pieces share more n-grams
+    sizes = {}
+    for ids in _chunks(candidates):
+        sizes.update(PieceNGram.objects.filter(piece__in=ids).values('piece')
+                     .annotate(size=Sum('count')).values_list('piece', 'size'))
+    own_size = sum(own.values())
+    ranked = sorted(
+        ((scores[piece_id] / math.sqrt(own_size * sizes[piece_id]), piece_id)
+         for piece_id in candidates),
+        key=lambda item: (-item[0], item[1]),
+    )[:limit]
+    found = MusicPiece.objects.in_bulk([piece_id for score, piece_id
+                                        in ranked])
+    return [(found[piece_id], score) for score, piece_id in ranked]
@@ -0,0 +1,12 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from CheckMyChords.analysis import update_analysis
+from CheckMyChords.models import MusicPiece
+
+
+@receiver(post_save, sender=MusicPiece)
+def analyse_saved_piece(sender, instance, raw=False, **kwargs):
+    # pieces loaded from fixtures (raw) are analysed by update_analyses
+    if not raw:
+        update_analysis(instance)
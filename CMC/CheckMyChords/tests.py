@@ -1,14 +1,115 @@
+import json
+import os
+import pickle
+import random
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
 from django.test import TestCase
+from django.urls import reverse
 
 from pyknon.music import Note, NoteSeq
 
-from CheckMyChords.harmony_rules import Chord
+from CheckMyChords.analysis import patch_piece, update_analysis
+from CheckMyChords.cache_backends import LRULocMemCache
+from CheckMyChords.harmony_cache import (
+    CACHE_ALIAS,
+    cache_stats,
+    cached_check_harmony_rules,
+    keep_checked_piece,
+    reset_cache_stats,
+    take_checked_piece,
+)
+from CheckMyChords.forms import SelectRulesForm
+from CheckMyChords import harmony_rules
+from CheckMyChords.harmony_rules import (
+    ERROR,
+    WARNING,
+    Chord,
+    Piece,
+    RULES,
+    VOICE_RANGES,
+    VOICES,
+    _analyse_chord,
+    _read_chord,
+    check_harmony_rules,
+    compile_context_rules,
+    iter_harmony,
+)
+from CheckMyChords.importers import (
+    PieceImportError,
+    read_midi,
+    read_musicxml,
+)
+from CheckMyChords.management.commands.benchmark import realistic_parts
+from CheckMyChords.midi_encoder import encode_midi
+from CheckMyChords.midi_rendering import (
+    clear_midi_cache,
+    midi_content_disposition,
+    render_midi,
+)
+from CheckMyChords.models import (
+    MusicPiece,
+    PieceAnalysis,
+    PieceNGram,
+    PieceViolation,
+)
+from CheckMyChords.notation import NotationError, midi_to_str, parse_notes
+from CheckMyChords.rule_stats import (
+    add_timing_hook,
+    remove_timing_hook,
+    reset_rule_stats,
+    rule_stats,
+)
+from CheckMyChords.search import (
+    find_progression,
+    find_voice_leading,
+    similar_pieces,
+)
+from CheckMyChords.views import PiecesView
+from CheckMyChords.violation_stats import violation_histogram
 
 
 class NoteTests(TestCase):
     # not yet implemented
     pass
 
+class NotationTests(TestCase):
+    def test_parse_notes_octaves(self):
+        self.assertEqual(parse_notes("C' C C, c,, C''"), (60, 60, 48, 36, 72))
+        # notes without octave marks are in the octave of the previous note
+        self.assertEqual(parse_notes("G, A B C'"), (55, 57, 59, 60))
+        self.assertEqual(parse_notes("C D"), (60, 62))
+
+    def test_parse_notes_accidentals(self):
+        self.assertEqual(parse_notes("F#' Gb' Bbb, a#,,"), (66, 66, 57, 46))
+        # accidentals don't change the octave (as in pyknon)
+        self.assertEqual(parse_notes("Cb' B#'"), (71, 60))
+
+    def test_parse_notes_matches_note_objects(self):
+        for note in ("C'", "Ab'", "F#,", "Bbb'", "E#,,", "Db''"):
+            self.assertEqual(parse_notes(note), (Note(note).midi_number,))
+
+    def test_invalid_notes_reported_with_column(self):
+        for notes, message, column in (("C' D' X E'", "Wrong notation", 7),
+                                       ("C' H'", "Use english notation!", 4),
+                                       ("  r C'", "Rests not allowed!", 3),
+                                       ("C'4", "Wrong notation", 1),
+                                       ("C#b'", "Wrong notation", 1),
+                                       ("C''''''''''", "Note out of range", 1)):
+            with self.assertRaises(NotationError) as cm:
+                parse_notes(notes)
+            self.assertEqual(cm.exception.message, message)
+            self.assertEqual(cm.exception.column, column)
+
+    def test_midi_to_str_is_parsable(self):
+        for midi in range(24, 100):
+            self.assertEqual(parse_notes(midi_to_str(midi)), (midi,))
+
 class ChordTests(TestCase):
     # TODO: add more descriptive fail messages
     def setUp(self):
@@ -204,6 +305,24 @@ class ChordTests(TestCase):
         # minor chord with added 7th
         pass
     
+    def test_chord_table_matches_chord_analysis(self):
+        # every chord that can be written in the default voice ranges
+        s_range = range(VOICE_RANGES["S"][0], VOICE_RANGES["S"][1] + 1)
+        a_range = range(VOICE_RANGES["A"][0], VOICE_RANGES["A"][1] + 1)
+        t_range = range(VOICE_RANGES["T"][0], VOICE_RANGES["T"][1] + 1)
+        b_range = range(VOICE_RANGES["B"][0], VOICE_RANGES["B"][1] + 1)
+        for b in b_range:
+            for t in t_range:
+                for a in a_range:
+                    for s in s_range:
+                        self.assertEqual(_read_chord(s, a, t, b),
+                                         _analyse_chord(s, a, t, b),
+                                         msg=(s, a, t, b))
+
+    def test_chord_table_outside_of_voice_ranges(self):
+        for chord in ((96, 72, 24, 12), (60, 64, 67, 100), (0, 0, 0, 0)):
+            self.assertEqual(_read_chord(*chord), _analyse_chord(*chord))
+
     def test_chord_structure_for_simple_chords(self):
         pass
     
@@ -214,7 +333,857 @@ class ChordTests(TestCase):
         pass
 
 
+class PieceTests(TestCase):
+    def setUp(self):
+        self.music_piece = MusicPiece(title="Cadence",
+                                      soprano="G' A' G' G'",
+                                      alto="E' F' D' E'",
+                                      tenor="C' C' B, C'",
+                                      bass="C, F, G, C,")
+
+    def test_piece_stores_parts_as_midi_numbers(self):
+        piece = Piece(self.music_piece)
+        self.assertEqual(len(piece), 4)
+        self.assertEqual(list(piece._row(0)), [67, 69, 67, 67])
+        self.assertEqual(list(piece._row(3)), [48, 53, 55, 48])
+        self.assertEqual([note.midi_number for note in piece.parts["T"]],
+                         [60, 60, 59, 60])
+
+    def test_piece_chords_match_chord_objects(self):
+        piece = Piece(self.music_piece)
+        for chord in piece.chords:
+            reference = Chord(chord.soprano, chord.alto,
+                              chord.tenor, chord.bass)
+            self.assertEqual(chord.root, reference.root)
+            self.assertEqual(chord.mode, reference.mode)
+            self.assertEqual(chord.structure, reference.structure)
+
+    def test_functions_found_again_when_key_changes(self):
+        piece = Piece(self.music_piece)
+        self.assertEqual(piece._functions(), ["T", "S", "D", "T"])
+        self.assertIs(piece.function_codes, piece.function_codes)
+        piece.key = (5, 1)  # F major
+        self.assertEqual(piece._functions(), ["D", "T", "", "D"])
+        for chord, function in zip(piece.chords, piece._functions()):
+            self.assertEqual(chord.harmonic_function(piece.key), function)
+        with self.assertRaises(ValueError):
+            piece.key = (12, 1)
+
+    def test_modulation_found(self):
+        # C: T S D T, G: D T S D T
+        self.music_piece.soprano = "E' F' D' E' F#' G' G' F#' G'"
+        self.music_piece.alto = "C' C' B C' D' D' E' D' D'"
+        self.music_piece.tenor = "G, A, G, G, A, B, C' A, B,"
+        self.music_piece.bass = "C, F, G, C, D, G, C, D, G,"
+        piece = Piece(self.music_piece)
+        self.assertEqual(piece.key, (0, 1))
+        self.assertEqual(piece.modulations, [(0, (0, 1)), (4, (7, 1))])
+        self.assertEqual(piece.modulations_hr, "chord 5: G major")
+        self.assertEqual(piece._functions(),
+                         ["T", "S", "D", "T", "D", "T", "S", "D", "T"])
+
+    def test_key_tables_replaced_when_too_big(self):
+        piece = Piece(self.music_piece)
+        with mock.patch.object(harmony_rules, "_MAX_KEY_STATES", 5):
+            rng = random.Random(0)
+            for i in range(5):
+                parts = realistic_parts(50, rng)
+                other = Piece(MusicPiece(**{
+                    field: " ".join(map(midi_to_str, part))
+                    for field, part in zip(("soprano", "alto", "tenor",
+                                            "bass"), parts)}))
+                self.assertLess(len(harmony_rules._key_tables.states), 60)
+            # the piece still uses its own tables
+            self.assertIsNot(piece._key_tables, other._key_tables)
+            piece.patch(2, 3, "B", "F'", "D'", "G,")
+        self.assertEqual(piece._functions(), ["T", "S", "D7", "T"])
+
+    def test_no_modulation_for_secondary_dominant(self):
+        self.music_piece.soprano = "E' F' F#' G' E'"
+        self.music_piece.alto = "C' C' D' D' C'"
+        self.music_piece.tenor = "G, A, A, B, G,"
+        self.music_piece.bass = "C, F, D, G, C,"
+        piece = Piece(self.music_piece)
+        self.assertEqual(piece.key_track, [(0, 1)] * 5)
+        self.assertEqual(piece.modulations_hr, "")
+
+    def test_score_printed_in_columns(self):
+        piece = Piece(self.music_piece)
+        self.assertEqual(piece.score_hr.split("\n"), [
+            "n:  1   2   3   4   ",
+            "S: |G4  A4  G4  G4  |",
+            "A: |E4  F4  D4  E4  |",
+            "T: |C4  C4  B3  C4  |",
+            "B: |C3  F3  G3  C3  |",
+            "f: |T   S   D   T   |",
+        ])
+        self.assertEqual(piece.chord_n_hr, " 1   2   3   4   ")
+        self.assertEqual(piece.functions_hr, "|T   S   D   T  ||")
+        # numbers of long pieces don't run together
+        self.music_piece.soprano = " ".join(["G'"] * 1000)
+        self.music_piece.alto = " ".join(["E'"] * 1000)
+        self.music_piece.tenor = " ".join(["C'"] * 1000)
+        self.music_piece.bass = " ".join(["C,"] * 1000)
+        numbers = Piece(self.music_piece).score_hr.split("\n")[0]
+        self.assertTrue(numbers.endswith(" 999  1000 "))
+
+    def test_piece_with_parts_of_different_length(self):
+        self.music_piece.bass = "C, F, G,"
+        with self.assertRaises(ValueError):
+            Piece(self.music_piece)
+
+
 class HarmonyRulesTests(TestCase):
-    # not yet implemented
-    pass
+    def make_piece(self, soprano, alto, tenor, bass):
+        return Piece(MusicPiece(title="Test", soprano=soprano, alto=alto,
+                                tenor=tenor, bass=bass))
+
+    def test_consecutive_fifths_and_octaves(self):
+        piece = self.make_piece("G' A'", "C' D'", "E, F,", "C, D,")
+        piece._check_paralels()
+        self.assertEqual(piece.err_count, 3)
+        self.assertEqual(piece.err_detailed, [
+            ("Consecutive intervals", 3, [
+                "Chords 1/2: S/A consecutive Fifths",
+                "Chords 1/2: S/B consecutive Fifths",
+                "Chords 1/2: A/B consecutive Unison/Octave",
+            ]),
+        ])
+
+    def test_leaps_and_distances(self):
+        piece = self.make_piece("E'' C'", "E' E'", "G, G,", "C,, C,,")
+        piece._check_leaps()
+        piece._check_distances()
+        self.assertEqual(piece.err_count, 2)
+        self.assertEqual(piece.err_detailed, [
+            ("Restricted leaps", 1, [
+                "Chords 1/2: Restricted leap in S - over an octave",
+            ]),
+            ("Voice distance errors", 1, ["Chord 2: S/A overlap"]),
+        ])
+
+    def test_messages_ordered_by_chords(self):
+        piece = self.make_piece(*[" ".join([note] * 12) for note in
+                                  ("G'", "E'", "C'", "C,,")])
+        piece._check_range()
+        self.assertEqual(piece.err_detailed[0][2][:3], [
+            "Chord 1: B too low", "Chord 2: B too low", "Chord 3: B too low",
+        ])
+        self.assertEqual(piece.violations[9].message, "Chord 10: B too low")
+
+    def test_checking_stops_after_max_errors(self):
+        # a wrong bass note in the first and in the last chord
+        notes = ("G'", "E'", "C'", "C,")
+        parts = [" ".join([note] * 600) for note in notes]
+        parts[3] = "C,, " + parts[3][3:-3] + " C,,"
+        piece = self.make_piece(*parts)
+        piece.check_harmony(max_errors=0)
+        self.assertFalse(piece.complete)
+        self.assertEqual(piece.err_count, 1)
+        self.assertEqual(piece.err_detailed,
+                         [("Voice range errors", 1, ["Chord 1: B too low"])])
+        piece = self.make_piece(*parts)
+        piece.check_harmony(max_errors=2)
+        self.assertTrue(piece.complete)
+        self.assertEqual(piece.rule_counts["RANGE"], (2, 0))
+        piece.check_harmony(max_errors=1)
+        with self.assertRaises(ValueError):
+            piece.patch(0, 0, "", "", "", "")  # checked only partly
+
+    def test_streamed_results_match_piece(self):
+        parts = ("G' A' E'' C'", "C' D' E' E'", "E, F, G, G,", "C, D, C,, C,,")
+        rules = ["RANGE", "LEAPS", "DISTANCES", "PARALELS", "CHORDS"]
+        piece = self.make_piece(*parts)
+        piece.check_harmony(rules)
+        results = list(iter_harmony(*parts, rules=rules))
+        self.assertEqual([result["chord"] for result in results], [1, 2, 3, 4])
+        self.assertEqual(results[0]["key"], piece.key_hr)
+        errors = [error for result in results for error in result["errors"]]
+        warnings = [warning for result in results
+                    for warning in result["warnings"]]
+        self.assertCountEqual(
+            errors, [e for group in piece.err_detailed for e in group[2]])
+        self.assertCountEqual(
+            warnings, [w for group in piece.war_detailed for w in group[2]])
+
+
+class ChordsInContextTests(TestCase):
+    def check(self, soprano, alto, tenor, bass, context_table=None):
+        piece = Piece(MusicPiece(title="Test", soprano=soprano, alto=alto,
+                                 tenor=tenor, bass=bass))
+        if context_table is not None:
+            piece.context_table = context_table
+        piece._check_chords_in_context()
+        return [(violation.beat, violation.voices, violation.detail)
+                for violation in piece.violations]
+
+    def test_forbidden_progression(self):
+        self.assertEqual(self.check("E' B' A' G'", "C' D' C' E'",
+                                    "G, G, F, C'", "C, G, F, C,"),
+                         [(1, "", "progression:D-S")])
+
+    def test_dominant_resolution(self):
+        # seventh going up, leading tone in soprano going down, doubled
+        # leading tone, seventh at the end
+        self.assertEqual(self.check("E' F' G'", "C' D' C'", "G, B, C'",
+                                    "C, G, C,"), [(1, "S", "seventh")])
+        self.assertEqual(self.check("E' B' G'", "C' D' E'", "G, G, C'",
+                                    "C, G, C,"), [(1, "S", "leading_tone")])
+        self.assertEqual(self.check("E' B' C''", "C' B' G'", "G, D' E'",
+                                    "C, G, C,"),
+                         [(1, "", "doubled_leading_tone")])
+        self.assertEqual(self.check("E' F'", "C' D'", "G, B,", "C, G,"),
+                         [(1, "S", "seventh_at_end")])
+
+    def test_checked_while_streaming(self):
+        for parts in (("E' B' A' G'", "C' D' C' E'", "G, G, F, C'",
+                       "C, G, F, C,"),
+                      ("E' F' G'", "C' D' C'", "G, B, C'", "C, G, C,"),
+                      ("E' B' C''", "C' B' G'", "G, D' E'", "C, G, C,"),
+                      ("E' F'", "C' D'", "G, B,", "C, G,")):
+            piece = check_harmony_rules(
+                MusicPiece(title="Test", soprano=parts[0], alto=parts[1],
+                           tenor=parts[2], bass=parts[3]), ["CHORDS_IN_CTX"])
+            messages = [message for result
+                        in iter_harmony(*parts, rules=["CHORDS_IN_CTX"])
+                        for message in result["errors"] + result["warnings"]]
+            self.assertTrue(messages)
+            self.assertCountEqual(messages, [
+                message for group in piece.err_detailed + piece.war_detailed
+                for message in group[2]])
+
+    def test_custom_rules_compiled(self):
+        table = compile_context_rules([("T", "D", "forbidden", WARNING)])
+        self.assertEqual(self.check("E' B' A' G'", "C' D' C' E'",
+                                    "G, G, F, C'", "C, G, F, C,", table),
+                         [(0, "", "progression:T-D")])
+        with self.assertRaises(ValueError):
+            compile_context_rules([("D", "X", "forbidden", ERROR)])
+        # results of another table are not reused (see ENGINE_VERSION)
+        self.assertNotEqual(
+            harmony_rules.context_table_hash(table),
+            harmony_rules.context_table_hash(harmony_rules.CONTEXT_TABLE))
+        self.assertEqual(
+            harmony_rules.RULE_VERSIONS["CHORDS_IN_CTX"],
+            "2." + harmony_rules.context_table_hash(
+                harmony_rules.CONTEXT_TABLE))
+
+class PiecePatchTests(TestCase):
+    def make_piece(self, parts):
+        return Piece(MusicPiece(title="Test", **{
+            field: " ".join(map(midi_to_str, part))
+            for field, part in zip(("soprano", "alto", "tenor", "bass"),
+                                   parts)}))
+
+    def results(self, piece):
+        return (list(piece._notes), piece.key_track, piece._functions(),
+                piece.err_detailed, piece.war_detailed, piece.violations)
+
+    def test_patched_piece_matches_checked_piece(self):
+        rng = random.Random(0)
+        for i in range(20):
+            parts = realistic_parts(30, rng)
+            piece = self.make_piece(parts)
+            piece.check_harmony()
+            for edit in range(3):
+                start = rng.randint(0, len(parts[0]))
+                stop = rng.randint(start, min(start + 3, len(parts[0])))
+                notes = realistic_parts(rng.randint(1, 3), rng) \
+                    if rng.random() < 0.7 else [[], [], [], []]
+                piece.patch(start, stop, *notes)
+                for part, new_part in zip(parts, notes):
+                    part[start:stop] = new_part
+                checked = self.make_piece(parts)
+                checked.check_harmony()
+                self.assertEqual(self.results(piece), self.results(checked))
+
+    def test_pickled_piece_patched(self):
+        # e.g. taken from a cache shared by processes - states of the key
+        # track are found again
+        parts = realistic_parts(30, random.Random(1))
+        piece = self.make_piece(parts)
+        piece.check_harmony()
+        piece = pickle.loads(pickle.dumps(piece))
+        self.assertIsNone(piece._key_states)
+        notes = realistic_parts(2, random.Random(2))
+        piece.patch(10, 12, *notes)
+        for part, new_part in zip(parts, notes):
+            part[10:12] = new_part
+        checked = self.make_piece(parts)
+        checked.check_harmony()
+        self.assertEqual(self.results(piece), self.results(checked))
+
+    def test_invalid_patch(self):
+        piece = self.make_piece([[67], [64], [60], [48]])
+        with self.assertRaises(ValueError):
+            piece.patch(0, 2, "C'", "C'", "C'", "C'")
+        with self.assertRaises(ValueError):
+            piece.patch(0, 1, "", "", "", "")
+        with self.assertRaises(ValueError):
+            piece.patch(0, 0, "C' D'", "C'", "C'", "C'")
+
+    def test_piece_edited_by_author(self):
+        user = User.objects.create_user("author", password="password")
+        music_piece = MusicPiece.objects.create(
+            title="Cadence", soprano="G' A' G' G'", alto="E' F' D' E'",
+            tenor="C' C' B, C'", bass="C, F, G, C,", author=user)
+        url = reverse("edit_piece", kwargs={"piece_id": music_piece.id})
+        data = json.dumps({"start": 1, "stop": 2, "soprano": "C''",
+                           "alto": "A'", "tenor": "F'", "bass": "F,"})
+        response = self.client.post(url, data,
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json(), {"error": "Login required"})
+        self.client.login(username="author", password="password")
+        result = self.client.post(url, data,
+                                  content_type='application/json').json()
+        self.assertEqual(result["checked"], [0, 2])
+        self.assertEqual(result["err_count"], 3)
+        music_piece.refresh_from_db()
+        self.assertEqual(music_piece.soprano, "G' C'' G' G'")
+        analysis = PieceAnalysis.objects.get(piece=music_piece)
+        self.assertEqual(analysis.parts_hash, music_piece.parts_hash)
+        self.assertEqual(analysis.err_count, 3)
+
+    def test_edit_patches_stored_analysis(self):
+        user = User.objects.create_user("author", password="password")
+        parts = realistic_parts(40, random.Random(7))
+        music_piece = MusicPiece.objects.create(title="Test", author=user, **{
+            field: " ".join(map(midi_to_str, part))
+            for field, part in zip(("soprano", "alto", "tenor", "bass"),
+                                   parts)})
+
+        def stored(music_piece):
+            analysis = PieceAnalysis.objects.get(piece=music_piece)
+            return (analysis.parts_hash, analysis.key, analysis.chords,
+                    analysis.rule_counts, sorted(
+                        music_piece.violations.values_list(
+                            'rule', 'beat', 'voices', 'detail')),
+                    sorted(music_piece.ngrams.values_list('gram', 'count')))
+
+        for start, stop, parts in ((3, 5, ["C''", "A'", "F'", "F,"]),
+                                   (10, 10, ["G' A'", "E' F'", "C' C'",
+                                             "C, F,"]),
+                                   (20, 24, ["", "", "", ""])):
+            piece = take_checked_piece(music_piece)
+            patch_piece(music_piece, piece, start, stop, parts)
+            keep_checked_piece(music_piece, piece)
+            # the kept Piece is patched by the next edit
+            self.assertIs(take_checked_piece(music_piece), piece)
+            keep_checked_piece(music_piece, piece)
+            patched = stored(music_piece)
+            update_analysis(music_piece, force=True)
+            self.assertEqual(patched, stored(music_piece))
+
+class HarmonyCacheTests(TestCase):
+    def setUp(self):
+        caches[CACHE_ALIAS].clear()
+        reset_cache_stats()
+        self.music_piece = MusicPiece(title="Cadence",
+                                      soprano="G' A' G' G'",
+                                      alto="E' F' D' E'",
+                                      tenor="C' C' B, C'",
+                                      bass="C, F, G, C,")
+
+    def test_checked_piece_is_cached(self):
+        first = cached_check_harmony_rules(self.music_piece, ["RANGE"])
+        second = cached_check_harmony_rules(self.music_piece, ["RANGE"])
+        self.assertEqual(cache_stats(), {"hits": 1, "misses": 1})
+        self.assertEqual(second, first)
+        # plain results, not a Piece
+        self.assertEqual(second["err_detailed"],
+                         check_harmony_rules(self.music_piece,
+                                             ["RANGE"]).err_detailed)
+
+    def test_cache_key_depends_on_rules_and_parts(self):
+        cached_check_harmony_rules(self.music_piece, ["RANGE", "LEAPS"])
+        cached_check_harmony_rules(self.music_piece, ["LEAPS", "RANGE"])
+        cached_check_harmony_rules(self.music_piece, ["LEAPS"])
+        self.music_piece.bass = "C, F, G, F,"
+        cached_check_harmony_rules(self.music_piece, ["LEAPS"])
+        self.assertEqual(cache_stats(), {"hits": 1, "misses": 3})
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        cache = LRULocMemCache("test-lru", {
+            "OPTIONS": {"MAX_ENTRIES": 3, "CULL_FREQUENCY": 3},
+        })
+        cache.clear()
+        for key in ("a", "b", "c"):
+            cache.set(key, key)
+        cache.get("a")
+        cache.set("d", "d")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "a")
+        self.assertEqual(cache.get("d"), "d")
+
+
+class PieceAnalysisTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user("composer", password="pass")
+        self.music_piece = MusicPiece.objects.create(
+            title="Cadence",
+            soprano="G' A' G' G'",
+            alto="E' F' D' E'",
+            tenor="C' C' B, C'",
+            bass="C, F, G, C,",
+            author=self.author,
+        )
+
+    def test_analysis_stored_on_save(self):
+        analysis = PieceAnalysis.objects.get(piece=self.music_piece)
+        self.assertEqual(analysis.key, "C major")
+        self.assertEqual([chord[2] for chord in analysis.chords_list],
+                         ["T", "S", "D", "T"])
+        self.assertEqual(analysis.rule_counts_dict["RANGE"], [0, 0])
+        self.assertEqual(analysis.parts_hash, self.music_piece.parts_hash)
+
+    def test_only_changed_rules_are_checked_again(self):
+        analysis = self.music_piece.analysis
+        counts = analysis.rule_counts_dict
+        counts["LEAPS"] = [99, 0]  # would be overwritten if checked again
+        versions = analysis.rule_versions_dict
+        versions["RANGE"] = 0  # an old version of the rule
+        analysis.rule_counts = json.dumps(counts)
+        analysis.rule_versions = json.dumps(versions)
+        analysis.save()
+        analysis = update_analysis(MusicPiece.objects.get(
+            id=self.music_piece.id))
+        self.assertEqual(analysis.rule_counts_dict["LEAPS"], [99, 0])
+        self.assertEqual(analysis.rule_versions_dict["RANGE"], 1)
+        self.assertGreaterEqual(analysis.err_count, 99)
+
+
+class CheckCorpusCommandTests(TestCase):
+    def test_results_written_as_json_lines(self):
+        author = User.objects.create_user("composer", password="pass")
+        for bass in ("C, F, G, C,", "C, F, G, C,,"):
+            MusicPiece.objects.create(title="Cadence", soprano="G' A' G' G'",
+                                      alto="E' F' D' E'", tenor="C' C' B, C'",
+                                      bass=bass, author=author)
+        out = StringIO()
+        call_command("check_corpus", workers=1, rules=["RANGE"], stdout=out,
+                     stderr=StringIO())
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([result["err_count"] for result in results], [0, 1])
+        self.assertEqual(results[1]["rule_counts"], {"RANGE": [1, 0]})
+        self.assertEqual(results[1]["errors"],
+                         [["Voice range errors", 1, ["Chord 4: B too low"]]])
+        out = StringIO()
+        with mock.patch("CheckMyChords.harmony_rules.violation_message") \
+                as violation_message:
+            call_command("check_corpus", workers=1, counts_only=True,
+                         stdout=out, stderr=StringIO())
+        self.assertFalse(violation_message.called)
+        self.assertNotIn("errors", json.loads(out.getvalue().splitlines()[1]))
+
+
+class ImportPiecesTests(TestCase):
+    PARTS = ("G' A' G' G'", "E' F' D' E'", "C' C' B, C'", "C, F, G, C,")
+    # soprano and alto on a staff (as voices, a tied note), tenor and bass as
+    # chords
+    MUSICXML = b"""<?xml version="1.0"?>
+<score-partwise><work><work-title>Cadence</work-title></work><part-list/>
+<part id="P1"><measure number="1"><attributes><divisions>2</divisions>
+</attributes>
+<note><pitch><step>G</step><octave>4</octave></pitch><duration>2</duration>
+<voice>1</voice></note>
+<note><pitch><step>A</step><octave>4</octave></pitch><duration>2</duration>
+<voice>1</voice></note>
+<note><pitch><step>G</step><octave>4</octave></pitch><duration>2</duration>
+<voice>1</voice><tie type="start"/></note>
+<backup><duration>6</duration></backup>
+<note><pitch><step>E</step><octave>4</octave></pitch><duration>2</duration>
+<voice>2</voice></note>
+<note><pitch><step>F</step><octave>4</octave></pitch><duration>2</duration>
+<voice>2</voice></note>
+<note><pitch><step>D</step><octave>4</octave></pitch><duration>2</duration>
+<voice>2</voice></note></measure>
+<measure number="2">
+<note><pitch><step>G</step><octave>4</octave></pitch><duration>2</duration>
+<voice>1</voice><tie type="stop"/></note>
+<backup><duration>2</duration></backup>
+<note><pitch><step>E</step><octave>4</octave></pitch><duration>2</duration>
+<voice>2</voice></note></measure></part>
+<part id="P2"><measure number="1"><attributes><divisions>1</divisions>
+</attributes>
+<note><pitch><step>C</step><octave>4</octave></pitch><duration>1</duration>
+</note>
+<note><chord/><pitch><step>C</step><octave>3</octave></pitch>
+<duration>1</duration></note>
+<note><pitch><step>C</step><octave>4</octave></pitch><duration>1</duration>
+</note>
+<note><chord/><pitch><step>F</step><octave>3</octave></pitch>
+<duration>1</duration></note>
+<note><pitch><step>B</step><octave>3</octave></pitch><duration>1</duration>
+</note>
+<note><chord/><pitch><step>G</step><octave>3</octave></pitch>
+<duration>1</duration></note>
+<note><pitch><step>C</step><octave>4</octave></pitch><duration>1</duration>
+</note>
+<note><chord/><pitch><step>C</step><octave>3</octave></pitch>
+<duration>1</duration></note></measure></part></score-partwise>"""
+
+    def fields(self, title):
+        return dict(zip(("title", "soprano", "alto", "tenor", "bass"),
+                        (title,) + self.PARTS))
+
+    def test_midi_read(self):
+        data = render_midi(self.PARTS)
+        self.assertEqual(read_midi(BytesIO(data), "Cadence"),
+                         self.fields("Cadence"))
+        with self.assertRaises(PieceImportError):
+            read_midi(BytesIO(data[:100]))
+        # tracks ending in the middle of an event, a short header
+        length = int.from_bytes(data[18:22], "big")
+        for cut in range(length):
+            track = data[14:22 + cut]
+            with self.assertRaises(PieceImportError):
+                read_midi(BytesIO(data[:14] + track[:4]
+                                  + cut.to_bytes(4, "big") + track[8:]))
+        with self.assertRaises(PieceImportError):
+            read_midi(BytesIO(b"MThd\x00\x00\x00\x02\x00\x01"))
+
+    def test_musicxml_read(self):
+        self.assertEqual(read_musicxml(BytesIO(self.MUSICXML)),
+                         self.fields("Cadence"))
+        with self.assertRaises(PieceImportError):
+            read_musicxml(BytesIO(self.MUSICXML.replace(b"</note>", b"", 1)))
+        with self.assertRaises(PieceImportError):
+            read_musicxml(BytesIO(self.MUSICXML.replace(
+                b"<divisions>1</divisions>", b"<divisions>0</divisions>")))
+
+    def test_files_imported(self):
+        User.objects.create_user("composer", password="pass")
+        with tempfile.TemporaryDirectory() as directory:
+            for name, data in (("a.mid", render_midi(self.PARTS)),
+                               ("b.xml", self.MUSICXML),
+                               ("c.mid", b"MThd"), ("d.txt", b"")):
+                with open(os.path.join(directory, name), "wb") as f:
+                    f.write(data)
+            err = StringIO()
+            call_command("import_pieces", directory, "--author=composer",
+                         workers=1, batch_size=1, stdout=StringIO(),
+                         stderr=err)
+        self.assertEqual(
+            sorted(MusicPiece.objects.values_list("title", flat=True)),
+            ["Cadence", "a"])
+        self.assertIn("c.mid", err.getvalue())
+        self.assertEqual(PieceAnalysis.objects.count(), 2)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("composer", password="pass")
+        # a cadence in C major, the same in D major (transposed) and a
+        # different piece
+        self.pieces = [MusicPiece.objects.create(
+            title=title, soprano=soprano, alto=alto, tenor=tenor, bass=bass,
+            author=self.user, is_public=True,
+        ) for title, soprano, alto, tenor, bass in (
+            ("C", "G' A' G' G'", "E' F' D' E'", "C' C' B, C'", "C, F, G, C,"),
+            ("D", "A' B' A' A'", "F#' G' E' F#'", "D' D' C#' D'",
+             "D, G, A, D,"),
+            ("Other", "E' D' C'", "C' B, A,", "G, G, E,", "C, G,, A,,"),
+        )]
+
+    def test_progression_found(self):
+        found = find_progression(["S", "D", "T"])
+        self.assertEqual([(piece.title, positions)
+                          for piece, positions in found],
+                         [("C", [2]), ("D", [2])])
+        self.assertEqual(find_progression(["D", "S"]), [])
+
+    def test_voice_leading_found(self):
+        found = find_voice_leading([(2, 1, 0, 5), (-2, -3, -1, 2)])
+        self.assertEqual([(piece.title, positions)
+                          for piece, positions in found],
+                         [("C", [1]), ("D", [1])])
+
+    def test_similar_pieces(self):
+        found = similar_pieces(self.pieces[0])
+        self.assertEqual([piece for piece, score in found], [self.pieces[1]])
+        self.assertGreater(found[0][1], 0)
+
+    def test_index_updated_on_save(self):
+        piece = self.pieces[2]
+        piece.soprano, piece.alto, piece.tenor, piece.bass = (
+            "G' A' G' G'", "E' F' D' E'", "C' C' B, C'", "C, F, G, C,")
+        piece.save()
+        self.assertEqual(len(find_progression(["T", "S", "D", "T"])), 3)
+        self.assertEqual(
+            PieceNGram.objects.filter(piece=piece).count(),
+            PieceNGram.objects.filter(piece=self.pieces[0]).count())
+
+    def test_search_api(self):
+        self.pieces[1].is_public = False
+        self.pieces[1].save()
+        response = self.client.get("/api/search",
+                                   {"progression": "S D T", "limit": 5})
+        self.assertEqual(response.json(), {"results": [
+            {"id": self.pieces[0].id, "title": "C", "chords": [2]},
+        ]})
+        response = self.client.get("/api/search", {"similar": "x"})
+        self.assertEqual(response.status_code, 400)
+        for limit in ("0", "-1", "x"):
+            response = self.client.get("/api/search", {
+                "similar": self.pieces[0].id, "limit": limit})
+            self.assertEqual(response.status_code, 400)
+
+
+class ViolationStatsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("composer", password="pass")
+        self.other = User.objects.create_user("other", password="pass")
+        # parallel octaves (S/B) and fifths (A/B)
+        for user in (self.user, self.user, self.other):
+            MusicPiece.objects.create(
+                title="Parallels", soprano="C' D'", alto="G, A,",
+                tenor="E, F#,", bass="C, D,", author=user,
+            )
+
+    def test_violations_stored(self):
+        piece = MusicPiece.objects.first()
+        self.assertEqual(
+            PieceViolation.objects.filter(piece=piece).count(),
+            piece.analysis.err_count + piece.analysis.war_count)
+        mistake = PieceViolation.objects.filter(
+            piece=piece, rule="PARALELS", voices="S/B").get()
+        self.assertEqual((mistake.beat, mistake.detail), (0, "octaves"))
+        self.assertEqual(mistake.author, self.user)
+        piece.bass = "C, B,,"
+        piece.save()
+        self.assertFalse(PieceViolation.objects.filter(
+            piece=piece, rule="PARALELS", voices="S/B").exists())
+
+    def test_histogram(self):
+        rows = violation_histogram(
+            PieceViolation.objects.filter(rule="PARALELS"),
+            ["author", "mistake"])
+        self.assertIn({"username": "composer", "rule": "PARALELS",
+                       "voices": "S/B", "detail": "octaves", "count": 2,
+                       "pieces": 2}, rows)
+        with self.assertRaises(ValueError):
+            violation_histogram(PieceViolation.objects.all(), ["week"])
+
+    def test_stats_api(self):
+        response = self.client.get("/api/violation_stats")
+        self.assertEqual(response.status_code, 401)
+        self.client.login(username="composer", password="pass")
+        response = self.client.get("/api/violation_stats", {
+            "group_by": "author,year", "rule": "PARALELS", "voices": "S/B"})
+        results = response.json()["results"]
+        # only the user's pieces
+        self.assertEqual([(row["username"], row["count"]) for row in results],
+                         [("composer", 2)])
+        response = self.client.get("/api/violation_stats",
+                                   {"since": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+
+
+class BenchmarkCommandTests(TestCase):
+    def test_each_stage_timed(self):
+        out = StringIO()
+        call_command("benchmark", lengths=[20], repeat=1, stdout=out,
+                     stderr=StringIO())
+        report = json.loads(out.getvalue())
+        stages = [result["stage"] for result in report["results"]
+                  if result["kind"] == "realistic"]
+        self.assertEqual(stages, ["piece"] + ["rule:" + rule for rule in RULES]
+                         + ["functions_hr", "parts_hr", "score_hr", "page",
+                            "midi"])
+        self.assertTrue(all(result["beats"] == 20
+                            for result in report["results"]))
+
+    def test_realistic_parts_within_voice_ranges(self):
+        parts = realistic_parts(200, random.Random(1))
+        for voice, part in zip(VOICES, parts):
+            low, high = VOICE_RANGES[voice]
+            self.assertTrue(low <= min(part) and max(part) <= high)
+
+
+class ApiCheckTests(TestCase):
+    def post(self, data):
+        return self.client.post('/api/check', json.dumps(data),
+                                content_type='application/json')
+
+    def test_violations_returned_as_records(self):
+        response = self.post({"soprano": "G' A'", "alto": "C' D'",
+                              "tenor": "E, F,", "bass": "C, D,",
+                              "rules": ["PARALELS"]})
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertTrue(result["valid"])
+        self.assertEqual(result["err_count"], 3)
+        self.assertEqual(result["violations"][2], {
+            "rule": "PARALELS", "severity": "error", "beat": 0,
+            "voices": "A/B", "detail": "octaves",
+        })
+
+    def test_many_pieces_checked_at_once(self):
+        piece = {"soprano": "G'", "alto": "E'", "tenor": "C'", "bass": "C,"}
+        response = self.post({"pieces": [piece, dict(piece, tenor="H")],
+                              "rules": ["RANGE"]})
+        results = response.json()["results"]
+        self.assertEqual([result["valid"] for result in results],
+                         [True, False])
+        self.assertEqual(results[0]["rule_counts"], {"RANGE": [0, 0]})
+        self.assertTrue(results[0]["complete"])
+        self.assertIn("tenor", results[1]["errors"])
+        self.assertFalse(MusicPiece.objects.exists())
+
+
+class RuleRegistryTests(TestCase):
+    def test_form_choices_generated_from_registry(self):
+        self.assertEqual([code for code, label in SelectRulesForm.RULES],
+                         list(RULES))
+        self.assertEqual(RULES, ("RANGE", "LEAPS", "DISTANCES", "PARALELS",
+                                 "CHORDS", "CHORDS_IN_CTX"))
+
+    def test_rules_are_timed(self):
+        reset_rule_stats()
+        measured = []
+        hook = lambda rule, seconds, chords: measured.append((rule, chords))
+        add_timing_hook(hook)
+        try:
+            check_harmony_rules(MusicPiece(title="Test", soprano="G' A'",
+                                           alto="C' D'", tenor="E, F,",
+                                           bass="C, D,"), ["LEAPS", "CHORDS"])
+        finally:
+            remove_timing_hook(hook)
+        self.assertEqual(measured, [("LEAPS", 2), ("CHORDS", 2)])
+        stats = rule_stats()
+        self.assertEqual(sorted(stats), ["CHORDS", "LEAPS"])
+        self.assertEqual(stats["LEAPS"]["calls"], 1)
+        self.assertEqual(sum(stats["LEAPS"]["histogram"]), 1)
+
+
+class MidiRenderingTests(TestCase):
+    def setUp(self):
+        clear_midi_cache()
+        self.user = User.objects.create_user("composer", password="secret")
+        self.client.login(username="composer", password="secret")
+        self.music_piece = MusicPiece.objects.create(
+            author=self.user, title="Cadence", soprano="G' A'",
+            alto="E' F'", tenor="C' C'", bass="C, F,")
+
+    def test_midi_encoded_from_midi_numbers(self):
+        data = encode_midi([[67, 69], [64, 65]], tempo=90)
+        self.assertEqual(data[:14],
+                         b"MThd\x00\x00\x00\x06\x00\x01\x00\x02\x03\xc0")
+        self.assertEqual(data.count(b"MTrk"), 2)
+        # tempo (666666 microseconds per beat) and the first note
+        self.assertIn(b"\x00\xff\x51\x03\x0a\x2c\x2a", data)
+        self.assertIn(b"\x00\x90\x43\x78\x87\x40\x80\x43\x00", data)
+
+    def test_file_rendered_once_and_not_sent_again(self):
+        url = reverse("download_midi",
+                      kwargs={"piece_id": self.music_piece.id})
+        with mock.patch("CheckMyChords.midi_rendering.render_midi",
+                        wraps=render_midi) as render:
+            responses = [self.client.get(url) for i in range(2)]
+            self.assertEqual(render.call_count, 1)
+        self.assertEqual(responses[0].status_code, 200)
+        data = b"".join(responses[0].streaming_content)
+        self.assertEqual(data, render_midi(
+            ("G' A'", "E' F'", "C' C'", "C, F,")))
+        response = self.client.get(
+            url, HTTP_IF_NONE_MATCH=responses[1]["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_file_name_of_any_title(self):
+        self.music_piece.title = 'Chorał "Wśród nocnej ciszy"'
+        self.assertEqual(
+            midi_content_disposition(self.music_piece),
+            'attachment; filename="{0}_Chora_ _Wsrod nocnej ciszy_.mid"; '
+            "filename*=UTF-8''{0}_Chora%C5%82%20%22W%C5%9Br%C3%B3d%20nocnej"
+            "%20ciszy%22.mid".format(self.music_piece.id))
+
+
+class PiecesViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("composer", password="secret")
+        for i in range(5):
+            MusicPiece.objects.create(
+                author=self.user, title="Piece {}".format(i), is_public=True,
+                soprano="G'", alto="E'", tenor="C'", bass="C,")
+
+    def test_pieces_listed_in_pages(self):
+        titles = []
+        url = reverse("pieces")
+        with mock.patch.object(PiecesView, "PAGE_SIZE", 2):
+            while url:
+                response = self.client.get(url)
+                titles += [piece.title for piece in response.context["pieces"]]
+                cursor = response.context["next_cursor"]
+                url = cursor and reverse("pieces") + "?after=" + cursor
+        self.assertEqual(titles, ["Piece {}".format(i) for i in range(4, -1, -1)])
+
+    def test_invalid_cursor(self):
+        for cursor in ("1", "a_1", "300000000000000000_1", "1_" + "9" * 30):
+            response = self.client.get(reverse("pieces"), {"after": cursor})
+            self.assertEqual(response.status_code, 400)
+
+    def test_parts_not_loaded(self):
+        response = self.client.get(reverse("pieces"))
+        piece = response.context["pieces"][0]
+        self.assertEqual(piece.get_deferred_fields(),
+                         {"soprano", "alto", "tenor", "bass", "author_id",
+                          "is_public"})
+
+    def test_listing_not_modified(self):
+        response = self.client.get(reverse("pieces"))
+        etag = response["ETag"]
+        response = self.client.get(reverse("pieces"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        MusicPiece.objects.create(
+            author=self.user, title="New", is_public=True,
+            soprano="G'", alto="E'", tenor="C'", bass="C,")
+        response = self.client.get(reverse("pieces"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+class CheckPieceViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("composer", password="secret")
+        self.piece = MusicPiece.objects.create(
+            author=self.user, title="Cadence", is_public=True,
+            soprano="G' A' G' G'", alto="E' F' D' E'",
+            tenor="C' C' B, C'", bass="C, F, G, C,")
+        self.url = reverse("check_piece", kwargs={"piece_id": self.piece.id})
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response["Cache-Control"], "public, max-age=60")
+        etag = response["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # other rules, an edited piece and a logged in user - other pages
+        response = self.client.get(self.url, {"rules": "RANGE"},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.client.login(username="composer", password="secret")
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+        etag = response["ETag"]
+        self.piece.bass = "C, F, G, C"
+        self.piece.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_stream_rules_validated(self):
+        url = reverse("check_piece_stream",
+                      kwargs={"piece_id": self.piece.id})
+        response = self.client.get(url, {"rules": "FOO"})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {"rules": "RANGE"})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 5)  # 4 chords and a summary
 
+    def test_rules_form_redirects(self):
+        response = self.client.post(self.url,
+                                    {"rules": ["RANGE", "PARALELS"]})
+        self.assertRedirects(response,
+                             self.url + "?rules=PARALELS&rules=RANGE")
+        response = self.client.get(self.url, {"rules": "UNKNOWN"})
+        self.assertEqual(response.status_code, 400)
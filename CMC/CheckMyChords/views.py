@@ -1,30 +1,128 @@
-from os import path
+import json
+from datetime import date, datetime, timedelta
+from hashlib import sha1
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.auth.views import redirect_to_login
+from django.contrib.messages import get_messages
 from django.db.models import Q
+from django.http import Http404
 from django.http.response import (
     HttpResponse, 
+    HttpResponseBadRequest,
+    HttpResponseForbidden,
     HttpResponseRedirect,
     JsonResponse,
+    StreamingHttpResponse,
 )
 from django.shortcuts import render, redirect
 from django.urls import reverse, reverse_lazy
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_date
+from django.utils.decorators import method_decorator
+from django.utils.http import urlencode
+from django.utils.timezone import utc
 from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 
-from pyknon.genmidi import Midi
-from pyknon.music import NoteSeq
-
-from CMC.settings import MEDIA_ROOT, MEDIA_URL
 from CheckMyChords.forms import (
+    CheckPartsForm,
     NewPieceForm,
     SelectRulesForm
 )
-from CheckMyChords.harmony_rules import check_harmony_rules, make_piece
-from CheckMyChords.models import MusicPiece
+from CheckMyChords.analysis import patch_piece
+from CheckMyChords.harmony_cache import (
+    cached_check_harmony_rules,
+    keep_checked_piece,
+    result_key,
+    take_checked_piece,
+)
+from CheckMyChords.harmony_rules import check_harmony_rules, iter_harmony
+from CheckMyChords.midi_rendering import (
+    midi_bytes,
+    midi_content_disposition,
+    midi_etag,
+)
+from CheckMyChords.models import MusicPiece, PieceViolation
+from CheckMyChords.rule_stats import BUCKETS_MS, reset_rule_stats, rule_stats
+from CheckMyChords.search import (
+    find_progression,
+    find_voice_leading,
+    similar_pieces,
+)
+from CheckMyChords.violation_stats import violation_histogram
+
+
+# seconds proxies may show a page without asking if it changed (pieces can
+# be edited, so not long)
+PAGE_MAX_AGE = 60
+
+
+def make_cursor(piece):
+    # position of a piece on the list - "<date_added (microseconds)>_<id>"
+    timestamp = piece.date_added - datetime(1970, 1, 1, tzinfo=utc)
+    return "{}_{}".format(timestamp // timedelta(microseconds=1), piece.id)
+
+def parse_cursor(cursor):
+    # (date_added, id) of the piece, raises ValueError for invalid cursors
+    # (also for dates and ids out of range)
+    microseconds, piece_id = (int(value) for value in cursor.split("_"))
+    if not 0 < piece_id < 2 ** 63:
+        raise ValueError("Piece id out of range: {}".format(piece_id))
+    try:
+        date_added = datetime(1970, 1, 1, tzinfo=utc) \
+            + timedelta(microseconds=microseconds)
+    except OverflowError as e:
+        raise ValueError(str(e))
+    return date_added, piece_id
+
+
+def visible_pieces(user, pieces=None):
+    # pieces the user may see - public ones and their own (all of them for
+    # superusers)
+    if pieces is None:
+        pieces = MusicPiece.objects.all()
+    if user.is_superuser:
+        return pieces.all()
+    elif user.is_authenticated:
+        return pieces.filter(Q(author=user) | Q(is_public=True))
+    else:
+        return pieces.filter(is_public=True)
+
+def page_etag(request, *parts):
+    # ETag of a page showing parts - the user and the date are shown as well
+    # (see base.html)
+    content = "\n".join(map(str, parts + (request.user.pk, date.today())))
+    return '"{}"'.format(sha1(content.encode("utf-8")).hexdigest())
+
+def conditional_render(request, etag, public, template, get_context):
+    # renders a page (get_context is called only then), or returns 304 if the
+    # client has the page with this ETag already. Pages shown to anonymous
+    # users (the same for all of them) may be cached by proxies if public
+    if get_messages(request):  # shown only once - the page can't be reused
+        response = render(request, template, get_context())
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = render(request, template, get_context())
+    response['ETag'] = etag
+    if public and not request.user.is_authenticated:
+        response['Cache-Control'] = 'public, max-age={}'.format(PAGE_MAX_AGE)
+    else:
+        response['Cache-Control'] = 'private, no-cache'
+    return response
+
 
+class JsonLoginRequiredMixin(LoginRequiredMixin):
+    # LoginRequiredMixin of the JSON endpoints - anonymous users get 401 (as
+    # JSON) instead of a redirect to the login page
+    def handle_no_permission(self):
+        return JsonResponse({"error": "Login required"}, status=401)
 
 class SignUpView(View):
     def get(self, request):
@@ -69,67 +167,371 @@ class AddPieceView(LoginRequiredMixin, View):
 
 class PiecesView(View):
     # Shows all pieces from db, enables checking them and downloading MIDI
+    # Pieces are shown newest first, PAGE_SIZE at a time. Next pages are
+    # selected by the last piece shown (?after=<cursor>), not by an offset
+    PAGE_SIZE = 50
+
     def get(self, request):
-        if request.user.is_superuser:
-            pieces = MusicPiece.objects.all()
-        elif request.user.is_authenticated:
-            pieces = MusicPiece.objects.filter(
-                Q(author=request.user) | Q(is_public=True),
+        # stored analyses are used to show keys and mistakes of the pieces,
+        # parts are not loaded
+        pieces = MusicPiece.objects.select_related('analysis').only(
+            'title', 'date_added', 'analysis__key', 'analysis__err_count',
+            'analysis__war_count',
+        )
+        pieces = visible_pieces(request.user, pieces)
+        after = request.GET.get('after')
+        if after:
+            try:
+                date_added, piece_id = parse_cursor(after)
+            except ValueError:
+                return HttpResponseBadRequest("Invalid cursor")
+            pieces = pieces.filter(
+                Q(date_added__lt=date_added)
+                | Q(date_added=date_added, id__lt=piece_id),
             )
-        else:
-            pieces = MusicPiece.objects.filter(is_public=True)
+        pieces = list(pieces.order_by('-date_added', '-id')[:self.PAGE_SIZE+1])
+        next_cursor = None
+        if len(pieces) > self.PAGE_SIZE:
+            pieces = pieces[:self.PAGE_SIZE]
+            next_cursor = make_cursor(pieces[-1])
         ctx = {
             "pieces": pieces,
+            "next_cursor": next_cursor,
+            "first_page": not after,
         }
-        return render(request, 'pieces.html', ctx)
+        # the page is made of the listed fields only
+        etag = page_etag(request, next_cursor, not after, *(
+            (piece.id, piece.title, make_cursor(piece))
+            + ((piece.analysis.key, piece.analysis.err_count,
+                piece.analysis.war_count)
+               if hasattr(piece, 'analysis') else ())
+            for piece in pieces
+        ))
+        return conditional_render(request, etag, True, 'pieces.html',
+                                  lambda: ctx)
 
 class CheckPieceView(View):
-    # Shows if piece is correct, according to basic harmony rules
+    # Shows if piece is correct, according to basic harmony rules (only the
+    # rules chosen in the form - ?rules=...&rules=...). The page depends only
+    # on the piece, the rules and ENGINE_VERSION (see harmony_cache), so it
+    # has an ETag and is not rendered again for a client which has it
     def get(self, request, piece_id):
         piece = MusicPiece.objects.get(id=piece_id)
-        checked_piece = check_harmony_rules(piece)
-        return render(request, 'check_piece.html', {'piece': checked_piece,
-                                                    'form': SelectRulesForm()})
-    
+        rules = ['ALL']
+        if 'rules' in request.GET:
+            form = SelectRulesForm(request.GET)
+            if not form.is_valid():
+                response = render(request, 'check_piece.html', {
+                    'piece': cached_check_harmony_rules(piece),
+                    'form': form,
+                })
+                response.status_code = 400
+                return response
+            rules = form.cleaned_data['rules']
+        etag = page_etag(request, result_key(piece, rules), piece.title)
+        # checked_piece is a dict of results, while piece is MusicPiece
+        # object
+        return conditional_render(
+            request, etag, piece.is_public, 'check_piece.html',
+            lambda: {'piece': cached_check_harmony_rules(piece, rules),
+                     'form': SelectRulesForm()},
+        )
+
     def post(self, request, piece_id):
-        # Check the piece, but only using the rules chosen in form
-        form = SelectRulesForm(request.POST)
-        if form.is_valid():
-            piece = MusicPiece.objects.get(id=piece_id)
+        # the rules chosen in the form - redirected to the page (GET), which
+        # can be cached
+        url = reverse("check_piece", kwargs={"piece_id": piece_id})
+        rules = sorted(request.POST.getlist('rules'))
+        if rules:
+            url += "?" + urlencode({'rules': rules}, doseq=True)
+        return HttpResponseRedirect(url)
+
+class CheckPieceStreamView(View):
+    # Checks the piece chord by chord and streams the results as JSON Lines
+    # (one line per chord and a summary at the end) - for very long pieces,
+    # which are not checked as a whole (see harmony_rules.iter_harmony)
+    def get(self, request, piece_id):
+        piece = MusicPiece.objects.get(id=piece_id)
+        rules = ['ALL']
+        if 'rules' in request.GET:
+            form = SelectRulesForm(request.GET)
+            if not form.is_valid():
+                return JsonResponse({"errors": form.errors}, status=400)
             rules = form.cleaned_data['rules']
-            checked_piece = check_harmony_rules(piece, rules)
-            # checked_piece is a Piece object, while piece is MusicPiece object
-            return render(request, 
-                          'check_piece.html', 
-                          {'piece':checked_piece, 'form' : SelectRulesForm()})
+        response = StreamingHttpResponse(
+            self.lines(piece, rules),
+            content_type='application/x-ndjson',
+        )
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    def lines(self, piece, rules):
+        err_count = 0
+        war_count = 0
+        try:
+            for result in iter_harmony(piece.soprano, piece.alto, piece.tenor,
+                                       piece.bass, rules):
+                err_count += len(result["errors"])
+                war_count += len(result["warnings"])
+                yield json.dumps(result) + "\n"
+        except ValueError as e:  # wrong notation or parts' lengths
+            yield json.dumps({"error": str(e)}) + "\n"
+            return
+        yield json.dumps({"title": piece.title,
+                          "err_count": err_count,
+                          "war_count": war_count}) + "\n"
+
+class EditPieceView(JsonLoginRequiredMixin, View):
+    # Edits a piece of the user and returns the new results (JSON):
+    #   {"start": ..., "stop": ..., "soprano": ..., "alto": ..., "tenor": ...,
+    #    "bass": ...} - chords start..stop-1 (from 0) are replaced with the
+    #    notes given (start == stop inserts them, empty parts delete chords)
+    # The piece checked is patched (see analysis.patch_piece) - mistakes found
+    # in the chords around the edit are returned as records (see ApiCheckView)
+    VOICE_FIELDS = ('soprano', 'alto', 'tenor', 'bass')
+
+    def post(self, request, piece_id):
+        music_piece = MusicPiece.objects.get(id=piece_id)
+        if music_piece.author != request.user:
+            return HttpResponseForbidden()
+        try:
+            data = json.loads(request.body.decode('utf-8'))
+        except ValueError:
+            return self.error("Invalid JSON")
+        if not isinstance(data, dict):
+            return self.error("Expected a JSON object")
+        start = data.get("start")
+        stop = data.get("stop", start)
+        parts = [data.get(voice, "") for voice in self.VOICE_FIELDS]
+        if not isinstance(start, int) or not isinstance(stop, int):
+            return self.error("'start' and 'stop' must be integers")
+        if not all(isinstance(part, str) for part in parts):
+            return self.error("Parts must be strings")
+        piece = take_checked_piece(music_piece)
+        try:
+            start, stop = patch_piece(music_piece, piece, start, stop, parts)
+        except ValueError as e:  # wrong notation, range or parts' lengths
+            keep_checked_piece(music_piece, piece)  # not changed
+            return self.error(str(e))
+        keep_checked_piece(music_piece, piece)
+        return JsonResponse({
+            "key": piece.key_hr,
+            "chords": len(piece),
+            "err_count": piece.err_count,
+            "war_count": piece.war_count,
+            "rule_counts": piece.rule_counts,
+            "checked": [start, stop],
+            "violations": [violation._asdict()
+                           for violation in piece.violations_in(start, stop)],
+        })
+
+    def error(self, message):
+        return JsonResponse({"error": message}, status=400)
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ApiCheckView(View):
+    # Checks pieces sent as JSON (without storing them in the db):
+    #   {"soprano": ..., "alto": ..., "tenor": ..., "bass": ...,
+    #    "rules": [...]} - a single piece, or
+    #   {"pieces": [<piece>, ...], "rules": [...]} - many pieces, rules (and
+    #    max_errors) given for all the pieces can be overridden by a piece
+    # "max_errors": N stops checking a piece after more than N errors (0 - at
+    # the first one, "complete" is false then)
+    # Mistakes are returned as records (rule, severity, beat - from 0,
+    # voices, detail) instead of messages
+    MAX_PIECES = 100
+
+    def post(self, request):
+        try:
+            data = json.loads(request.body.decode('utf-8'))
+        except ValueError:
+            return self.error("Invalid JSON")
+        if not isinstance(data, dict):
+            return self.error("Expected a JSON object")
+        if "pieces" not in data:
+            return JsonResponse(self.check(data))
+        pieces = data["pieces"]
+        if not isinstance(pieces, list):
+            return self.error("'pieces' must be a list")
+        if len(pieces) > self.MAX_PIECES:
+            return self.error(
+                "At most {} pieces can be checked at once".format(
+                    self.MAX_PIECES))
+        results = []
+        for piece in pieces:
+            if not isinstance(piece, dict):
+                results.append({"valid": False,
+                                "errors": {"__all__": ["Expected an object"]}})
+                continue
+            options = {option: data[option]
+                       for option in ("rules", "max_errors") if option in data}
+            piece = dict(options, **piece)
+            results.append(self.check(piece))
+        return JsonResponse({"results": results})
+
+    def check(self, data):
+        form = CheckPartsForm(data)
+        if not form.is_valid():
+            return {"valid": False, "errors": form.errors}
+        rules = form.cleaned_data.pop('rules')
+        max_errors = form.cleaned_data.pop('max_errors')
+        piece = check_harmony_rules(MusicPiece(**form.cleaned_data), rules,
+                                    max_errors)
+        return {
+            "valid": True,
+            "complete": piece.complete,
+            "key": piece.key_hr,
+            "chords": len(piece),
+            "err_count": piece.err_count,
+            "war_count": piece.war_count,
+            "rule_counts": piece.rule_counts,
+            "violations": [violation._asdict()
+                           for violation in piece.violations],
+        }
+
+    def error(self, message):
+        return JsonResponse({"error": message}, status=400)
+
+class ApiSearchView(View):
+    # Searches the pieces the user may see (JSON, see search.py):
+    #   ?progression=T S D T - pieces with a progression of functions ("?" -
+    #    an unknown chord)
+    #   ?motions=+2 +1 0 -5/0 0 +1 -7 - pieces where voices (S A T B) move
+    #    by these intervals (in semitones) between consecutive chords
+    #   ?similar=<id> - pieces most similar to a piece
+    # ?limit= limits the number of the pieces found (1..MAX_LIMIT)
+    MAX_LIMIT = 200
+
+    def get(self, request):
+        try:
+            limit = int(request.GET.get('limit', 50))
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            return self.error("'limit' must be a positive integer")
+        limit = min(limit, self.MAX_LIMIT)
+        pieces = visible_pieces(request.user)
+        try:
+            if 'progression' in request.GET:
+                found = find_progression(
+                    request.GET['progression'].split(), pieces, limit)
+                return self.results(found, "chords")
+            if 'motions' in request.GET:
+                motions = [[int(move) for move in motion.split()]
+                           for motion in request.GET['motions'].split("/")]
+                found = find_voice_leading(motions, pieces, limit)
+                return self.results(found, "chords")
+            if 'similar' in request.GET:
+                piece = pieces.get(id=int(request.GET['similar']))
+                found = similar_pieces(piece, pieces, limit)
+                return self.results(found, "score")
+        except MusicPiece.DoesNotExist:
+            raise Http404
+        except ValueError as e:
+            return self.error(str(e))
+        return self.error("Expected 'progression', 'motions' or 'similar'")
+
+    def results(self, found, name):
+        return JsonResponse({"results": [
+            {"id": piece.id, "title": piece.title, name: value}
+            for piece, value in found
+        ]})
+
+    def error(self, message):
+        return JsonResponse({"error": message}, status=400)
+
+class ViolationStatsView(JsonLoginRequiredMixin, View):
+    # Histograms of the stored mistakes (JSON, see violation_stats) - of the
+    # user's pieces, of all the pieces for staff:
+    #   ?group_by=rule,month - groups (see violation_stats.GROUPS)
+    #   ?rule=, ?voices=, ?detail=, ?severity=, ?author=<username> - only
+    #    such mistakes are counted
+    #   ?since=, ?until= - dates (YYYY-MM-DD) the pieces were added between
+    #    (including both)
+    FILTERS = ('rule', 'voices', 'detail', 'severity')
+
+    def get(self, request):
+        violations = PieceViolation.objects.all()
+        if not request.user.is_staff:
+            violations = violations.filter(author=request.user)
+        for field in self.FILTERS:
+            if field in request.GET:
+                violations = violations.filter(**{field: request.GET[field]})
+        if 'author' in request.GET:
+            violations = violations.filter(
+                author__username=request.GET['author'])
+        try:
+            for name, lookup in (('since', 'gte'), ('until', 'lte')):
+                if name not in request.GET:
+                    continue
+                date = parse_date(request.GET[name])
+                if date is None:
+                    raise ValueError("Invalid date: {}".format(
+                        request.GET[name]))
+                violations = violations.filter(
+                    **{'date_added__date__' + lookup: date})
+            group_by = request.GET.get('group_by', 'rule').split(',')
+            results = violation_histogram(violations, group_by)
+        except ValueError as e:  # invalid date or group
+            return JsonResponse({"error": str(e)}, status=400)
+        return JsonResponse({"group_by": group_by, "results": results})
+
+class RuleStatsView(View):
+    # Timing of the harmony rules in this process (see rule_stats) - for
+    # superusers, or for everyone when DEBUG is on. POST resets the stats
+    def dispatch(self, request, *args, **kwargs):
+        if not (settings.DEBUG or request.user.is_superuser):
+            raise Http404
+        return super(RuleStatsView, self).dispatch(request, *args, **kwargs)
+
+    def get(self, request):
+        return JsonResponse({"buckets_ms": BUCKETS_MS,
+                             "rules": rule_stats()})
+
+    def post(self, request):
+        reset_rule_stats()
+        return JsonResponse({"buckets_ms": BUCKETS_MS,
+                             "rules": rule_stats()})
 
 class GenerateMidiView(View):
-    # used to create MIDI file from piece in db. MIDI is generated and uploaded
-    # only if user requests it
+    # used to get the url of MIDI file of a piece in db (after checking if
+    # user is allowed to download it)
     def get(self, request, piece_id):
         if not request.user.is_authenticated:
             return JsonResponse({"url": reverse("login"),
                                  "type": "redirect"})
         piece = MusicPiece.objects.get(id=piece_id)
         # check if user has permission to download this file (in case JS was
-        # modified). This doesn't prevent user from downloading file
-        # via entering /media/<filename> url if the midi file has been already
-        # generated (but such desperate must know not only the ID, but also
-        # the title)
+        # modified) - checked again when the file is downloaded
         if not (piece.is_public or piece.author == request.user):
             return JsonResponse({"url": reverse("login"),
                                  "type": "redirect"})
-        piece = make_piece(piece)
-        filename = '{}_{}.mid'.format(piece_id, piece.title)
-        # if file exists, don't generate it again - as it's
-        # not possible to modify piece in current version
-        if not path.isfile(path.join(MEDIA_ROOT,filename)):
-            # file doesn't exist - generate it!
-            m = Midi(4, tempo=90)
-            for idx, voice in enumerate(piece.parts):
-                m.seq_notes(piece.parts[voice], idx)
-            m.write(path.join(MEDIA_ROOT, filename))
-        url = path.join(MEDIA_URL, filename)
-        return JsonResponse({"url": url,
+        return JsonResponse({"url": reverse("download_midi",
+                                            kwargs={"piece_id": piece_id}),
                              "type": "file"})
 
+class DownloadMidiView(View):
+    # MIDI file of a piece, rendered in memory (see midi_rendering). Files
+    # depend only on the parts, so browsers may keep them (ETag)
+    CHUNK_SIZE = 64 * 1024
+
+    def get(self, request, piece_id):
+        if not request.user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        piece = MusicPiece.objects.get(id=piece_id)
+        if not (piece.is_public or piece.author == request.user):
+            return HttpResponseForbidden()
+        etag = midi_etag(piece)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            data = memoryview(midi_bytes(piece))
+            response = StreamingHttpResponse(
+                (data[i:i + self.CHUNK_SIZE]
+                 for i in range(0, len(data), self.CHUNK_SIZE)),
+                content_type='audio/midi',
+            )
+            response['Content-Length'] = len(data)
+            response['Content-Disposition'] = midi_content_disposition(piece)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
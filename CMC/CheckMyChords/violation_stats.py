@@ -0,0 +1,40 @@
+# Statistics of the stored mistakes (see PieceViolation) - counted in the
+# database (using its indexes), without checking the pieces again
+from django.db.models import Count, F
+from django.db.models.functions import TruncDay, TruncMonth, TruncYear
+
+
+# groups of the histograms - fields of PieceViolation (or expressions) by
+# name of the group
+GROUPS = {
+    "rule": {"rule": F("rule")},
+    "mistake": {"rule": F("rule"), "voices": F("voices"),
+                "detail": F("detail")},
+    "severity": {"severity": F("severity")},
+    "author": {"username": F("author__username")},
+    "day": {"day": TruncDay("date_added")},
+    "month": {"month": TruncMonth("date_added")},
+    "year": {"year": TruncYear("date_added")},
+}
+
+
+def violation_histogram(violations, group_by):
+    # [{<fields of the groups>, "count": ..., "pieces": ...}] - numbers of
+    # the mistakes (and of the pieces with them) in each group (e.g. for
+    # each rule in each month), violations - a PieceViolation queryset
+    expressions = {}
+    for group in group_by:
+        if group not in GROUPS:
+            raise ValueError("Unknown group: {}".format(group))
+        expressions.update(GROUPS[group])
+    names = sorted(expressions)
+    # fields are renamed (annotated) unless they keep their names
+    annotations = {name: expression for name, expression
+                   in expressions.items()
+                   if not (isinstance(expression, F)
+                           and expression.name == name)}
+    rows = violations.annotate(**annotations).values(*names).annotate(
+        count=Count("id"),
+        pieces=Count("piece", distinct=True),
+    )
+    return list(rows.order_by(*names))
@@ -1,4 +1,32 @@
 $(function(){
+    // asks the server for the url of the MIDI file
+    function request_midi(a_tag, url) {
+        $.ajax({
+            url: url,
+            type: "GET",
+            dataType: "json"
+        }).done(function(result) {
+            console.log("Server responded:");
+            console.log(result['type']);
+            a_tag.attr("href", result['url']);
+            if (result['type'] == "file"){
+                console.log('Received File');
+                a_tag.attr("download", "");
+            } else if (result['type'] == 'redirect'){
+                // redirect AnonymousUser to login page
+                console.log("Redirecting");
+                a_tag.removeAttr("download");
+            } else {
+                console.log("Failed");
+                return;
+            };
+            // trigger event again (the href attr has been updated)
+            a_tag.find("button").click();
+        }).fail(function(xhr,status,err) {
+            console.log("Failed to generate MIDI file");
+        });
+    };
+
     // add listener on all the buttons (on CLICK)
     var buttons = $(".midigen");
     buttons.each(function(index,element){
@@ -13,29 +41,7 @@ $(function(){
                 url = "generate_midi/" + String($(this).data("piece"));
                 // ask server to generate midi and return url from which
                 // it could be downloaded
-                $.ajax({
-                    url: url,
-                    type: "GET",
-                    dataType: "json"
-                }).done(function(result) {
-                    console.log("Server responded:");
-                    a_tag.attr("href", result['url']);
-                    console.log(result['type']);
-                    if (result['type'] == "file"){
-                        console.log('Received File');
-                        a_tag.attr("download", "");
-                    } else if (result['type'] == 'redirect'){
-                        // redirect AnonymousUser to login page
-                        console.log("Redirecting");
-                        a_tag.removeAttr("download");
-                    } else {
-                        console.log("Failed");
-                    };
-                    // trigger event again (the href attr has been updated)
-                    a_tag.find("button").click();
-                }).fail(function(xhr,status,err) {
-                    console.log("Failed to generate MIDI file");
-                });
+                request_midi(a_tag, url);
             };
         });
     });